@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import math
+import time
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.cache import TTLCache
+from app.config import ADMISSION_LANES, ADMISSION_MAX_CLIENTS
+from app.metrics import ADMISSION_IN_FLIGHT, ADMISSION_QUEUE_DEPTH, ADMISSION_SHED
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+TOO_MANY_REQUESTS = 429
+SERVICE_UNAVAILABLE = 503
+
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """One token bucket per client, refilled at `rate` tokens per second up to `burst`"""
+
+    def __init__(self, rate: float, burst: int, max_clients: int = ADMISSION_MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        # A client idle long enough to have a full bucket again needs no entry
+        self._buckets = TTLCache(maxsize=max_clients, ttl=burst / rate if rate > 0 else 1.0)
+
+    def take(self, client: str) -> float:
+        """Take a token for `client`, or return the seconds until one is available"""
+        if self.rate <= 0:
+            return 0.0
+
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+
+        if tokens < 1:
+            return (1 - tokens) / self.rate
+
+        self._buckets.set(client, (tokens - 1, now))
+
+        return 0.0
+
+
+class Lane:
+    """At most `concurrency` requests at once, with up to `queue_size` more waiting"""
+
+    def __init__(
+            self,
+            name: str,
+            paths: tuple,
+            concurrency: int,
+            queue_size: int,
+            queue_timeout: float,
+            rate: float,
+            burst: int,
+        ):
+        self.name = name
+        self.paths = paths
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.buckets = TokenBuckets(rate, burst)
+        self._slots = asyncio.Semaphore(concurrency)
+        self._waiting = 0
+
+    def matches(self, path: str) -> bool:
+        return path.startswith(self.paths)
+
+    def _shed(self, status_code: int, reason: str, retry_after: float) -> Rejected:
+        ADMISSION_SHED.inc(self.name, reason)
+        return Rejected(status_code, reason, retry_after)
+
+    async def acquire(self, client: str) -> None:
+        retry_after = self.buckets.take(client)
+
+        if retry_after > 0:
+            raise self._shed(TOO_MANY_REQUESTS, "rate_limited", retry_after)
+
+        if self._slots.locked():
+            if self._waiting >= self.queue_size:
+                raise self._shed(SERVICE_UNAVAILABLE, "queue_full", self.queue_timeout)
+
+            self._waiting += 1
+            ADMISSION_QUEUE_DEPTH.inc(self.name)
+
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._shed(SERVICE_UNAVAILABLE, "queue_timeout", self.queue_timeout)
+            finally:
+                self._waiting -= 1
+                ADMISSION_QUEUE_DEPTH.dec(self.name)
+        else:
+            await self._slots.acquire()
+
+        ADMISSION_IN_FLIGHT.inc(self.name)
+
+    def release(self) -> None:
+        ADMISSION_IN_FLIGHT.dec(self.name)
+        self._slots.release()
+
+
+def client_id(scope: Scope) -> str:
+    """Who a request counts against: its address.
+
+    Tokens aren't verified yet at this point, so keying on them would give a
+    client a fresh bucket for every made-up token.
+    """
+    client = scope.get("client")
+
+    return client[0] if client else "unknown"
+
+
+async def _reject(send: Send, rejected: Rejected) -> None:
+    if rejected.status_code == TOO_MANY_REQUESTS:
+        detail = "Too many requests, try again later."
+    else:
+        detail = "Service is overloaded, try again later."
+
+    body = json.dumps(dict(detail=detail)).encode()
+
+    await send({
+        "type": "http.response.start",
+        "status": rejected.status_code,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(max(1, math.ceil(rejected.retry_after))).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """Admit requests to expensive routes through lanes with their own limits.
+
+    Routes without a lane are never queued, so cheap proxied calls keep
+    flowing while the expensive ones wait or are shed with 429 (client over
+    its rate) or 503 (lane queue full, or waited longer than its timeout).
+    """
+
+    def __init__(self, app: ASGIApp, lanes: dict = ADMISSION_LANES):
+        self.app = app
+        self.lanes = [Lane(name, **settings) for name, settings in lanes.items()]
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        lane = next((lane for lane in self.lanes if lane.matches(scope["path"])), None)
+
+        if lane is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await lane.acquire(client_id(scope))
+        except Rejected as rejected:
+            logger.info("Shed %s %s: %s", scope["method"], scope["path"], rejected.reason)
+            await _reject(send, rejected)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            lane.release()
@@ -0,0 +1,93 @@
+import base64
+import hashlib
+import json
+import logging
+import time
+
+from app.cache import SingleFlight
+from app.cache_backends import make_cache
+from app.clients import get_client_for_url
+from app.config import (AUTH_CACHE_MAX_SIZE, AUTH_CACHE_TTL,
+                        AUTH_NEGATIVE_CACHE_TTL, TOKEN_VERIFICATION_ENDPOINT,
+                        USER_ID_ENDPOINT)
+from app.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Keys are token hashes, so raw tokens are never kept in memory longer than a request
+_token_cache = make_cache("auth", maxsize=AUTH_CACHE_MAX_SIZE, ttl=AUTH_CACHE_TTL)
+_single_flight = SingleFlight()
+
+
+def _token_hash(token: str) -> str:
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def _token_ttl(token: str) -> float:
+    """Seconds until the token's `exp` claim, capped at AUTH_CACHE_TTL"""
+    try:
+        payload = token.split(" ")[-1].split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return min(AUTH_CACHE_TTL, float(claims["exp"]) - time.time())
+    except (IndexError, ValueError, KeyError, TypeError):
+        return AUTH_CACHE_TTL
+
+
+async def _verify_token(token: str, key: tuple) -> bool:
+    res = await get_client_for_url(TOKEN_VERIFICATION_ENDPOINT).get(
+        TOKEN_VERIFICATION_ENDPOINT, params={"accessToken": token}
+    )
+
+    valid = res.status_code == 200 and res.json() is True
+
+    # Don't remember upstream failures, only real answers
+    if valid:
+        await _token_cache.set(key, True, ttl=_token_ttl(token))
+    elif res.status_code < 500:
+        await _token_cache.set(key, False, ttl=AUTH_NEGATIVE_CACHE_TTL)
+
+    return valid
+
+
+async def _resolve_user_id(token: str, key: tuple) -> str | None:
+    res = await get_client_for_url(USER_ID_ENDPOINT).get(
+        USER_ID_ENDPOINT, params={"accessToken": token}
+    )
+
+    if res.status_code != 200:
+        return None
+
+    await _token_cache.set(key, res.text, ttl=_token_ttl(token))
+
+    return res.text
+
+
+async def is_token_valid(token: str) -> bool:
+    key = ("valid", _token_hash(token))
+
+    valid = await _token_cache.get(key)
+
+    CACHE_REQUESTS.inc("auth_token", "miss" if valid is None else "hit")
+
+    if valid is None:
+        valid = await _single_flight.do(key, lambda: _verify_token(token, key))
+
+    return valid
+
+
+async def get_user_id(token: str) -> str | None:
+    key = ("userId", _token_hash(token))
+
+    user_id = await _token_cache.get(key)
+
+    CACHE_REQUESTS.inc("auth_user_id", "miss" if user_id is None else "hit")
+
+    if user_id is None:
+        user_id = await _single_flight.do(key, lambda: _resolve_user_id(token, key))
+
+    return user_id
+
+
+async def clear_auth_cache() -> None:
+    await _token_cache.clear()
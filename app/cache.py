@@ -0,0 +1,162 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+from app.deadlines import deadline_var
+
+T = TypeVar("T")
+
+_MISSING = object()
+
+
+class TTLCache:
+    """In-process LRU cache whose entries also expire after a time-to-live.
+
+    When `max_bytes` is given, entries are also evicted once the summed
+    `sizeof(value)` of all entries goes over it.
+    """
+
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: float,
+            max_bytes: int | None = None,
+            sizeof: Callable[[Any], int] = sys.getsizeof,
+        ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size_bytes = 0
+        self._data: OrderedDict[Hashable, tuple[float, int, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+
+        if entry is _MISSING:
+            return default
+
+        expires_at, _, value = entry
+
+        if expires_at <= time.monotonic():
+            self.delete(key)
+            return default
+
+        self._data.move_to_end(key)
+
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+
+        self.delete(key)
+
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+
+        if ttl <= 0 or (self.max_bytes is not None and size > self.max_bytes):
+            return
+
+        self._data[key] = (time.monotonic() + ttl, size, value)
+        self.size_bytes += size
+
+        while len(self._data) > self.maxsize or (
+            self.max_bytes is not None and self.size_bytes > self.max_bytes
+        ):
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self.size_bytes -= evicted_size
+
+    def delete(self, key: Hashable) -> None:
+        entry = self._data.pop(key, None)
+
+        if entry is not None:
+            self.size_bytes -= entry[1]
+
+    def keys(self) -> list[Hashable]:
+        return list(self._data)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.size_bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one execution.
+
+    The call runs in its own task, so a caller that is cancelled does not
+    cancel the work the other callers are waiting for. The task has no
+    deadline, since the callers sharing it may each have a different one.
+    """
+
+    def __init__(self):
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+        # Callers still waiting on a task none of them has taken the result of
+        self._waiting: dict[asyncio.Task, int] = {}
+
+    async def do(
+            self,
+            key: Hashable,
+            func: Callable[[], Awaitable[T]],
+            discard: Callable[[T], Awaitable[None]] | None = None,
+        ) -> T:
+        """Await `func()`, or the call of it already running under `key`.
+
+        If every caller is cancelled before taking the result, it is passed
+        to `discard` once ready, so resources held by it can be released.
+        """
+        task = self._tasks.get(key)
+
+        if task is None:
+            task = asyncio.ensure_future(self._run(func))
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+
+        self._waiting[task] = self._waiting.get(task, 0) + 1
+
+        try:
+            result = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            self._leave(task, discard)
+            raise
+        except BaseException:
+            self._waiting.pop(task, None)
+            raise
+
+        self._waiting.pop(task, None)
+
+        return result
+
+    def _leave(self, task: asyncio.Task, discard: Callable[[T], Awaitable[None]] | None) -> None:
+        if task not in self._waiting:
+            return
+
+        self._waiting[task] -= 1
+
+        if self._waiting[task] > 0:
+            return
+
+        del self._waiting[task]
+
+        def discard_result(task: asyncio.Task) -> None:
+            if not task.cancelled() and task.exception() is None:
+                asyncio.ensure_future(discard(task.result()))
+
+        if discard is not None:
+            task.add_done_callback(discard_result)
+
+    @staticmethod
+    async def _run(func: Callable[[], Awaitable[T]]) -> T:
+        # Only changes the task's copy of the leader's context
+        deadline_var.set(None)
+
+        return await func()
+
+    def __len__(self) -> int:
+        return len(self._tasks)
@@ -0,0 +1,393 @@
+import asyncio
+import logging
+import sys
+import uuid
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple
+
+from app.cache import TTLCache
+from app.config import (CACHE_BACKEND, CACHE_INVALIDATION_BROADCAST,
+                        CACHE_INVALIDATION_CHANNEL, CACHE_KEY_PREFIX,
+                        CACHE_NEAR_TTL, CACHE_REDIS_URL)
+from app.metrics import CACHE_BACKEND_ERRORS
+from app.serialization import dumps, loads
+
+try:
+    import redis.asyncio as redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+REDIS_AVAILABLE = redis is not None
+
+_REDIS_ERRORS = (redis.RedisError, OSError) if REDIS_AVAILABLE else (OSError,)
+
+
+class Codec(NamedTuple):
+    """How the values of a shared cache are stored"""
+    encode: Callable[[Any], bytes]
+    decode: Callable[[bytes], Any]
+
+
+JSON_CODEC = Codec(dumps, loads)
+
+
+class CacheBackend:
+    """Async cache of one namespace, returning None for keys it doesn't have.
+
+    None can't be cached, so callers store a sentinel for "known to be absent".
+    """
+
+    async def get(self, key: Hashable) -> Any:
+        raise NotImplementedError
+
+    async def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        raise NotImplementedError
+
+    async def delete(self, key: Hashable) -> None:
+        raise NotImplementedError
+
+    async def clear(self) -> None:
+        raise NotImplementedError
+
+
+class LocalCache(CacheBackend):
+    """In-process LRU with TTLs, only seen by this worker"""
+
+    def __init__(
+            self,
+            maxsize: int,
+            ttl: float,
+            max_bytes: int | None = None,
+            sizeof: Callable[[Any], int] = sys.getsizeof,
+        ):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl, max_bytes=max_bytes, sizeof=sizeof)
+
+    async def get(self, key: Hashable) -> Any:
+        return self._cache.get(key)
+
+    async def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        self._cache.set(key, value, ttl=ttl)
+
+    async def delete(self, key: Hashable) -> None:
+        self._cache.delete(key)
+
+    async def clear(self) -> None:
+        self._cache.clear()
+
+    def keys(self) -> list[Hashable]:
+        return self._cache.keys()
+
+
+def _redis_key(namespace: str, key: Hashable) -> str:
+    parts = list(key) if isinstance(key, tuple) else [key]
+
+    return f"{CACHE_KEY_PREFIX}:{namespace}:{dumps(parts).decode()}"
+
+
+class RedisCache(CacheBackend):
+    """Cache shared by every replica through Redis.
+
+    A failing Redis only costs hit rate: errors are logged and counted in
+    CACHE_BACKEND_ERRORS, and reads are answered as misses. So are values that
+    no longer decode.
+    """
+
+    def __init__(self, client, namespace: str, ttl: float, codec: Codec = JSON_CODEC):
+        self.client = client
+        self.namespace = namespace
+        self.ttl = ttl
+        self.codec = codec
+
+    def _failed(self, operation: str, exc: Exception) -> None:
+        CACHE_BACKEND_ERRORS.inc(self.namespace, operation)
+        logger.warning("Cache %s %s failed: %r", self.namespace, operation, exc)
+
+    async def get(self, key: Hashable) -> Any:
+        try:
+            raw = await self.client.get(_redis_key(self.namespace, key))
+        except _REDIS_ERRORS as exc:
+            self._failed("get", exc)
+            return None
+
+        if raw is None:
+            return None
+
+        try:
+            return self.codec.decode(raw)
+        except (ValueError, TypeError) as exc:
+            self._failed("decode", exc)
+            return None
+
+    async def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+
+        if ttl <= 0:
+            return
+
+        try:
+            await self.client.set(
+                _redis_key(self.namespace, key), self.codec.encode(value), px=max(1, int(ttl * 1000))
+            )
+        except _REDIS_ERRORS as exc:
+            self._failed("set", exc)
+
+    async def delete(self, key: Hashable) -> None:
+        try:
+            await self.client.delete(_redis_key(self.namespace, key))
+        except _REDIS_ERRORS as exc:
+            self._failed("delete", exc)
+
+    async def clear(self) -> None:
+        try:
+            keys = [key async for key in self.client.scan_iter(match=f"{CACHE_KEY_PREFIX}:{self.namespace}:*")]
+
+            if keys:
+                await self.client.delete(*keys)
+        except _REDIS_ERRORS as exc:
+            self._failed("clear", exc)
+
+
+class InvalidationBus:
+    """Redis pub/sub telling the other workers and replicas which cached entries changed"""
+
+    def __init__(self, client, channel: str = CACHE_INVALIDATION_CHANNEL):
+        self.client = client
+        self.channel = channel
+        self.sender = uuid.uuid4().hex
+        self._handlers: dict[str, Callable[[Any], Awaitable[None]]] = {}
+        self._task: asyncio.Task | None = None
+
+    def subscribe(self, namespace: str, handler: Callable[[Any], Awaitable[None]]) -> None:
+        """Have `handler(key)` awaited for the namespace's changes made elsewhere.
+
+        The key is None when anything in the namespace may have changed.
+        """
+        self._handlers[namespace] = handler
+
+    def register(self, namespace: str, near: LocalCache) -> None:
+        """Drop the entries of a near-cache that were changed elsewhere"""
+        async def drop(key: str | None) -> None:
+            if key is None:
+                await near.clear()
+            else:
+                await near.delete(key)
+
+        self.subscribe(namespace, drop)
+
+    async def publish(self, namespace: str, key: Any) -> None:
+        """Announce a changed key, or with None a cleared namespace"""
+        message = dumps(dict(sender=self.sender, namespace=namespace, key=key))
+
+        try:
+            await self.client.publish(self.channel, message)
+        except _REDIS_ERRORS as exc:
+            CACHE_BACKEND_ERRORS.inc(namespace, "publish")
+            logger.warning("Cache invalidation broadcast failed: %r", exc)
+
+    async def handle(self, data: bytes) -> None:
+        try:
+            message = loads(data)
+        except ValueError as exc:
+            logger.warning("Skipping malformed cache invalidation %r: %r", data, exc)
+            return
+
+        if not isinstance(message, dict):
+            logger.warning("Skipping malformed cache invalidation %r", data)
+            return
+
+        handler = self._handlers.get(message.get("namespace"))
+
+        if message.get("sender") == self.sender or handler is None:
+            return
+
+        await handler(message.get("key"))
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.client.pubsub()
+
+            try:
+                await pubsub.subscribe(self.channel)
+
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+
+                    # One bad message must not stop the invalidations behind it
+                    try:
+                        await self.handle(message["data"])
+                    except Exception:
+                        logger.exception("Cache invalidation %r failed", message["data"])
+            except _REDIS_ERRORS as exc:
+                logger.warning("Cache invalidation subscription failed, resubscribing: %r", exc)
+                # Invalidations may have been missed while we weren't listening
+                for handler in self._handlers.values():
+                    await handler(None)
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+class TwoTierCache(CacheBackend):
+    """A local near-cache in front of a shared cache.
+
+    Shared entries are kept locally for at most `near_ttl` seconds. With a
+    bus, writes also drop the near copies held by the other replicas, so
+    they don't serve a replaced value for that long.
+    """
+
+    def __init__(
+            self,
+            namespace: str,
+            near: LocalCache,
+            shared: CacheBackend,
+            near_ttl: float = CACHE_NEAR_TTL,
+            bus: InvalidationBus | None = None,
+        ):
+        self.namespace = namespace
+        self.near = near
+        self.shared = shared
+        self.near_ttl = near_ttl
+        self.bus = bus
+
+        if bus is not None:
+            bus.register(namespace, near)
+
+    async def _broadcast(self, key: str | None) -> None:
+        if self.bus is not None:
+            await self.bus.publish(self.namespace, key)
+
+    async def get(self, key: Hashable) -> Any:
+        near_key = _redis_key(self.namespace, key)
+        value = await self.near.get(near_key)
+
+        if value is not None:
+            return value
+
+        value = await self.shared.get(key)
+
+        if value is not None:
+            await self.near.set(near_key, value, ttl=self.near_ttl)
+
+        return value
+
+    async def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        near_key = _redis_key(self.namespace, key)
+        near_ttl = self.near_ttl if ttl is None else min(ttl, self.near_ttl)
+
+        await self.near.set(near_key, value, ttl=near_ttl)
+        await self.shared.set(key, value, ttl=ttl)
+        await self._broadcast(near_key)
+
+    async def delete(self, key: Hashable) -> None:
+        near_key = _redis_key(self.namespace, key)
+
+        await self.near.delete(near_key)
+        await self.shared.delete(key)
+        await self._broadcast(near_key)
+
+    async def clear(self) -> None:
+        await self.near.clear()
+        await self.shared.clear()
+        await self._broadcast(None)
+
+
+_redis_client = None
+_bus: InvalidationBus | None = None
+
+
+def _get_redis_client():
+    global _redis_client
+
+    if _redis_client is None:
+        # Connects on first use, so caches can be created at import time
+        _redis_client = redis.from_url(CACHE_REDIS_URL)
+
+    return _redis_client
+
+
+def _get_bus() -> InvalidationBus:
+    global _bus
+
+    if _bus is None:
+        _bus = InvalidationBus(_get_redis_client())
+
+    return _bus
+
+
+def make_cache(
+        namespace: str,
+        maxsize: int,
+        ttl: float,
+        max_bytes: int | None = None,
+        sizeof: Callable[[Any], int] = sys.getsizeof,
+        codec: Codec = JSON_CODEC,
+        shared: bool = True,
+        backend: str = CACHE_BACKEND,
+    ) -> CacheBackend:
+    """Create a cache of the configured CACHE_BACKEND.
+
+    `maxsize`, `max_bytes` and `sizeof` bound the in-process tier, `codec`
+    stores values in the shared one. With `shared=False` the cache is always
+    local, for values that are only valid in this process.
+
+    Raises RuntimeError for a Redis backend without the `redis` package,
+    which stops the service from starting.
+    """
+    local = LocalCache(maxsize, ttl, max_bytes=max_bytes, sizeof=sizeof)
+
+    if not shared or backend == "local":
+        return local
+
+    if backend not in ("redis", "two_tier"):
+        logger.warning("Unknown CACHE_BACKEND %r, using local caches", backend)
+        return local
+
+    if not REDIS_AVAILABLE:
+        # Silently caching per worker would multiply the load on the upstreams by the replica count
+        raise RuntimeError(f"CACHE_BACKEND={backend} needs the `redis` package, install it or use `local`")
+
+    redis_cache = RedisCache(_get_redis_client(), namespace, ttl, codec)
+
+    if backend == "redis":
+        return redis_cache
+
+    return TwoTierCache(
+        namespace, local, redis_cache, bus=_get_bus() if CACHE_INVALIDATION_BROADCAST else None
+    )
+
+
+def get_invalidation_bus(backend: str = CACHE_BACKEND) -> InvalidationBus | None:
+    """The bus reaching every worker and replica, when a shared CACHE_BACKEND broadcasts invalidations"""
+    if backend not in ("redis", "two_tier") or not CACHE_INVALIDATION_BROADCAST:
+        return None
+
+    if not REDIS_AVAILABLE:
+        raise RuntimeError(f"CACHE_BACKEND={backend} needs the `redis` package, install it or use `local`")
+
+    return _get_bus()
+
+
+async def start_cache_backends() -> None:
+    if _bus is not None:
+        _bus.start()
+
+
+async def close_cache_backends() -> None:
+    if _bus is not None:
+        await _bus.stop()
+
+    if _redis_client is not None:
+        await _redis_client.aclose()
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from importlib.util import find_spec
+
+import httpx
+
+from app.config import DEFAULT_UPSTREAM_SETTINGS, UPSTREAM_SETTINGS
+from app.deadlines import apply_deadline
+from app.dns import CachingNetworkBackend
+from app.metrics import (CIRCUIT_BREAKER_OPEN, UPSTREAM_POOL_CONNECTIONS,
+                         register_collector)
+from app.resilience import CircuitBreaker, ResilientTransport
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# HTTP/2 needs `h2`, installed with the httpx[http2] extra the gateway depends on.
+HTTP2_AVAILABLE = find_spec("h2") is not None
+
+_clients: dict[str, httpx.AsyncClient] = {}
+_http_transports: dict[str, httpx.AsyncHTTPTransport] = {}
+_mounted_transports: dict[str, httpx.AsyncBaseTransport] = {}
+# Kept across client rebuilds, so a failing upstream stays failed
+_circuit_breakers: dict[str, CircuitBreaker] = {}
+
+
+def _build_client(upstream: str) -> httpx.AsyncClient:
+    settings = UPSTREAM_SETTINGS.get(upstream, DEFAULT_UPSTREAM_SETTINGS)
+
+    limits = httpx.Limits(
+        max_connections=settings["max_connections"],
+        max_keepalive_connections=settings["max_keepalive_connections"],
+        keepalive_expiry=settings["keepalive_expiry"],
+    )
+
+    if settings["http2"] and not HTTP2_AVAILABLE:
+        logger.warning("HTTP/2 requested for %s but `h2` is not installed", upstream)
+
+    http_transport = _mounted_transports.get(upstream)
+
+    if http_transport is None:
+        http_transport = _http_transports[upstream] = httpx.AsyncHTTPTransport(
+            limits=limits, http2=settings["http2"] and HTTP2_AVAILABLE
+        )
+        _use_dns_cache(http_transport)
+
+    transport = ResilientTransport(
+        upstream,
+        http_transport,
+        get_circuit_breaker(upstream),
+        hedge=settings["hedge"],
+        hedge_delay=settings["hedge_delay"],
+    )
+
+    return httpx.AsyncClient(
+        base_url=f"{settings['scheme']}://{upstream}",
+        transport=transport,
+        timeout=httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+        # Never wait on an upstream longer than the request it serves may still take
+        event_hooks={"request": [apply_deadline]},
+    )
+
+
+def _use_dns_cache(transport: httpx.AsyncHTTPTransport) -> None:
+    # httpx does not take a network backend, so swap it into its pool defensively
+    pool = getattr(transport, "_pool", None)
+
+    if pool is not None and hasattr(pool, "_network_backend"):
+        pool._network_backend = CachingNetworkBackend(pool._network_backend)
+    else:
+        logger.warning("Cannot cache DNS lookups with this httpx version")
+
+
+def get_http_transport(upstream: str) -> httpx.AsyncBaseTransport | None:
+    """The connection pool of an upstream's client, below its retries and breaker"""
+    return _mounted_transports.get(upstream) or _http_transports.get(upstream)
+
+
+def get_circuit_breaker(upstream: str) -> CircuitBreaker:
+    breaker = _circuit_breakers.get(upstream)
+
+    if breaker is None:
+        settings = UPSTREAM_SETTINGS.get(upstream, DEFAULT_UPSTREAM_SETTINGS)
+        breaker = _circuit_breakers[upstream] = CircuitBreaker(
+            settings["failure_threshold"], settings["reset_timeout"]
+        )
+
+    return breaker
+
+
+def get_client(upstream: str) -> httpx.AsyncClient:
+    """Return the long-lived connection pool of an upstream, creating it on first use"""
+    client = _clients.get(upstream)
+
+    if client is None or client.is_closed:
+        client = _clients[upstream] = _build_client(upstream)
+
+    return client
+
+
+def mount_transport(upstream: str, transport: httpx.AsyncBaseTransport | None) -> None:
+    """Send an upstream's traffic through `transport` instead of the network.
+
+    Used to run the gateway against in-process stubs. Pass None to unmount.
+    Takes effect for clients created afterwards, see `close_clients`.
+    """
+    if transport is None:
+        _mounted_transports.pop(upstream, None)
+    else:
+        _mounted_transports[upstream] = transport
+
+
+def get_client_for_url(url: str) -> httpx.AsyncClient:
+    return get_client(httpx.URL(url).netloc.decode("ascii"))
+
+
+def _collect_upstream_metrics() -> None:
+    for upstream, breaker in _circuit_breakers.items():
+        CIRCUIT_BREAKER_OPEN.set(upstream, value=int(breaker.state != CircuitBreaker.CLOSED))
+
+    for upstream, transport in _http_transports.items():
+        # httpx does not expose its connection pool, so look it up defensively
+        connections = getattr(getattr(transport, "_pool", None), "connections", [])
+        idle = sum(1 for connection in connections if connection.is_idle())
+
+        UPSTREAM_POOL_CONNECTIONS.set(upstream, "idle", value=idle)
+        UPSTREAM_POOL_CONNECTIONS.set(upstream, "active", value=len(connections) - idle)
+
+
+register_collector(_collect_upstream_metrics)
+
+
+async def open_clients() -> None:
+    for upstream in UPSTREAM_SETTINGS:
+        get_client(upstream)
+
+
+async def close_clients() -> None:
+    clients = list(_clients.values())
+    _clients.clear()
+    _http_transports.clear()
+
+    await asyncio.gather(*(client.aclose() for client in clients))
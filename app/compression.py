@@ -0,0 +1,181 @@
+import gzip
+import logging
+import zlib
+
+import httpx
+from fastapi import HTTPException
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import (COMPRESSED_ROUTES, COMPRESSION_BROTLI_QUALITY,
+                        COMPRESSION_GZIP_LEVEL, COMPRESSION_MIN_SIZE)
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BROTLI_AVAILABLE = brotli is not None
+
+# Encodings the gateway can produce itself, most preferred first
+SUPPORTED_ENCODINGS = ("br", "gzip") if BROTLI_AVAILABLE else ("gzip",)
+# Encodings the gateway can decode for clients that don't accept them
+DECODABLE_ENCODINGS = ("br", "gzip", "deflate") if BROTLI_AVAILABLE else ("gzip", "deflate")
+
+
+def accepted_encodings(accept_encoding: str | None) -> set[str]:
+    """Encodings an Accept-Encoding header allows, ignoring the ones with q=0"""
+    encodings = set()
+
+    for item in (accept_encoding or "").split(","):
+        name, _, params = item.strip().partition(";")
+        q = params.strip().removeprefix("q=")
+
+        try:
+            if params and float(q) == 0:
+                continue
+        except ValueError:
+            continue
+
+        if name:
+            encodings.add(name.strip().lower())
+
+    return encodings
+
+
+def accepts(accept_encoding: str | None, encoding: str) -> bool:
+    encodings = accepted_encodings(accept_encoding)
+
+    return encoding == "identity" or encoding in encodings or "*" in encodings
+
+
+def upstream_accept_encoding(accept_encoding: str | None) -> str:
+    """What to ask an upstream for on behalf of a client: only encodings the
+    client accepts and the gateway could still decode for another client.
+    """
+    encodings = [name for name in DECODABLE_ENCODINGS if accepts(accept_encoding, name)]
+
+    return ", ".join(encodings) or "identity"
+
+
+def decode(body: bytes, encoding: str) -> bytes | None:
+    """Decompress `body`, or None when the encoding isn't one we can decode"""
+    if encoding == "gzip":
+        return gzip.decompress(body)
+
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            # Some servers send raw deflate without the zlib wrapper
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+
+    if encoding == "br" and BROTLI_AVAILABLE:
+        return brotli.decompress(body)
+
+    return None
+
+
+def encode(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def negotiate_body(
+        body: bytes, headers: httpx.Headers, accept_encoding: str | None
+    ) -> tuple[bytes, httpx.Headers]:
+    """Pass an upstream body on as it was encoded when the client accepts that,
+    otherwise decode it and drop the headers describing the encoded form.
+
+    A body the client can't accept and the gateway can't decode is a bad
+    gateway response (502).
+    """
+    encoding = headers.get("content-encoding", "identity").lower()
+
+    if accepts(accept_encoding, encoding):
+        return body, headers
+
+    try:
+        decoded = decode(body, encoding)
+    except (OSError, EOFError, zlib.error) as exc:
+        logger.warning("Could not decode %s response body: %r", encoding, exc)
+        decoded = None
+
+    if decoded is None:
+        raise HTTPException(
+            status_code=502,
+            detail=f"Upstream response is {encoding} encoded, which the client does not accept",
+        )
+
+    return decoded, httpx.Headers([
+        (key, value) for key, value in headers.multi_items()
+        if key.lower() not in ("content-encoding", "content-length")
+    ])
+
+
+class CompressionMiddleware:
+    """Compress the single-message JSON bodies of COMPRESSED_ROUTES.
+
+    Bodies smaller than COMPRESSION_MIN_SIZE, streamed bodies and responses
+    that already carry a Content-Encoding are sent unchanged.
+    """
+
+    def __init__(self, app: ASGIApp, routes: tuple = COMPRESSED_ROUTES):
+        self.app = app
+        self.routes = frozenset(routes)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] not in self.routes:
+            await self.app(scope, receive, send)
+            return
+
+        encodings = accepted_encodings(Headers(scope=scope).get("accept-encoding"))
+        encoding = next((name for name in SUPPORTED_ENCODINGS if name in encodings), None)
+
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal start
+
+            if message["type"] == "http.response.start":
+                # Held back until we know whether the body gets compressed
+                start = message
+                return
+
+            if start is None:
+                await send(message)
+                return
+
+            held, start = start, None
+            headers = MutableHeaders(raw=held["headers"])
+            body = message.get("body", b"")
+
+            if (
+                message.get("more_body", False)
+                or len(body) < COMPRESSION_MIN_SIZE
+                or "content-encoding" in headers
+            ):
+                await send(held)
+                await send(message)
+                return
+
+            body = encode(body, encoding)
+
+            headers["content-encoding"] = encoding
+            headers["content-length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            held["headers"] = headers.raw
+
+            await send(held)
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_wrapper)
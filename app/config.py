@@ -1,9 +1,34 @@
+import os
+import tempfile
+
+
+def _env_int(name: str, default: int) -> int:
+    return int(os.environ.get(name, default))
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    return os.environ.get(name, str(default)).lower() in ("1", "true", "yes", "on")
+
+
+def _available_cpus() -> int:
+    # Respects CPU pinning of the container, which os.cpu_count() does not
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+
 # URLs
 INVENTORY_SERVICE_URL = "inventory-service"
 LLM_SERVICE_URL = "llm-service:8888"
 USER_SERVICE_URL = "user-manager:8080"
 IMAGE_SERVICE_URL = "image-service:8080"
-GEOLOCATION_API_URL = "https://us1.locationiq.com/v1/search"
+GEOLOCATION_SERVICE_URL = "us1.locationiq.com"
+GEOLOCATION_API_URL = f"https://{GEOLOCATION_SERVICE_URL}/v1/search"
 
 # Endpoint templates
 QUERY_SCHEMA_ENDPOINT_TEMPLATE = "http://{}/schema/propertyQuery"
@@ -26,3 +51,250 @@ USER_ID_ENDPOINT = USER_ID_ENDPOINT_TEMPLATE.format(USER_SERVICE_URL)
 UPLOAD_IMAGE_ENDPOINT = UPLOAD_IMAGE_ENDPOINT_TEMPLATE.format(IMAGE_SERVICE_URL)
 PRIMARY_IMAGE_ENDPOINT = PRIMARY_IMAGE_ENDPOINT_TEMPLATE.format(IMAGE_SERVICE_URL)
 ALL_IMAGES_ENDPOINT = ALL_IMAGES_ENDPOINT_TEMPLATE.format(IMAGE_SERVICE_URL)
+
+
+# Upstreams: connection pool, timeouts, circuit breaker and hedging settings.
+# Every setting can be overridden with a <PREFIX>_<SETTING> environment
+# variable, e.g. INVENTORY_MAX_CONNECTIONS or LLM_SERVICE_TIMEOUT.
+def _upstream_settings(
+        prefix: str,
+        scheme: str = "http",
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        connect_timeout: float = 2.0,
+        timeout: float = 5.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 10.0,
+        hedge: bool = False,
+        hedge_delay: float = 0.2,
+        warmup_connections: int = 2,
+    ) -> dict:
+    return dict(
+        scheme=scheme,
+        max_connections=_env_int(f"{prefix}_MAX_CONNECTIONS", max_connections),
+        max_keepalive_connections=_env_int(
+            f"{prefix}_MAX_KEEPALIVE_CONNECTIONS", max_keepalive_connections
+        ),
+        keepalive_expiry=_env_float(f"{prefix}_KEEPALIVE_EXPIRY", keepalive_expiry),
+        http2=_env_bool(f"{prefix}_HTTP2", http2),
+        # Seconds to connect, and to wait on any single read/write
+        connect_timeout=_env_float(f"{prefix}_CONNECT_TIMEOUT", connect_timeout),
+        timeout=_env_float(f"{prefix}_TIMEOUT", timeout),
+        # Consecutive failures that open the breaker, and seconds before a trial call
+        failure_threshold=_env_int(f"{prefix}_FAILURE_THRESHOLD", failure_threshold),
+        reset_timeout=_env_float(f"{prefix}_RESET_TIMEOUT", reset_timeout),
+        # Send a second GET when the first is slower than the observed p95
+        # (or `hedge_delay` until enough calls were observed). Off by default,
+        # as it adds load exactly when an upstream is slow
+        hedge=_env_bool(f"{prefix}_HEDGE", hedge),
+        hedge_delay=_env_float(f"{prefix}_HEDGE_DELAY", hedge_delay),
+        # Connections opened at startup, so the first requests don't pay for connecting
+        warmup_connections=_env_int(f"{prefix}_WARMUP_CONNECTIONS", warmup_connections),
+    )
+
+
+DEFAULT_UPSTREAM_SETTINGS = _upstream_settings("UPSTREAM")
+
+UPSTREAM_SETTINGS = {
+    INVENTORY_SERVICE_URL: _upstream_settings(
+        "INVENTORY", max_connections=200, max_keepalive_connections=50
+    ),
+    USER_SERVICE_URL: _upstream_settings(
+        "USER_SERVICE", max_keepalive_connections=50, timeout=3.0
+    ),
+    IMAGE_SERVICE_URL: _upstream_settings("IMAGE_SERVICE", timeout=30.0),
+    LLM_SERVICE_URL: _upstream_settings(
+        "LLM_SERVICE", max_connections=50, timeout=30.0, failure_threshold=3,
+        reset_timeout=30.0,
+    ),
+    GEOLOCATION_SERVICE_URL: _upstream_settings(
+        "GEOLOCATION", scheme="https", max_connections=10,
+        max_keepalive_connections=5, http2=True, timeout=10.0,
+        # A third-party API, only connected to when an address needs geocoding
+        warmup_connections=0,
+    ),
+}
+
+
+# Auth cache
+AUTH_CACHE_MAX_SIZE = _env_int("AUTH_CACHE_MAX_SIZE", 10000)
+AUTH_CACHE_TTL = _env_float("AUTH_CACHE_TTL", 300.0)
+AUTH_NEGATIVE_CACHE_TTL = _env_float("AUTH_NEGATIVE_CACHE_TTL", 5.0)
+
+# Query schema cache
+QUERY_SCHEMA_MAX_AGE = _env_float("QUERY_SCHEMA_MAX_AGE", 300.0)
+
+# LLM translation cache
+LLM_CACHE_MAX_SIZE = _env_int("LLM_CACHE_MAX_SIZE", 5000)
+LLM_CACHE_MAX_BYTES = _env_int("LLM_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+LLM_CACHE_TTL = _env_float("LLM_CACHE_TTL", 24 * 60 * 60.0)
+
+# Geocoding
+GEOLOCATION_API_KEY = os.environ.get("GEOLOCATION_API_ACCESS_KEY")
+GEOCODE_CACHE_MAX_SIZE = _env_int("GEOCODE_CACHE_MAX_SIZE", 10000)
+GEOCODE_CACHE_TTL = _env_float("GEOCODE_CACHE_TTL", 7 * 24 * 60 * 60.0)
+# Provider calls per second from each worker, 0 for no limit
+GEOLOCATION_MAX_QPS = _env_float("GEOLOCATION_MAX_QPS", 2.0)
+GEOLOCATION_MAX_RETRIES = _env_int("GEOLOCATION_MAX_RETRIES", 3)
+
+# Image uploads
+IMAGE_UPLOAD_CONCURRENCY = _env_int("IMAGE_UPLOAD_CONCURRENCY", 4)
+
+# Reverse proxy
+# Bodies up to this size are buffered, larger ones and request bodies of unknown length are streamed
+PROXY_MAX_BUFFER_BYTES = _env_int("PROXY_MAX_BUFFER_BYTES", 1024 * 1024)
+
+# Response cache for idempotent proxied GETs
+RESPONSE_CACHE_MAX_SIZE = _env_int("RESPONSE_CACHE_MAX_SIZE", 2000)
+RESPONSE_CACHE_MAX_BYTES = _env_int("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+RESPONSE_CACHE_MAX_TTL = _env_float("RESPONSE_CACHE_MAX_TTL", 300.0)
+RESPONSE_CACHE_TTL = _env_float("RESPONSE_CACHE_TTL", 30.0)
+
+# Request headers that make otherwise identical in-flight GETs different
+COALESCE_VARY_HEADERS = ("authorization", "accept", "accept-encoding", "accept-language", "cookie")
+
+# Server, see app/server.py
+DEBUG = _env_bool("DEBUG", False)
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = _env_int("SERVER_PORT", 8000)
+# One worker process per core available to the container by default
+SERVER_WORKERS = _env_int("SERVER_WORKERS", _available_cpus())
+SERVER_BACKLOG = _env_int("SERVER_BACKLOG", 2048)
+# Longer than the load balancer's idle timeout, so it never reuses a closed connection
+SERVER_KEEPALIVE_TIMEOUT = _env_int("SERVER_KEEPALIVE_TIMEOUT", 75)
+# Seconds in-flight requests get to finish after SIGTERM
+SERVER_GRACEFUL_SHUTDOWN_TIMEOUT = _env_int("SERVER_GRACEFUL_SHUTDOWN_TIMEOUT", 30)
+# Requests handled at once per worker before answering 503, 0 for no limit
+SERVER_LIMIT_CONCURRENCY = _env_int("SERVER_LIMIT_CONCURRENCY", 0)
+# Restart a worker after this many requests, 0 to never restart
+SERVER_MAX_REQUESTS = _env_int("SERVER_MAX_REQUESTS", 0)
+SERVER_ACCESS_LOG = _env_bool("SERVER_ACCESS_LOG", False)
+# Proxies whose X-Forwarded-For / X-Forwarded-Proto are trusted: comma separated
+# addresses or networks, or * for any. Set it to the load balancer's, otherwise
+# every client is seen as the balancer and shares its admission rate limit
+FORWARDED_ALLOW_IPS = os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+# Logging, see app/logs.py
+# json, or text for timestamped human readable lines
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+# Characters of an upstream payload kept in a log line
+LOG_MAX_PAYLOAD_CHARS = _env_int("LOG_MAX_PAYLOAD_CHARS", 1000)
+# Fraction of high-volume info lines (payload dumps) that are written
+LOG_INFO_SAMPLE_RATE = _env_float("LOG_INFO_SAMPLE_RATE", 1.0)
+# Records waiting for the background writer before new ones are dropped
+LOG_QUEUE_SIZE = _env_int("LOG_QUEUE_SIZE", 10000)
+
+# Primary image URLs added to search results, see app/images.py
+PRIMARY_IMAGE_CACHE_MAX_SIZE = _env_int("PRIMARY_IMAGE_CACHE_MAX_SIZE", 10000)
+PRIMARY_IMAGE_CACHE_TTL = _env_float("PRIMARY_IMAGE_CACHE_TTL", 60.0)
+# Image service calls in flight at once while enriching one search page
+IMAGE_ENRICHMENT_CONCURRENCY = _env_int("IMAGE_ENRICHMENT_CONCURRENCY", 10)
+
+# Compression of the JSON the gateway builds itself, see app/compression.py
+COMPRESSED_ROUTES = ("/initial_query", "/fetchPropertiesByUser", "/queryProperties")
+COMPRESSION_MIN_SIZE = _env_int("COMPRESSION_MIN_SIZE", 1024)
+# Fast settings, the gateway compresses on every request rather than once
+COMPRESSION_GZIP_LEVEL = _env_int("COMPRESSION_GZIP_LEVEL", 5)
+COMPRESSION_BROTLI_QUALITY = _env_int("COMPRESSION_BROTLI_QUALITY", 4)
+
+
+# Admission control, see app/admission.py
+def _admission_lane(
+        prefix: str,
+        paths: tuple,
+        concurrency: int,
+        queue_size: int,
+        queue_timeout: float,
+        rate: float,
+        burst: int,
+    ) -> dict:
+    return dict(
+        # Request paths starting with any of these are admitted through the lane
+        paths=paths,
+        # Requests handled at once, and requests allowed to wait for a slot
+        concurrency=_env_int(f"{prefix}_CONCURRENCY", concurrency),
+        queue_size=_env_int(f"{prefix}_QUEUE_SIZE", queue_size),
+        queue_timeout=_env_float(f"{prefix}_QUEUE_TIMEOUT", queue_timeout),
+        # Per client token bucket: sustained requests per second and burst size, 0 to disable
+        rate=_env_float(f"{prefix}_RATE", rate),
+        burst=_env_int(f"{prefix}_BURST", burst),
+    )
+
+
+# Only expensive routes get a lane, everything else is admitted right away
+ADMISSION_LANES = {
+    "llm": _admission_lane(
+        "ADMISSION_LLM", ("/initial_query",),
+        concurrency=32, queue_size=64, queue_timeout=5.0, rate=2.0, burst=10,
+    ),
+    "property_write": _admission_lane(
+        "ADMISSION_PROPERTY_WRITE", ("/createProperty", "/updateProperty/"),
+        concurrency=16, queue_size=32, queue_timeout=10.0, rate=1.0, burst=5,
+    ),
+}
+# Clients tracked by the token buckets of one lane
+ADMISSION_MAX_CLIENTS = _env_int("ADMISSION_MAX_CLIENTS", 10000)
+
+# Background /createProperty jobs, see app/jobs.py
+# SQLite database and spooled images; mount a volume here to survive container restarts
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(tempfile.gettempdir(), "service-manager-jobs"))
+JOB_WORKERS = _env_int("JOB_WORKERS", 4)
+# Runs of a job before it is marked failed, with exponential backoff in between
+JOB_MAX_ATTEMPTS = _env_int("JOB_MAX_ATTEMPTS", 5)
+JOB_RETRY_BACKOFF = _env_float("JOB_RETRY_BACKOFF", 2.0)
+JOB_MAX_RETRY_BACKOFF = _env_float("JOB_MAX_RETRY_BACKOFF", 60.0)
+# A job whose worker stopped renewing its lease is picked up by another worker
+JOB_LEASE = _env_float("JOB_LEASE", 60.0)
+JOB_POLL_INTERVAL = _env_float("JOB_POLL_INTERVAL", 5.0)
+# Finished jobs are kept this long for /jobs/{id}
+JOB_RETENTION = _env_float("JOB_RETENTION", 7 * 24 * 60 * 60.0)
+
+# Upstream address lookups are cached this many seconds
+DNS_CACHE_TTL = _env_float("DNS_CACHE_TTL", 30.0)
+DNS_CACHE_MAX_SIZE = _env_int("DNS_CACHE_MAX_SIZE", 256)
+
+# Startup warm-up; the instance reports ready after it, or after this many seconds
+WARMUP_TIMEOUT = _env_float("WARMUP_TIMEOUT", 10.0)
+
+# Cache backend of the auth, LLM, geocoding and primary image caches:
+# "local" (in-process LRU), "redis" (shared by all replicas) or "two_tier"
+# (a local near-cache in front of Redis)
+CACHE_BACKEND = os.environ.get("CACHE_BACKEND", "local")
+CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_KEY_PREFIX = os.environ.get("CACHE_KEY_PREFIX", "service-manager")
+# Seconds a two-tier cache keeps a shared entry locally
+CACHE_NEAR_TTL = _env_float("CACHE_NEAR_TTL", 5.0)
+# Tell the other replicas to drop their near copy of a changed entry
+CACHE_INVALIDATION_BROADCAST = _env_bool("CACHE_INVALIDATION_BROADCAST", True)
+CACHE_INVALIDATION_CHANNEL = f"{CACHE_KEY_PREFIX}:invalidate"
+
+# Popular /initial_query phrasings, tracked with a Space-Saving summary of
+# POPULAR_QUERY_CAPACITY counters. Every POPULAR_QUERY_REFRESH_INTERVAL
+# seconds the POPULAR_QUERY_TOP_K queries seen at least POPULAR_QUERY_MIN_COUNT
+# times are translated ahead of time, with their inventory results when
+# POPULAR_QUERY_PRECOMPUTE_RESULTS is on. Counts are then multiplied by
+# POPULAR_QUERY_DECAY, so popularity follows recent traffic.
+POPULAR_QUERY_CAPACITY = _env_int("POPULAR_QUERY_CAPACITY", 1000)
+POPULAR_QUERY_TOP_K = _env_int("POPULAR_QUERY_TOP_K", 20)
+POPULAR_QUERY_MIN_COUNT = _env_int("POPULAR_QUERY_MIN_COUNT", 3)
+POPULAR_QUERY_REFRESH_INTERVAL = _env_float("POPULAR_QUERY_REFRESH_INTERVAL", 20.0)
+POPULAR_QUERY_DECAY = _env_float("POPULAR_QUERY_DECAY", 0.5)
+POPULAR_QUERY_PRECOMPUTE_RESULTS = _env_bool("POPULAR_QUERY_PRECOMPUTE_RESULTS", True)
+# Inventory results are as fresh as proxied responses, dropped on any write
+POPULAR_QUERY_RESULT_TTL = _env_float("POPULAR_QUERY_RESULT_TTL", RESPONSE_CACHE_TTL)
+
+# Seconds a request may take. Clients can ask for another deadline with an
+# X-Request-Timeout header, kept within DEADLINE_MIN and DEADLINE_MAX.
+# 0 disables the deadline.
+DEADLINE_DEFAULT = _env_float("DEADLINE_DEFAULT", 30.0)
+DEADLINE_MIN = _env_float("DEADLINE_MIN", 1.0)
+DEADLINE_MAX = _env_float("DEADLINE_MAX", 120.0)
+# Path prefix -> deadline of routes that need more than DEADLINE_DEFAULT
+DEADLINE_ROUTES = {
+    "/initial_query": _env_float("DEADLINE_INITIAL_QUERY", 40.0),
+    "/createProperty": _env_float("DEADLINE_CREATE_PROPERTY", 120.0),
+    "/updateProperty/": _env_float("DEADLINE_UPDATE_PROPERTY", 60.0),
+    "/upload": _env_float("DEADLINE_UPLOAD", 120.0),
+}
@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import deque
+from contextvars import ContextVar
+
+import httpx
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import (DEADLINE_DEFAULT, DEADLINE_MAX, DEADLINE_MIN,
+                        DEADLINE_ROUTES)
+from app.metrics import REQUESTS_CANCELLED
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Seconds the caller is willing to wait, read from clients and sent to upstreams
+DEADLINE_HEADER = "X-Request-Timeout"
+
+# Status of requests whose client went away, as nginx logs them
+CLIENT_CLOSED_REQUEST = 499
+GATEWAY_TIMEOUT = 504
+
+# Set on upstream requests whose timeouts were shortened to the deadline
+DEADLINE_BOUND = "deadline_bound"
+
+# time.monotonic() by which the current request must be answered
+deadline_var: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(httpx.TimeoutException):
+    """Raised instead of calling an upstream once the request's deadline has passed"""
+
+
+def remaining() -> float | None:
+    """Seconds left until the current request's deadline, or None without one"""
+    deadline = deadline_var.get()
+
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def request_timeout(scope: Scope, routes: dict = DEADLINE_ROUTES) -> float:
+    """The client's X-Request-Timeout within DEADLINE_MIN and DEADLINE_MAX, else the route's default"""
+    value = Headers(scope=scope).get(DEADLINE_HEADER)
+
+    if value is not None:
+        try:
+            timeout = float(value)
+        except ValueError:
+            timeout = math.nan
+
+        if math.isfinite(timeout) and timeout > 0:
+            # Too short a deadline would only turn healthy upstream calls into timeouts
+            return min(max(timeout, DEADLINE_MIN), DEADLINE_MAX)
+
+    path = scope["path"]
+
+    return next(
+        (timeout for prefix, timeout in routes.items() if path.startswith(prefix)), DEADLINE_DEFAULT
+    )
+
+
+async def apply_deadline(request: httpx.Request) -> None:
+    """httpx request hook passing the time left on to the upstream.
+
+    The upstream gets it as X-Request-Timeout, and no connect, read, write
+    or pool wait may take longer than it. A timeout that only happened
+    because of that is the caller's doing, see `DEADLINE_BOUND`.
+    """
+    left = remaining()
+
+    if left is None:
+        return
+
+    if left <= 0:
+        raise DeadlineExceeded("Request deadline exceeded", request=request)
+
+    request.headers[DEADLINE_HEADER] = f"{left:.3f}"
+
+    timeouts = request.extensions.get("timeout", {})
+
+    request.extensions[DEADLINE_BOUND] = any(
+        timeouts.get(name) is None or timeouts[name] > left
+        for name in ("connect", "read", "write", "pool")
+    )
+    request.extensions["timeout"] = {
+        name: left if timeouts.get(name) is None else min(timeouts[name], left)
+        for name in ("connect", "read", "write", "pool")
+    }
+
+
+class DeadlineMiddleware:
+    """Run each request with a deadline, cancelling it when the deadline
+    passes (answering 504) or when the client disconnects.
+
+    Disconnects are noticed once the app has read the request body, so a
+    streamed upload is never buffered to watch for them.
+    """
+
+    def __init__(self, app: ASGIApp, routes: dict = DEADLINE_ROUTES):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timeout = request_timeout(scope, self.routes)
+        headers = Headers(scope=scope)
+        has_body = "transfer-encoding" in headers or headers.get("content-length", "0") != "0"
+
+        body_read = asyncio.Event()
+        disconnected = asyncio.Event()
+        receive_lock = asyncio.Lock()
+        pending: deque[Message] = deque()
+        response_started = False
+
+        async def read() -> Message:
+            message = await receive()
+
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+            elif not message.get("more_body", False):
+                body_read.set()
+
+            return message
+
+        async def receive_wrapper() -> Message:
+            if not pending and not body_read.is_set():
+                async with receive_lock:
+                    if not pending and not body_read.is_set():
+                        return await read()
+
+            if pending:
+                return pending.popleft()
+
+            # The watcher reads from here on, and only a disconnect can come
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal response_started
+
+            if message["type"] == "http.response.start":
+                response_started = True
+
+            await send(message)
+
+        async def watch_disconnect() -> None:
+            if has_body:
+                await body_read.wait()
+
+            while not disconnected.is_set():
+                async with receive_lock:
+                    message = await read()
+
+                # The empty body of a request without one, read before the app asked
+                if message["type"] != "http.disconnect":
+                    pending.append(message)
+
+        token = deadline_var.set(time.monotonic() + timeout if timeout > 0 else None)
+
+        try:
+            app_task = asyncio.ensure_future(self.app(scope, receive_wrapper, send_wrapper))
+        finally:
+            # The task has copied the context, this one no longer needs it
+            deadline_var.reset(token)
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+
+        try:
+            done, _ = await asyncio.wait(
+                {app_task, watcher},
+                timeout=timeout if timeout > 0 else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        except asyncio.CancelledError:
+            app_task.cancel()
+            raise
+        finally:
+            watcher.cancel()
+
+        if app_task in done:
+            app_task.result()
+            return
+
+        app_task.cancel()
+        await asyncio.gather(app_task, return_exceptions=True)
+
+        reason = "disconnect" if disconnected.is_set() else "deadline"
+        REQUESTS_CANCELLED.inc(reason)
+        logger.info("Cancelled %s %s: %s", scope["method"], scope["path"], reason)
+
+        if response_started:
+            return
+
+        if reason == "disconnect":
+            # Nobody reads it, but it records the request as cut short rather than failed
+            await send({"type": "http.response.start", "status": CLIENT_CLOSED_REQUEST, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        body = json.dumps(dict(detail="Request deadline exceeded.")).encode()
+
+        await send({
+            "type": "http.response.start",
+            "status": GATEWAY_TIMEOUT,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,107 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+import typing
+
+import httpcore
+
+from app.cache import TTLCache
+from app.config import DNS_CACHE_MAX_SIZE, DNS_CACHE_TTL
+from app.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_addresses = TTLCache(maxsize=DNS_CACHE_MAX_SIZE, ttl=DNS_CACHE_TTL)
+
+
+def _is_ip(host: str) -> bool:
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        return False
+
+    return True
+
+
+async def resolve(host: str, port: int, timeout: float | None = None) -> list[str]:
+    """Addresses of `host`, looked up at most once every DNS_CACHE_TTL seconds"""
+    if _is_ip(host):
+        return [host]
+
+    addresses = _addresses.get((host, port))
+
+    if addresses is not None:
+        CACHE_REQUESTS.inc("dns", "hit")
+        return addresses
+
+    CACHE_REQUESTS.inc("dns", "miss")
+
+    try:
+        infos = await asyncio.wait_for(
+            asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout
+        )
+    except (OSError, asyncio.TimeoutError) as exc:
+        raise httpcore.ConnectError(f"Could not resolve {host}: {exc!r}") from exc
+
+    # getaddrinfo may list an address once per protocol, keep its order
+    addresses = list(dict.fromkeys(info[4][0] for info in infos))
+    _addresses.set((host, port), addresses)
+
+    return addresses
+
+
+def forget(host: str, port: int) -> None:
+    _addresses.delete((host, port))
+
+
+def clear_dns_cache() -> None:
+    _addresses.clear()
+
+
+class CachingNetworkBackend(httpcore.AsyncNetworkBackend):
+    """httpcore network backend connecting to addresses from the DNS cache.
+
+    Addresses are tried in order. When none of them accepts the connection
+    the host is looked up again on the next connect, in case it moved.
+    """
+
+    def __init__(self, backend: httpcore.AsyncNetworkBackend):
+        self.backend = backend
+
+    async def connect_tcp(
+            self,
+            host: str,
+            port: int,
+            timeout: float | None = None,
+            local_address: str | None = None,
+            socket_options: typing.Iterable | None = None,
+        ) -> httpcore.AsyncNetworkStream:
+        addresses = await resolve(host, port, timeout)
+        error = httpcore.ConnectError(f"No addresses found for {host}")
+
+        for address in addresses:
+            try:
+                return await self.backend.connect_tcp(
+                    address, port, timeout=timeout, local_address=local_address,
+                    socket_options=socket_options,
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as exc:
+                logger.info("Connecting to %s (%s) failed: %r", host, address, exc)
+                error = exc
+
+        forget(host, port)
+
+        raise error
+
+    async def connect_unix_socket(
+            self,
+            path: str,
+            timeout: float | None = None,
+            socket_options: typing.Iterable | None = None,
+        ) -> httpcore.AsyncNetworkStream:
+        return await self.backend.connect_unix_socket(path, timeout=timeout, socket_options=socket_options)
+
+    async def sleep(self, seconds: float) -> None:
+        await self.backend.sleep(seconds)
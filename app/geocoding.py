@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import re
+import time
+
+from app.cache import SingleFlight
+from app.cache_backends import JSON_CODEC, Codec, make_cache
+from app.clients import get_client_for_url
+from app.config import (GEOCODE_CACHE_MAX_SIZE, GEOCODE_CACHE_TTL,
+                        GEOLOCATION_API_KEY, GEOLOCATION_API_URL,
+                        GEOLOCATION_MAX_QPS, GEOLOCATION_MAX_RETRIES)
+from app.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_SEPARATORS = re.compile(r"[\s,;]+")
+
+
+class AddressNotFoundError(LookupError):
+    """The geocoding provider has no match for an address"""
+
+
+class RateLimiter:
+    """Space calls at least 1 / `rate` seconds apart, queueing callers in order.
+
+    A `rate` of 0 or less doesn't limit calls.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next_slot = 0.0
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self.interval
+
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def defer(self, delay: float) -> None:
+        """Push back every queued call, e.g. after the provider throttled us"""
+        self._next_slot = max(self._next_slot, time.monotonic() + delay)
+
+
+_geocode_cache = make_cache(
+    "geocode",
+    maxsize=GEOCODE_CACHE_MAX_SIZE,
+    ttl=GEOCODE_CACHE_TTL,
+    # Coordinates come back from JSON as a list
+    codec=Codec(JSON_CODEC.encode, lambda raw: tuple(JSON_CODEC.decode(raw))),
+)
+_single_flight = SingleFlight()
+_rate_limiter = RateLimiter(GEOLOCATION_MAX_QPS)
+
+
+def _address_key(address: str, location: str) -> str:
+    return _SEPARATORS.sub(" ", f"{address} {location}".casefold()).strip()
+
+
+def is_same_address(current: dict, updated: dict) -> bool:
+    return _address_key(current.get("address", ""), current.get("location", "")) == \
+        _address_key(updated["address"], updated["location"])
+
+
+async def get_cached_coordinates(address: str, location: str) -> tuple[float, float] | None:
+    return await _geocode_cache.get(_address_key(address, location))
+
+
+async def _fetch_coordinates(key: str, query: str) -> tuple[float, float] | None:
+    client = get_client_for_url(GEOLOCATION_API_URL)
+    params = dict(key=GEOLOCATION_API_KEY, q=query, format="json")
+
+    for _ in range(GEOLOCATION_MAX_RETRIES + 1):
+        await _rate_limiter.acquire()
+
+        res = await client.get(GEOLOCATION_API_URL, params=params)
+
+        if res.status_code != 429:
+            break
+
+        # Throttled: wait for the provider before anyone else tries again
+        retry_after = res.headers.get("Retry-After", "")
+        # Without a limit of our own, give the provider a second
+        _rate_limiter.defer(float(retry_after) if retry_after.isdigit() else _rate_limiter.interval or 1.0)
+        logger.warning("Geocoding throttled by provider, retrying")
+
+    if res.status_code != 200:
+        return None
+
+    matches = res.json()
+
+    if not matches:
+        raise AddressNotFoundError(query)
+
+    coords = matches[0]
+    coordinates = float(coords["lon"]), float(coords["lat"])
+
+    await _geocode_cache.set(key, coordinates)
+
+    return coordinates
+
+
+async def geocode(address: str, location: str) -> tuple[float, float] | None:
+    """Return (longitude, latitude) of an address, or None when the provider failed.
+
+    Raise AddressNotFoundError when the provider has no match for it.
+    """
+    key = _address_key(address, location)
+
+    coordinates = await _geocode_cache.get(key)
+
+    CACHE_REQUESTS.inc("geocode", "miss" if coordinates is None else "hit")
+
+    if coordinates is None:
+        coordinates = await _single_flight.do(
+            key, lambda: _fetch_coordinates(key, f"{address} {location}")
+        )
+
+    return coordinates
+
+
+async def remember_coordinates(address: str, location: str, coordinates: tuple[float, float]) -> None:
+    await _geocode_cache.set(_address_key(address, location), coordinates)
+
+
+async def clear_geocode_cache() -> None:
+    await _geocode_cache.clear()
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+
+import httpx
+
+from app.cache import SingleFlight
+from app.cache_backends import make_cache
+from app.clients import get_client_for_url
+from app.config import (IMAGE_ENRICHMENT_CONCURRENCY, IMAGE_SERVICE_URL,
+                        PRIMARY_IMAGE_CACHE_MAX_SIZE, PRIMARY_IMAGE_CACHE_TTL,
+                        PRIMARY_IMAGE_ENDPOINT)
+from app.metrics import CACHE_REQUESTS
+from app.proxy_cache import add_invalidation_listener
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Keys under which the inventory returns its list of properties
+PROPERTY_LIST_KEYS = ("properties", "content", "items", "results")
+
+# Cached for properties without a primary image, as None means "not cached"
+_NO_IMAGE = ""
+
+_primary_image_cache = make_cache(
+    "primary_image", maxsize=PRIMARY_IMAGE_CACHE_MAX_SIZE, ttl=PRIMARY_IMAGE_CACHE_TTL
+)
+_single_flight = SingleFlight()
+
+
+async def _fetch_primary_image_url(property_id) -> str | None:
+    res = await get_client_for_url(PRIMARY_IMAGE_ENDPOINT).get(
+        PRIMARY_IMAGE_ENDPOINT, params={"propertyId": property_id}
+    )
+
+    if res.status_code == 200:
+        url = res.json() if res.headers.get("content-type", "").startswith("application/json") \
+            else res.text
+    elif res.status_code == 404:
+        url = None
+    else:
+        # Don't remember upstream failures
+        return None
+
+    await _primary_image_cache.set(str(property_id), url or _NO_IMAGE)
+
+    return url
+
+
+async def get_primary_image_url(property_id) -> str | None:
+    # Keyed on the id as text, the form it has in query parameters
+    url = await _primary_image_cache.get(str(property_id))
+
+    CACHE_REQUESTS.inc("primary_image", "miss" if url is None else "hit")
+
+    if url is None:
+        url = await _single_flight.do(property_id, lambda: _fetch_primary_image_url(property_id))
+
+    return url or None
+
+
+def _property_list(search_result) -> list:
+    if isinstance(search_result, list):
+        return search_result
+
+    for key in PROPERTY_LIST_KEYS:
+        if isinstance(search_result.get(key), list):
+            return search_result[key]
+
+    return []
+
+
+async def add_primary_image_urls(search_result: dict | list) -> dict | list:
+    """Set `primaryImageUrl` on every property of a search result, in place.
+
+    Image service calls run concurrently, at most IMAGE_ENRICHMENT_CONCURRENCY
+    at a time. A property whose image can't be fetched gets None rather than
+    failing the whole search.
+    """
+    semaphore = asyncio.Semaphore(IMAGE_ENRICHMENT_CONCURRENCY)
+
+    async def enrich(item: dict) -> None:
+        async with semaphore:
+            try:
+                item["primaryImageUrl"] = await get_primary_image_url(item["propertyId"])
+            except httpx.HTTPError as exc:
+                logger.warning("Fetching primary image of property %s failed: %r", item["propertyId"], exc)
+                item["primaryImageUrl"] = None
+
+    await asyncio.gather(*(
+        enrich(item) for item in _property_list(search_result)
+        if isinstance(item, dict) and "propertyId" in item
+    ))
+
+    return search_result
+
+
+async def forget_primary_image(property_id) -> None:
+    await _primary_image_cache.delete(str(property_id))
+
+
+async def clear_primary_image_cache() -> None:
+    await _primary_image_cache.clear()
+
+
+async def _forget_images(call_url: str | None, params: dict | None) -> None:
+    # Image service writes, through the gateway's routes or another worker
+    if call_url not in (None, IMAGE_SERVICE_URL):
+        return
+
+    property_id = (params or {}).get("propertyId")
+
+    if property_id is None:
+        await clear_primary_image_cache()
+    else:
+        await forget_primary_image(property_id)
+
+
+add_invalidation_listener(_forget_images)
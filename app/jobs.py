@@ -0,0 +1,464 @@
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import httpx
+from starlette.datastructures import Headers, UploadFile
+
+from app.config import (IMAGE_SERVICE_URL, IMAGE_UPLOAD_CONCURRENCY,
+                        INVENTORY_SERVICE_URL, JOB_LEASE, JOB_MAX_ATTEMPTS,
+                        JOB_MAX_RETRY_BACKOFF, JOB_POLL_INTERVAL,
+                        JOB_RETENTION, JOB_RETRY_BACKOFF, JOB_WORKERS,
+                        JOBS_DIR, UPLOAD_IMAGE_ENDPOINT)
+from app.geocoding import AddressNotFoundError, geocode
+from app.metrics import JOBS
+from app.proxy_cache import invalidate_responses
+from app.utils import async_post_data, async_upload_file
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+CREATE_PROPERTY = "create_property"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    status TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    progress TEXT NOT NULL DEFAULT '{}',
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    not_before REAL NOT NULL DEFAULT 0,
+    lease_until REAL NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class JobStepError(Exception):
+    """A step of a job failed in a way that is worth retrying"""
+
+
+class JobStore:
+    """Jobs in a SQLite database, safe to share between worker processes.
+
+    Methods block on disk, call them through `asyncio.to_thread`.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(directory, "jobs.sqlite3"), timeout=30, check_same_thread=False,
+        )
+        self._db.row_factory = sqlite3.Row
+
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(_SCHEMA)
+
+    def spool_dir(self, job_id: str) -> str:
+        return os.path.join(self.directory, job_id)
+
+    def _execute(self, sql: str, params: tuple = ()) -> int:
+        """Run a statement, returning the number of rows it changed"""
+        with self._lock, self._db:
+            return self._db.execute(sql, params).rowcount
+
+    def _query(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        # Fetched under the lock, as another thread may use the connection right after
+        with self._lock, self._db:
+            return self._db.execute(sql, params).fetchall()
+
+    def create(self, job_id: str, kind: str, owner: str, payload: dict, progress: dict) -> None:
+        now = time.time()
+
+        self._execute(
+            "INSERT INTO jobs (id, kind, owner, status, payload, progress, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, kind, owner, QUEUED, json.dumps(payload), json.dumps(progress), now, now),
+        )
+
+    def get(self, job_id: str) -> dict | None:
+        rows = self._query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+
+        if not rows:
+            return None
+
+        job = dict(rows[0])
+
+        for column in ("payload", "progress", "result"):
+            job[column] = json.loads(job[column]) if job[column] is not None else None
+
+        return job
+
+    def claim(self, job_id: str, lease: float, max_attempts: int = JOB_MAX_ATTEMPTS) -> dict | None:
+        """Take a due queued job, or one whose worker's lease ran out, with attempts left"""
+        now = time.time()
+
+        claimed = self._execute(
+            "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ? "
+            "WHERE id = ? AND attempts < ? "
+            "AND ((status = ? AND not_before <= ?) OR (status = ? AND lease_until < ?))",
+            (RUNNING, now + lease, now, job_id, max_attempts, QUEUED, now, RUNNING, now),
+        )
+
+        return self.get(job_id) if claimed else None
+
+    def claimable(self, limit: int = 100, max_attempts: int = JOB_MAX_ATTEMPTS) -> list[str]:
+        now = time.time()
+
+        rows = self._query(
+            "SELECT id FROM jobs WHERE attempts < ? "
+            "AND ((status = ? AND not_before <= ?) OR (status = ? AND lease_until < ?)) "
+            "ORDER BY created_at LIMIT ?",
+            (max_attempts, QUEUED, now, RUNNING, now, limit),
+        )
+
+        return [row["id"] for row in rows]
+
+    def fail_abandoned(self, max_attempts: int = JOB_MAX_ATTEMPTS) -> int:
+        """Fail running jobs whose lease ran out on their last attempt"""
+        rows = self._query(
+            "SELECT id FROM jobs WHERE status = ? AND lease_until < ? AND attempts >= ?",
+            (RUNNING, time.time(), max_attempts),
+        )
+
+        for row in rows:
+            job = self.get(row["id"])
+            self.finish(
+                job["id"], FAILED, _job_result(job["progress"]),
+                f"Worker lost the job on its last attempt ({job['attempts']}).",
+            )
+            shutil.rmtree(self.spool_dir(job["id"]), ignore_errors=True)
+
+        return len(rows)
+
+    def save_progress(self, job_id: str, progress: dict, lease: float) -> None:
+        now = time.time()
+
+        self._execute(
+            "UPDATE jobs SET progress = ?, lease_until = ?, updated_at = ? WHERE id = ?",
+            (json.dumps(progress), now + lease, now, job_id),
+        )
+
+    def renew_lease(self, job_id: str, lease: float) -> None:
+        now = time.time()
+
+        self._execute(
+            "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = ?",
+            (now + lease, now, job_id, RUNNING),
+        )
+
+    def retry_later(self, job_id: str, error: str, delay: float) -> None:
+        now = time.time()
+
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, not_before = ?, lease_until = 0, updated_at = ? "
+            "WHERE id = ?",
+            (QUEUED, error, now + delay, now, job_id),
+        )
+
+    def finish(self, job_id: str, status: str, result: dict, error: str | None = None) -> None:
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, lease_until = 0, updated_at = ? "
+            "WHERE id = ?",
+            (status, json.dumps(result), error, time.time(), job_id),
+        )
+
+    def prune(self, older_than: float) -> int:
+        rows = self._query(
+            "SELECT id FROM jobs WHERE status IN (?, ?) AND updated_at < ?",
+            (SUCCEEDED, FAILED, time.time() - older_than),
+        )
+
+        for row in rows:
+            shutil.rmtree(self.spool_dir(row["id"]), ignore_errors=True)
+            self._execute("DELETE FROM jobs WHERE id = ?", (row["id"],))
+
+        return len(rows)
+
+
+_store: JobStore | None = None
+_queue: asyncio.Queue | None = None
+# Ids in the queue, so a job that is due again before a worker got to it isn't queued twice
+_queued: set[str] = set()
+_workers: list[asyncio.Task] = []
+
+
+def _put(job_id: str) -> None:
+    if _queue is not None and job_id not in _queued:
+        _queued.add(job_id)
+        _queue.put_nowait(job_id)
+
+
+def get_job_store() -> JobStore:
+    global _store
+
+    if _store is None:
+        _store = JobStore(JOBS_DIR)
+
+    return _store
+
+
+def _spool_image(path: str, upload: UploadFile) -> int:
+    upload.file.seek(0)
+
+    with open(path, "wb") as f:
+        shutil.copyfileobj(upload.file, f)
+
+    return os.path.getsize(path)
+
+
+async def enqueue_create_property(owner: str, inventory_data: dict, images: list) -> str:
+    """Persist a /createProperty request with its images and queue it, returning the job id"""
+    store = get_job_store()
+    job_id = uuid.uuid4().hex
+    spool_dir = store.spool_dir(job_id)
+
+    await asyncio.to_thread(os.makedirs, spool_dir, exist_ok=True)
+
+    spooled = []
+
+    for index, image in enumerate(images):
+        path = os.path.join(spool_dir, str(index))
+        size = await asyncio.to_thread(_spool_image, path, image)
+
+        spooled.append(dict(
+            index=index,
+            filename=image.filename,
+            contentType=image.content_type,
+            path=path,
+            size=size,
+            uploaded=False,
+        ))
+
+    await asyncio.to_thread(
+        store.create, job_id, CREATE_PROPERTY, owner, inventory_data, dict(images=spooled),
+    )
+
+    JOBS.inc(CREATE_PROPERTY, QUEUED)
+    _put(job_id)
+
+    return job_id
+
+
+async def get_job(job_id: str) -> dict | None:
+    return await asyncio.to_thread(get_job_store().get, job_id)
+
+
+async def _upload_spooled_image(semaphore: asyncio.Semaphore, property_id, image: dict) -> None:
+    async with semaphore:
+        with open(image["path"], "rb") as f:
+            upload = UploadFile(
+                f,
+                size=image["size"],
+                filename=image["filename"],
+                headers=Headers({"content-type": image["contentType"] or "application/octet-stream"}),
+            )
+
+            try:
+                res = await async_upload_file(
+                    UPLOAD_IMAGE_ENDPOINT,
+                    upload,
+                    params=dict(propertyId=property_id, primary=image["index"] == 0),
+                )
+            except httpx.HTTPError as exc:
+                logger.warning(
+                    "Uploading image %s of property %s failed: %r", image["index"], property_id, exc
+                )
+                return
+
+    image["uploaded"] = res is not None
+
+
+async def _run_create_property(store: JobStore, job: dict) -> dict:
+    """Run the steps of a /createProperty job that haven't succeeded yet.
+
+    Progress is saved after every step, so a retried job neither geocodes
+    again nor creates the property twice nor uploads an image twice.
+    """
+    payload, progress = job["payload"], job["progress"]
+
+    async def save():
+        await asyncio.to_thread(store.save_progress, job["id"], progress, JOB_LEASE)
+
+    if "coordinates" not in progress:
+        coordinates = await geocode(payload["address"], payload["location"])
+
+        if coordinates is None:
+            raise JobStepError("Couldn't fetch coordinates of a location.")
+
+        progress["coordinates"] = list(coordinates)
+        await save()
+
+    if "propertyId" not in progress:
+        inventory_data = dict(payload)
+        inventory_data["longitude"], inventory_data["latitude"] = progress["coordinates"]
+
+        inv_resp = await async_post_data(f"http://{INVENTORY_SERVICE_URL}/properties/", inventory_data)
+
+        if inv_resp is None:
+            raise JobStepError("Error when creating new property.")
+
+        progress["propertyId"] = inv_resp["propertyId"]
+        await invalidate_responses(INVENTORY_SERVICE_URL)
+        await save()
+
+    property_id = progress["propertyId"]
+    pending = [image for image in progress["images"] if not image["uploaded"]]
+
+    if pending:
+        semaphore = asyncio.Semaphore(IMAGE_UPLOAD_CONCURRENCY)
+        await asyncio.gather(*(_upload_spooled_image(semaphore, property_id, image) for image in pending))
+        await save()
+
+        await invalidate_responses(IMAGE_SERVICE_URL, dict(propertyId=str(property_id)))
+
+    failed = [image["index"] for image in progress["images"] if not image["uploaded"]]
+
+    if failed:
+        raise JobStepError(f"Error when uploading images {failed} for a property with id = {property_id}.")
+
+    return _job_result(progress)
+
+
+def _job_result(progress: dict) -> dict:
+    return dict(
+        propertyId=progress.get("propertyId"),
+        images=[
+            dict(index=image["index"], filename=image["filename"], uploaded=image["uploaded"])
+            for image in progress["images"]
+        ],
+    )
+
+
+async def _fail(store: JobStore, job: dict, error: str) -> None:
+    await asyncio.to_thread(store.finish, job["id"], FAILED, _job_result(job["progress"]), error)
+    await asyncio.to_thread(shutil.rmtree, store.spool_dir(job["id"]), True)
+    JOBS.inc(job["kind"], FAILED)
+
+
+async def _keep_lease(store: JobStore, job_id: str) -> None:
+    # Renewed well before it runs out, so a slow step isn't taken over by another worker
+    while True:
+        await asyncio.sleep(JOB_LEASE / 3)
+        await asyncio.to_thread(store.renew_lease, job_id, JOB_LEASE)
+
+
+async def run_job(job_id: str) -> None:
+    store = get_job_store()
+    job = await asyncio.to_thread(store.claim, job_id, JOB_LEASE)
+
+    # Finished, not due yet, out of attempts, or taken by another worker
+    if job is None:
+        return
+
+    heartbeat = asyncio.ensure_future(_keep_lease(store, job_id))
+
+    try:
+        result = await _run_create_property(store, job)
+    except (JobStepError, httpx.HTTPError) as exc:
+        error = str(exc) or repr(exc)
+
+        if job["attempts"] >= JOB_MAX_ATTEMPTS:
+            logger.warning("Job %s failed after %s attempts: %s", job_id, job["attempts"], error)
+            await _fail(store, job, error)
+            return
+
+        delay = min(JOB_MAX_RETRY_BACKOFF, JOB_RETRY_BACKOFF * 2 ** (job["attempts"] - 1))
+        logger.info("Job %s attempt %s failed, retrying in %.1fs: %s", job_id, job["attempts"], delay, error)
+        await asyncio.to_thread(store.retry_later, job_id, error, delay)
+        JOBS.inc(job["kind"], "retried")
+
+        asyncio.get_running_loop().call_later(delay, _put, job_id)
+
+        return
+    except AddressNotFoundError:
+        await _fail(store, job, "Address not found.")
+        return
+    except Exception as exc:
+        # A malformed payload or upstream response fails the same way every time
+        logger.exception("Job %s failed", job_id)
+        await _fail(store, job, repr(exc))
+        return
+    finally:
+        heartbeat.cancel()
+
+    await asyncio.to_thread(store.finish, job_id, SUCCEEDED, result)
+    await asyncio.to_thread(shutil.rmtree, store.spool_dir(job_id), True)
+    JOBS.inc(job["kind"], SUCCEEDED)
+
+
+async def _worker() -> None:
+    while True:
+        job_id = await _queue.get()
+        _queued.discard(job_id)
+
+        try:
+            await run_job(job_id)
+        except Exception:
+            # The job store failing must not take a worker down; the job's lease will expire
+            logger.exception("Job %s crashed", job_id)
+
+
+async def _rescan() -> None:
+    store = get_job_store()
+
+    while True:
+        # Jobs left behind by processes that died, and retries that are due
+        try:
+            await asyncio.to_thread(store.fail_abandoned)
+
+            for job_id in await asyncio.to_thread(store.claimable):
+                _put(job_id)
+        except Exception:
+            logger.exception("Scanning for due jobs failed")
+
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+async def start_job_workers() -> None:
+    global _queue
+
+    store = get_job_store()
+    _queue = asyncio.Queue()
+
+    pruned = await asyncio.to_thread(store.prune, JOB_RETENTION)
+
+    if pruned:
+        logger.info("Pruned %s finished jobs", pruned)
+
+    _workers.extend(asyncio.ensure_future(_worker()) for _ in range(JOB_WORKERS))
+    # A single scanner, starting with the jobs left behind by an earlier run of the service
+    _workers.append(asyncio.ensure_future(_rescan()))
+
+
+async def stop_job_workers() -> None:
+    global _queue
+
+    for worker in _workers:
+        worker.cancel()
+
+    await asyncio.gather(*_workers, return_exceptions=True)
+
+    _workers.clear()
+    _queued.clear()
+    _queue = None
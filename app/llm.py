@@ -0,0 +1,74 @@
+import logging
+import re
+import unicodedata
+
+from app.cache import SingleFlight
+from app.cache_backends import Codec, make_cache
+from app.config import (LLM_CACHE_MAX_BYTES, LLM_CACHE_MAX_SIZE, LLM_CACHE_TTL,
+                        LLM_QUERY_ENDPOINT)
+from app.logs import SAMPLED, Truncated
+from app.metrics import CACHE_REQUESTS
+from app.models import LLMQuery
+from app.utils import async_get_data_from_llm
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Sentence punctuation closing a search phrase, which never changes its meaning
+_TRAILING_PUNCTUATION = re.compile(r"[.,;:!?]+$")
+
+_llm_cache = make_cache(
+    "llm",
+    maxsize=LLM_CACHE_MAX_SIZE,
+    ttl=LLM_CACHE_TTL,
+    max_bytes=LLM_CACHE_MAX_BYTES,
+    sizeof=lambda llm_query: len(llm_query.content),
+    codec=Codec(lambda llm_query: llm_query.model_dump_json().encode(), LLMQuery.model_validate_json),
+)
+_single_flight = SingleFlight()
+
+
+def normalize_query(user_query: str) -> str:
+    """Reduce a search phrase to the form used as cache key.
+
+    Only case, spacing and closing punctuation are ignored: "2-room Flat  in
+    Zürich." becomes "2-room flat in zürich". Symbols and words are kept, as
+    "price <2000" and "price >2000" are different searches.
+    """
+    words = unicodedata.normalize("NFKC", user_query).casefold().split()
+
+    return _TRAILING_PUNCTUATION.sub("", " ".join(words)).rstrip()
+
+
+async def _translate(key: tuple, data: dict) -> tuple[int, LLMQuery | None]:
+    status_code, llm_query = await async_get_data_from_llm(LLM_QUERY_ENDPOINT, data)
+
+    if status_code == 200 and llm_query is not None:
+        await _llm_cache.set(key, llm_query)
+
+    return status_code, llm_query
+
+
+async def translate_query(
+        user_query: str, data: dict, schema_version: str | None
+    ) -> tuple[int, LLMQuery | None]:
+    """Translate a user query with the LLM, reusing earlier translations.
+
+    Translations are keyed by the normalized query and the query schema
+    version, so a schema change invalidates all of them.
+    """
+    key = (normalize_query(user_query), schema_version)
+
+    llm_query = await _llm_cache.get(key)
+
+    CACHE_REQUESTS.inc("llm", "miss" if llm_query is None else "hit")
+
+    if llm_query is not None:
+        logger.info("LLM cache hit for query = %s", Truncated(key[0]), extra=SAMPLED)
+        return 200, llm_query
+
+    return await _single_flight.do(key, lambda: _translate(key, data))
+
+
+async def clear_llm_cache() -> None:
+    await _llm_cache.clear()
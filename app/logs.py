@@ -0,0 +1,168 @@
+import atexit
+import json
+import logging
+import queue
+import random
+import reprlib
+import sys
+import uuid
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.config import (LOG_FORMAT, LOG_INFO_SAMPLE_RATE,
+                        LOG_MAX_PAYLOAD_CHARS, LOG_QUEUE_SIZE)
+from app.metrics import LOG_RECORDS_DROPPED
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Pass as `extra=` to mark a high-volume info line that may be sampled out
+SAMPLED = {"sampled": True}
+
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+_payload_repr = reprlib.Repr()
+_payload_repr.maxlevel = 3
+_payload_repr.maxdict = 20
+_payload_repr.maxlist = 20
+# Leave room for more than the first field of a nested payload
+_payload_repr.maxstring = max(40, LOG_MAX_PAYLOAD_CHARS // 4)
+_payload_repr.maxother = max(40, LOG_MAX_PAYLOAD_CHARS // 4)
+
+
+class Truncated:
+    """Log argument rendering at most LOG_MAX_PAYLOAD_CHARS of a payload.
+
+    Rendering happens only if the record is actually emitted, and never walks
+    more of the payload than it prints.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self) -> str:
+        value = self.value
+
+        if isinstance(value, bytes):
+            value = value[:LOG_MAX_PAYLOAD_CHARS + 1].decode("utf-8", "replace")
+
+        text = value if isinstance(value, str) else _payload_repr.repr(value)
+
+        if len(text) > LOG_MAX_PAYLOAD_CHARS:
+            return f"{text[:LOG_MAX_PAYLOAD_CHARS]}... (truncated)"
+
+        return text
+
+
+class RequestIdFilter(logging.Filter):
+    """Attach the id of the request being handled, before the record leaves its task"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Keep only a `rate` fraction of records logged with `extra=SAMPLED`"""
+
+    def __init__(self, rate: float = LOG_INFO_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sampled", False) or record.levelno >= logging.WARNING:
+            return True
+
+        return self.rate >= 1 or random.random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = dict(
+            time=self.formatTime(record),
+            level=record.levelname,
+            logger=record.name,
+            message=record.getMessage(),
+        )
+
+        request_id = getattr(record, "request_id", None)
+
+        if request_id is not None:
+            entry["request_id"] = request_id
+
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the writer falls behind"""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def queue_handler(format: str = LOG_FORMAT, stream=None) -> QueueHandler:
+    """Handler factory for log_config.yaml.
+
+    Callers only interpolate the message and enqueue the record, a background
+    thread serialises and writes it.
+    """
+    handler = logging.StreamHandler(stream or sys.stdout)
+
+    if format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(request_id)s - %(message)s"
+        ))
+
+    listener = QueueListener(queue.Queue(LOG_QUEUE_SIZE), handler, respect_handler_level=True)
+    listener.start()
+    # Flush what is still queued when the process exits
+    atexit.register(listener.stop)
+
+    return DroppingQueueHandler(listener.queue)
+
+
+class RequestIdMiddleware:
+    """Use the caller's X-Request-ID, or generate one, for the logs of a request"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:128]
+                break
+
+        request_id = request_id or uuid.uuid4().hex
+        token = request_id_var.set(request_id)
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (REQUEST_ID_HEADER.lower().encode(), request_id.encode("latin-1")),
+                ]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id_var.reset(token)
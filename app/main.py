@@ -1,33 +1,110 @@
-import os
+import asyncio
 import json
 import logging
+import math
+from contextlib import asynccontextmanager
+from typing import Annotated
 from functools import partial
-from pathlib import Path
-
-import uvicorn
-from app.config import (IMAGE_SERVICE_URL, INVENTORY_SERVICE_URL,
-                        LLM_QUERY_ENDPOINT, PROPERTIES_BY_USER_ENDPOINT,
-                        PROPERTY_QUERY_ENDPOINT, QUERY_SCHEMA_ENDPOINT,
-                        UPLOAD_IMAGE_ENDPOINT, USER_ID_ENDPOINT,
-                        USER_SERVICE_URL, GEOLOCATION_API_URL)
+
+import httpx
+from app.admission import AdmissionMiddleware
+from app.auth import get_user_id
+from app.cache_backends import close_cache_backends, start_cache_backends
+from app.clients import close_clients, open_clients
+from app.compression import CompressionMiddleware
+from app.config import (DEBUG, IMAGE_SERVICE_URL, INVENTORY_SERVICE_URL,
+                        PROPERTIES_BY_USER_ENDPOINT, PROPERTY_QUERY_ENDPOINT,
+                        IMAGE_UPLOAD_CONCURRENCY, RESPONSE_CACHE_TTL,
+                        UPLOAD_IMAGE_ENDPOINT, USER_SERVICE_URL)
+from app.deadlines import DeadlineMiddleware
+from app.geocoding import (AddressNotFoundError, geocode,
+                           get_cached_coordinates, is_same_address,
+                           remember_coordinates)
+from app.images import add_primary_image_urls
+from app.jobs import (enqueue_create_property, get_job, start_job_workers,
+                      stop_job_workers)
+from app.llm import translate_query
+from app.logs import SAMPLED, RequestIdMiddleware, Truncated
+from app.metrics import (INITIAL_QUERY_STAGE_DURATION, MetricsMiddleware,
+                         render_metrics)
 from app.models import InventoryRequest
-from app.utils import (_reverse_auth_proxy, _reverse_proxy, fetch_json,
-                       fetch_text, get_data_from_llm, post_data, put_data,
-                       raise_for_invalid_token)
-from fastapi import FastAPI, HTTPException, Request
+from app.popular import (get_precomputed, precompute_hit_rate, record_query,
+                         start_precompute, stop_precompute, top_queries)
+from app.proxy_cache import invalidate_responses
+from app.query_filters import normalize_query_filters
+from app.resilience import CircuitOpenError
+from app.schema import (get_query_schema, get_query_schema_version,
+                        refresh_query_schema)
+from app.serialization import RawJSONResponse, loads, splice_field
+from app.utils import (_reverse_auth_proxy, _reverse_proxy, async_fetch_bytes,
+                       async_fetch_json, async_post_data, async_put_data,
+                       async_raise_for_invalid_token, async_upload_file)
+from app.warmup import is_ready, readiness, start_warm_up, stop_warm_up
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse
 from starlette.datastructures import UploadFile
 
-LOG_CONFIG_PATH = Path(__file__).parent / "log_config.yaml"
-
+ACCEPTED = 202
+UNPROCESSABLE_ENTITY = 422
 INTERNAL_SERVER_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
+
+# Opt-in query parameter of the search endpoints adding `primaryImageUrl` to each result
+WITH_IMAGES_PARAM = "withImages"
+
+# Opt-in query parameter of /createProperty answering 202 with a job to poll
+ASYNC_PARAM = "async"
 
-GEOLOCATION_API_KEY = os.environ.get('GEOLOCATION_API_ACCESS_KEY')
+# Fields of a new property /createProperty geocodes, checked before any work is done or queued
+REQUIRED_PROPERTY_FIELDS = ("address", "location")
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-app = FastAPI(debug=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_clients()
+    await start_cache_backends()
+    await start_job_workers()
+    start_warm_up()
+    start_precompute()
+    yield
+    await stop_precompute()
+    await stop_warm_up()
+    await stop_job_workers()
+    await close_cache_backends()
+    await close_clients()
+
+
+app = FastAPI(debug=DEBUG, lifespan=lifespan)
+
+
+@app.exception_handler(CircuitOpenError)
+async def circuit_open_handler(request: Request, exc: CircuitOpenError):
+    return JSONResponse(
+        status_code=SERVICE_UNAVAILABLE,
+        content=dict(detail=f"{exc.upstream} is temporarily unavailable."),
+        headers={"Retry-After": str(math.ceil(exc.retry_after))},
+    )
+
+
+@app.exception_handler(AddressNotFoundError)
+async def address_not_found_handler(request: Request, exc: AddressNotFoundError):
+    return JSONResponse(
+        status_code=UNPROCESSABLE_ENTITY,
+        content=dict(detail="Address not found."),
+    )
+
+
+@app.exception_handler(httpx.TimeoutException)
+async def upstream_timeout_handler(request: Request, exc: httpx.TimeoutException):
+    return JSONResponse(
+        status_code=GATEWAY_TIMEOUT,
+        content=dict(detail="Upstream service timed out."),
+    )
 
 
 origins = ["*"]
@@ -39,22 +116,28 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(AdmissionMiddleware)
+# Outside admission, so time spent queued counts against the deadline
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(RequestIdMiddleware)
 
 
 # Inventory service without authorization
 app.add_route(
     "/properties",
-    partial(_reverse_proxy, INVENTORY_SERVICE_URL),
+    partial(
+        _reverse_proxy, INVENTORY_SERVICE_URL,
+        stream=True, cache_ttl=RESPONSE_CACHE_TTL, coalesce=True,
+    ),
     methods=["GET"],
 )
 app.add_route(
     "/properties/{path:path}",
-    partial(_reverse_proxy, INVENTORY_SERVICE_URL),
+    partial(_reverse_proxy, INVENTORY_SERVICE_URL, cache_ttl=RESPONSE_CACHE_TTL, coalesce=True),
     methods=["GET"],
 )
-app.add_route(
-    "/queryProperties", partial(_reverse_proxy, INVENTORY_SERVICE_URL), methods=["GET"]
-)
 app.add_route(
     "/declareInterest", partial(_reverse_proxy, INVENTORY_SERVICE_URL), methods=["POST"]
 )
@@ -70,12 +153,12 @@ app.add_route(
 # Inventory service with authorization
 app.add_route(
     "/properties",
-    partial(_reverse_auth_proxy, INVENTORY_SERVICE_URL),
+    partial(_reverse_auth_proxy, INVENTORY_SERVICE_URL, invalidates=True),
     methods=["POST"],
 )
 app.add_route(
     "/properties/{path:path}",
-    partial(_reverse_auth_proxy, INVENTORY_SERVICE_URL),
+    partial(_reverse_auth_proxy, INVENTORY_SERVICE_URL, invalidates=True),
     methods=["PUT"],
 )
 
@@ -107,22 +190,42 @@ app.add_route(
 
 # Image service without authorization
 app.add_route(
-    "/getPrimaryImageUrl", partial(_reverse_proxy, IMAGE_SERVICE_URL), methods=["GET"]
+    "/getPrimaryImageUrl",
+    partial(_reverse_proxy, IMAGE_SERVICE_URL, cache_ttl=RESPONSE_CACHE_TTL, coalesce=True),
+    methods=["GET"],
 )
 app.add_route(
-    "/getImageUrls", partial(_reverse_proxy, IMAGE_SERVICE_URL), methods=["GET"]
+    "/getImageUrls",
+    partial(_reverse_proxy, IMAGE_SERVICE_URL, cache_ttl=RESPONSE_CACHE_TTL, coalesce=True),
+    methods=["GET"],
 )
 # Image service with authorization
-app.add_route(
-    "/upload", partial(_reverse_auth_proxy, IMAGE_SERVICE_URL), methods=["POST"]
-)
+async def _proxy_image_upload(request: Request):
+    """Upload through the image service, then drop what was cached about the property"""
+    response = await _reverse_auth_proxy(IMAGE_SERVICE_URL, request, stream=True)
+
+    if response.status_code < 400:
+        property_id = request.query_params.get("propertyId")
+
+        # Without a property, any of them may have a new image
+        await invalidate_responses(
+            IMAGE_SERVICE_URL, None if property_id is None else dict(propertyId=property_id)
+        )
+
+    return response
+
+
+app.add_route("/upload", _proxy_image_upload, methods=["POST"])
 
 
 @app.get("/initial_query")
-async def list_properties(user_query: str):
-    logger.info(f"Received user query = {user_query}")
+async def list_properties(
+        user_query: str, with_images: Annotated[bool, Query(alias=WITH_IMAGES_PARAM)] = False
+    ):
+    logger.info("Received user query = %s", Truncated(user_query))
 
-    query_schema = fetch_json(QUERY_SCHEMA_ENDPOINT)
+    with INITIAL_QUERY_STAGE_DURATION.time("schema"):
+        query_schema = await get_query_schema()
 
     if query_schema is None:
         raise HTTPException(
@@ -130,23 +233,72 @@ async def list_properties(user_query: str):
             detail="Something went wrong with the inventory service. Initial request failed.",
         )
 
-    data = InventoryRequest(
-        query=user_query, api_documentation=query_schema
-    ).model_dump()
+    record_query(user_query)
+
+    # Popular queries may have been translated, and searched, ahead of time
+    precomputed = await get_precomputed(user_query, get_query_schema_version())
 
-    logger.info(f"Fetched query schema from inventory = {data}")
+    if precomputed is not None:
+        filters, inventory_res = precomputed
+    else:
+        data = InventoryRequest(
+            query=user_query, api_documentation=query_schema
+        ).model_dump()
 
-    res_status_code, llm_query = get_data_from_llm(LLM_QUERY_ENDPOINT, data)
+        logger.info("Fetched query schema from inventory = %s", Truncated(data), extra=SAMPLED)
 
-    if res_status_code != 200 or llm_query is None:
+        with INITIAL_QUERY_STAGE_DURATION.time("llm"):
+            res_status_code, llm_query = await translate_query(
+                user_query, data, get_query_schema_version()
+            )
+
+        if res_status_code != 200 or llm_query is None:
+            raise HTTPException(
+                status_code=res_status_code,
+                detail="Something went wrong with the LLM service.",
+            )
+
+        filters = normalize_query_filters(llm_query.get_parsed_params(), query_schema)
+        inventory_res = None
+
+    if inventory_res is None:
+        with INITIAL_QUERY_STAGE_DURATION.time("inventory"):
+            inventory_res = await async_fetch_bytes(PROPERTY_QUERY_ENDPOINT, params=filters)
+
+    if inventory_res is None:
         raise HTTPException(
-            status_code=res_status_code,
-            detail="Something went wrong with the LLM service.",
+            status_code=INTERNAL_SERVER_ERROR,
+            detail="Something went wrong with the inventory service. Querying properties failed.",
         )
 
-    inventory_res = fetch_json(
-        PROPERTY_QUERY_ENDPOINT, params=llm_query.get_parsed_params()
-    )
+    logger.info("Fetched data from inventory = %s", Truncated(inventory_res), extra=SAMPLED)
+
+    if with_images:
+        with INITIAL_QUERY_STAGE_DURATION.time("images"):
+            properties = await add_primary_image_urls(loads(inventory_res))
+
+        properties["filters"] = filters
+
+        return RawJSONResponse(properties)
+
+    # Add filters to the response, without decoding the inventory's payload
+    return RawJSONResponse(splice_field(inventory_res, "filters", filters))
+
+
+def _wants_images(request: Request) -> bool:
+    return request.query_params.get(WITH_IMAGES_PARAM, "").lower() in ("1", "true", "yes", "on")
+
+
+@app.get("/queryProperties")
+async def query_properties(request: Request):
+    if not _wants_images(request):
+        return await _reverse_proxy(
+            INVENTORY_SERVICE_URL, request, cache_ttl=RESPONSE_CACHE_TTL, coalesce=True
+        )
+
+    params = [(k, v) for k, v in request.query_params.multi_items() if k != WITH_IMAGES_PARAM]
+
+    inventory_res = await async_fetch_json(PROPERTY_QUERY_ENDPOINT, params=params)
 
     if inventory_res is None:
         raise HTTPException(
@@ -154,21 +306,59 @@ async def list_properties(user_query: str):
             detail="Something went wrong with the inventory service. Querying properties failed.",
         )
 
-    logger.info(f"Fetched data from inventory = {inventory_res}")
+    return RawJSONResponse(await add_primary_image_urls(inventory_res))
+
+
+@app.get("/ready", include_in_schema=False)
+async def get_ready():
+    return JSONResponse(
+        status_code=200 if is_ready() else SERVICE_UNAVAILABLE,
+        content=readiness(),
+    )
+
+
+@app.get("/popularQueries", include_in_schema=False)
+async def get_popular_queries(request: Request):
+    # The queries are what users searched for
+    await async_raise_for_invalid_token(request.headers.get("Authorization"))
+
+    return dict(
+        top=[
+            dict(query=counted.item, count=counted.count, error=counted.error)
+            for counted in top_queries()
+        ],
+        precompute=precompute_hit_rate(),
+    )
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
 
-    # Add filters to the response
-    inventory_res['filters'] = llm_query.get_parsed_params()
 
-    return inventory_res
+@app.post("/refreshQuerySchema")
+async def post_refresh_query_schema(request: Request):
+    # Every call bypasses the cache and hits the inventory service
+    await async_raise_for_invalid_token(request.headers.get("Authorization"))
+
+    query_schema = await refresh_query_schema()
+
+    if query_schema is None:
+        raise HTTPException(
+            status_code=INTERNAL_SERVER_ERROR,
+            detail="Something went wrong with the inventory service. Fetching query schema failed.",
+        )
+
+    return query_schema
 
 
 @app.get("/fetchPropertiesByUser")
-def get_user_properties(request: Request):
+async def get_user_properties(request: Request):
     auth_token = request.headers.get("Authorization")
 
-    raise_for_invalid_token(auth_token)
+    await async_raise_for_invalid_token(auth_token)
 
-    user_id = fetch_text(USER_ID_ENDPOINT, dict(accessToken=auth_token))
+    user_id = await get_user_id(auth_token)
 
     if user_id is None:
         raise HTTPException(
@@ -176,7 +366,7 @@ def get_user_properties(request: Request):
             detail="Couldn't fetch userId.",
         )
 
-    user_properties = fetch_json(PROPERTIES_BY_USER_ENDPOINT, dict(userId=user_id))
+    user_properties = await async_fetch_bytes(PROPERTIES_BY_USER_ENDPOINT, dict(userId=user_id))
 
     if user_properties is None:
         raise HTTPException(
@@ -184,18 +374,43 @@ def get_user_properties(request: Request):
             detail="Something went wrong with the inventory service. Fetching user properties failed.",
         )
 
-    logger.info(f"Fetched data from inventory = {user_properties}")
+    logger.info("Fetched data from inventory = %s", Truncated(user_properties), extra=SAMPLED)
+
+    return RawJSONResponse(user_properties)
 
-    return user_properties
+
+async def _upload_image(
+        semaphore: asyncio.Semaphore, property_id: int, index: int, img: UploadFile
+    ) -> dict:
+    assert isinstance(img, UploadFile)
+
+    result = dict(index=index, filename=img.filename, uploaded=False)
+
+    async with semaphore:
+        try:
+            res = await async_upload_file(
+                UPLOAD_IMAGE_ENDPOINT,
+                img,
+                params=dict(propertyId=property_id, primary=index == 0),
+            )
+        except httpx.HTTPError as exc:
+            logger.warning("Uploading image %s of property %s failed: %r", index, property_id, exc)
+            return result
+
+    result["uploaded"] = res is not None
+
+    return result
 
 
 @app.post("/createProperty")
-async def post_create_property(request: Request):
+async def post_create_property(
+        request: Request, run_async: Annotated[bool, Query(alias=ASYNC_PARAM)] = False
+    ):
     auth_token = request.headers.get("Authorization")
 
-    raise_for_invalid_token(auth_token)
+    await async_raise_for_invalid_token(auth_token)
 
-    user_id = fetch_text(USER_ID_ENDPOINT, dict(accessToken=auth_token))
+    user_id = await get_user_id(auth_token)
 
     if user_id is None:
         raise HTTPException(
@@ -209,26 +424,38 @@ async def post_create_property(request: Request):
     inventory_data["owner"] = user_id
     del inventory_data["images"]
 
+    missing = [field for field in REQUIRED_PROPERTY_FIELDS if field not in inventory_data]
+
+    if missing:
+        raise HTTPException(
+            status_code=UNPROCESSABLE_ENTITY,
+            detail=f"Missing property fields: {', '.join(missing)}.",
+        )
+
     images = form.getlist("images")
 
-    geolocation_query = f"{inventory_data['address']} {inventory_data['location']}"
+    if run_async:
+        job_id = await enqueue_create_property(user_id, inventory_data, images)
 
-    geolocation_res = fetch_json(GEOLOCATION_API_URL, params=dict(key=GEOLOCATION_API_KEY, q=geolocation_query, format="json"))
+        return JSONResponse(
+            status_code=ACCEPTED,
+            content=dict(jobId=job_id, status="queued"),
+            headers={"Location": f"/jobs/{job_id}"},
+        )
+
+    coordinates = await geocode(inventory_data["address"], inventory_data["location"])
 
-    if geolocation_res is None:
+    if coordinates is None:
         raise HTTPException(
             status_code=404,
             detail="Couldn't fetch coordinates of a location.",
         )
-    
-    coords = geolocation_res[0]
-    
-    inventory_data["longitude"] = float(coords["lon"])
-    inventory_data["latitude"] = float(coords["lat"])
 
-    inv_resp = post_data(f"http://{INVENTORY_SERVICE_URL}/properties/", inventory_data)
+    inventory_data["longitude"], inventory_data["latitude"] = coordinates
 
-    logger.info(inv_resp)
+    inv_resp = await async_post_data(f"http://{INVENTORY_SERVICE_URL}/properties/", inventory_data)
+
+    logger.info("Inventory response = %s", Truncated(inv_resp), extra=SAMPLED)
 
     if inv_resp is None:
         raise HTTPException(
@@ -238,31 +465,90 @@ async def post_create_property(request: Request):
 
     assert isinstance(inv_resp, dict), f'Actual type = {type(inv_resp)}'
 
-    for id_, img in enumerate(images):
-        assert isinstance(img, UploadFile)
-        res = post_data(
-            UPLOAD_IMAGE_ENDPOINT,
-            params=dict(propertyId=inv_resp["propertyId"], primary=id_ == 0),
-            files={"file": img.file},
-            return_json=False,
-        )
+    await invalidate_responses(INVENTORY_SERVICE_URL)
 
-        if res is None:
-            raise HTTPException(
-                status_code=INTERNAL_SERVER_ERROR,
-                detail=f"Error when uploading image for a property with id = {inv_resp['propertyId']}.",
-            )
+    # The first image is the primary one, the rest are uploaded alongside it
+    semaphore = asyncio.Semaphore(IMAGE_UPLOAD_CONCURRENCY)
+    results = await asyncio.gather(*(
+        _upload_image(semaphore, inv_resp["propertyId"], id_, img)
+        for id_, img in enumerate(images)
+    ))
+
+    await invalidate_responses(IMAGE_SERVICE_URL, dict(propertyId=str(inv_resp["propertyId"])))
+
+    if not all(result["uploaded"] for result in results):
+        raise HTTPException(
+            status_code=INTERNAL_SERVER_ERROR,
+            detail=dict(
+                message=f"Error when uploading image for a property with id = {inv_resp['propertyId']}.",
+                propertyId=inv_resp["propertyId"],
+                images=results,
+            ),
+        )
 
     return inv_resp
 
 
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, request: Request):
+    auth_token = request.headers.get("Authorization")
+
+    await async_raise_for_invalid_token(auth_token)
+
+    user_id = await get_user_id(auth_token)
+    job = await get_job(job_id)
+
+    # Someone else's job is reported exactly like a missing one
+    if job is None or user_id is None or str(job["owner"]) != str(user_id):
+        raise HTTPException(
+            status_code=404,
+            detail="Job not found.",
+        )
+
+    return dict(
+        jobId=job["id"],
+        status=job["status"],
+        attempts=job["attempts"],
+        result=job["result"],
+        error=job["error"],
+        createdAt=job["created_at"],
+        updatedAt=job["updated_at"],
+    )
+
+
+async def _get_current_coordinates(
+        property_id: int, inventory_data: dict
+    ) -> tuple[float, float] | None:
+    """Coordinates already known for the property's address, if any"""
+    coordinates = await get_cached_coordinates(inventory_data["address"], inventory_data["location"])
+
+    if coordinates is not None:
+        return coordinates
+
+    current = await async_fetch_json(f"http://{INVENTORY_SERVICE_URL}/properties/{property_id}")
+
+    if (
+        not isinstance(current, dict)
+        or current.get("longitude") is None
+        or current.get("latitude") is None
+        or not is_same_address(current, inventory_data)
+    ):
+        return None
+
+    coordinates = float(current["longitude"]), float(current["latitude"])
+
+    await remember_coordinates(inventory_data["address"], inventory_data["location"], coordinates)
+
+    return coordinates
+
+
 @app.put("/updateProperty/{property_id}")
 async def put_update_property(request: Request, property_id: int):
     auth_token = request.headers.get("Authorization")
 
-    raise_for_invalid_token(auth_token)
+    await async_raise_for_invalid_token(auth_token)
 
-    user_id = fetch_text(USER_ID_ENDPOINT, dict(accessToken=auth_token))
+    user_id = await get_user_id(auth_token)
 
     if user_id is None:
         raise HTTPException(
@@ -278,37 +564,36 @@ async def put_update_property(request: Request, property_id: int):
 
     del inventory_data["images"]
 
-    geolocation_query = f"{inventory_data['address']} {inventory_data['location']}"
+    # Skip geocoding when the address of the property did not change
+    coordinates = await _get_current_coordinates(property_id, inventory_data)
 
-    geolocation_res = fetch_json(GEOLOCATION_API_URL, params=dict(key=GEOLOCATION_API_KEY, q=geolocation_query, format="json"))
+    if coordinates is None:
+        coordinates = await geocode(inventory_data["address"], inventory_data["location"])
 
-    if geolocation_res is None:
+    if coordinates is None:
         raise HTTPException(
             status_code=404,
             detail="Couldn't fetch coordinates of a location.",
         )
-    
-    coords = geolocation_res[0]
-    
-    inventory_data["longitude"] = float(coords["lon"])
-    inventory_data["latitude"] = float(coords["lat"])
 
-    inv_resp = put_data(f"http://{INVENTORY_SERVICE_URL}/properties/{property_id}", inventory_data)
+    inventory_data["longitude"], inventory_data["latitude"] = coordinates
 
-    logger.info(inv_resp)
+    inv_resp = await async_put_data(f"http://{INVENTORY_SERVICE_URL}/properties/{property_id}", inventory_data)
+
+    logger.info("Inventory response = %s", Truncated(inv_resp), extra=SAMPLED)
 
     if inv_resp is None:
         raise HTTPException(
             status_code=INTERNAL_SERVER_ERROR,
             detail="Error when creating new property.",
         )
+
+    await invalidate_responses(INVENTORY_SERVICE_URL)
+
     return inv_resp
 
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "main:app",
-        host="0.0.0.0",
-        port=8000,
-        log_config=str(LOG_CONFIG_PATH),
-    )
+    from app.server import run
+
+    run()
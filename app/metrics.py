@@ -0,0 +1,287 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+# Seconds, tuned for a gateway whose upstream calls take between 1ms and 30s
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+_registry: list["Metric"] = []
+_collectors: list[Callable[[], None]] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple, labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+
+    if extra:
+        pairs.append(extra)
+
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        _registry.append(self)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: defaultdict[tuple, float] = defaultdict(float)
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] += amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, *labels, amount: float = 1.0) -> None:
+        self._values[labels] -= amount
+
+    def set(self, *labels, value: float) -> None:
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: tuple = (),
+            buckets: tuple = DEFAULT_BUCKETS,
+        ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # Per label set: one count per bucket plus +Inf, then the sum
+        self._values: dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels) -> None:
+        counts = self._values.get(labels)
+
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels) -> Iterator[None]:
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels) -> int:
+        counts = self._values.get(labels)
+
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self) -> Iterator[str]:
+        for labels, counts in list(self._values.items()):
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ("+Inf",), counts[:-1]):
+                cumulative += count
+                bucket = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                yield f"{self.name}_bucket{bucket} {cumulative}"
+
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {counts[-1]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+def register_collector(collector: Callable[[], None]) -> None:
+    """Register a callback that refreshes gauges right before they are scraped"""
+    _collectors.append(collector)
+
+
+def render_metrics() -> str:
+    for collector in _collectors:
+        collector()
+
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+HTTP_REQUESTS = Counter(
+    "service_manager_http_requests_total",
+    "Requests handled by the gateway.",
+    ("method", "route", "status"),
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "service_manager_http_request_duration_seconds",
+    "Time to handle a gateway request, including streaming the response.",
+    ("method", "route"),
+)
+HTTP_IN_FLIGHT = Gauge(
+    "service_manager_http_requests_in_flight",
+    "Gateway requests currently being handled.",
+)
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "service_manager_upstream_request_duration_seconds",
+    "Time until an upstream returned its response headers.",
+    ("upstream", "method"),
+)
+UPSTREAM_ERRORS = Counter(
+    "service_manager_upstream_errors_total",
+    "Failed upstream calls, by kind of failure.",
+    ("upstream", "kind"),
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "service_manager_upstream_requests_in_flight",
+    "Upstream calls currently waiting for a response.",
+    ("upstream",),
+)
+UPSTREAM_HEDGED = Counter(
+    "service_manager_upstream_hedged_requests_total",
+    "Second attempts sent for slow idempotent upstream calls.",
+    ("upstream",),
+)
+UPSTREAM_POOL_CONNECTIONS = Gauge(
+    "service_manager_upstream_pool_connections",
+    "Connections held by an upstream connection pool.",
+    ("upstream", "state"),
+)
+CIRCUIT_BREAKER_OPEN = Gauge(
+    "service_manager_circuit_breaker_open",
+    "1 while the circuit breaker of an upstream is open or half-open.",
+    ("upstream",),
+)
+CACHE_REQUESTS = Counter(
+    "service_manager_cache_requests_total",
+    "Cache lookups, by cache and result.",
+    ("cache", "result"),
+)
+INITIAL_QUERY_STAGE_DURATION = Histogram(
+    "service_manager_initial_query_stage_duration_seconds",
+    "Time /initial_query spends in each stage.",
+    ("stage",),
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "service_manager_admission_in_flight",
+    "Requests holding a slot of an admission lane.",
+    ("lane",),
+)
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "service_manager_admission_queue_depth",
+    "Requests waiting for a slot of an admission lane.",
+    ("lane",),
+)
+ADMISSION_SHED = Counter(
+    "service_manager_admission_shed_total",
+    "Requests turned away by admission control, by reason.",
+    ("lane", "reason"),
+)
+CACHE_BACKEND_ERRORS = Counter(
+    "service_manager_cache_backend_errors_total",
+    "Shared cache operations that failed and were treated as misses.",
+    ("cache", "operation"),
+)
+REQUESTS_CANCELLED = Counter(
+    "service_manager_requests_cancelled_total",
+    "Requests whose work was cancelled, by reason (deadline or disconnect).",
+    ("reason",),
+)
+JOBS = Counter(
+    "service_manager_jobs_total",
+    "Background jobs by kind and what happened to them.",
+    ("kind", "event"),
+)
+LLM_REJECTED_FIELDS = Counter(
+    "service_manager_llm_rejected_fields_total",
+    "LLM generated query filters dropped before querying the inventory.",
+    ("reason",),
+)
+LOG_RECORDS_DROPPED = Counter(
+    "service_manager_log_records_dropped_total",
+    "Log records dropped because the background log writer fell behind.",
+)
+
+
+def _route_template(scope: Scope, templates: dict) -> str:
+    route = scope.get("route")
+
+    if route is not None:
+        return route.path
+
+    endpoint = scope.get("endpoint")
+
+    if endpoint is None:
+        return "unmatched"
+
+    if not templates:
+        templates.update(
+            (getattr(route, "endpoint", None), route.path) for route in scope["app"].routes
+        )
+
+    return templates.get(endpoint, "unmatched")
+
+
+class MetricsMiddleware:
+    """Count and time every request, labelled by route template rather than raw path"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._templates: dict = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_IN_FLIGHT.dec()
+
+            route = _route_template(scope, self._templates)
+            HTTP_REQUESTS.inc(scope["method"], route, status)
+            HTTP_REQUEST_DURATION.observe(time.perf_counter() - start, scope["method"], route)
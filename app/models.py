@@ -1,6 +1,9 @@
-import json
+from functools import cached_property
+
 from pydantic import BaseModel
 
+from app.serialization import loads
+
 
 class InventoryRequest(BaseModel):
     query: str
@@ -10,8 +13,13 @@ class InventoryRequest(BaseModel):
 class LLMQuery(BaseModel):
     content: str
 
-    def get_parsed_params(self) -> dict:
+    @cached_property
+    def _parsed_params(self) -> dict:
         if self.content == '':
             return {}
-        
-        return {k: v for k, v in json.loads(self.content).items() if v is not None}
+
+        return {k: v for k, v in loads(self.content).items() if v is not None}
+
+    def get_parsed_params(self) -> dict:
+        # Parsed once per instance, which the LLM cache shares between requests
+        return dict(self._parsed_params)
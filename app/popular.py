@@ -0,0 +1,250 @@
+import asyncio
+import logging
+from typing import NamedTuple
+
+import httpx
+
+from app.cache_backends import make_cache
+from app.config import (INVENTORY_SERVICE_URL, POPULAR_QUERY_CAPACITY,
+                        POPULAR_QUERY_DECAY, POPULAR_QUERY_MIN_COUNT,
+                        POPULAR_QUERY_PRECOMPUTE_RESULTS,
+                        POPULAR_QUERY_REFRESH_INTERVAL,
+                        POPULAR_QUERY_RESULT_TTL, POPULAR_QUERY_TOP_K,
+                        PROPERTY_QUERY_ENDPOINT)
+from app.llm import normalize_query, translate_query
+from app.metrics import CACHE_REQUESTS
+from app.models import InventoryRequest
+from app.proxy_cache import add_invalidation_listener, response_cache_enabled
+from app.query_filters import normalize_query_filters
+from app.schema import get_query_schema, get_query_schema_version
+from app.utils import async_fetch_bytes
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class Counted(NamedTuple):
+    item: str
+    count: float
+    # The count may overstate how often the item was seen by at most this much
+    error: float
+
+
+class SpaceSaving:
+    """Approximate most frequent items in `capacity` counters (Metwally et al.).
+
+    Every item seen more than total / capacity times is guaranteed to be
+    tracked. A new item replaces the least counted one and inherits its count
+    as possible overestimate.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._counts: dict[str, float] = {}
+        self._errors: dict[str, float] = {}
+
+    def add(self, item: str) -> str | None:
+        """Count `item`, returning the item it evicted, if any"""
+        if item in self._counts:
+            self._counts[item] += 1
+            return None
+
+        evicted = None
+        error = 0.0
+
+        if len(self._counts) >= self.capacity:
+            evicted = min(self._counts, key=self._counts.__getitem__)
+            error = self._counts.pop(evicted)
+            del self._errors[evicted]
+
+        self._counts[item] = error + 1
+        self._errors[item] = error
+
+        return evicted
+
+    def top(self, k: int) -> list[Counted]:
+        items = sorted(self._counts, key=self._counts.__getitem__, reverse=True)[:k]
+
+        return [Counted(item, self._counts[item], self._errors[item]) for item in items]
+
+    def decay(self, factor: float) -> None:
+        """Scale every count by `factor`, forgetting items that drop below one"""
+        for item in list(self._counts):
+            self._counts[item] *= factor
+            self._errors[item] *= factor
+
+            if self._counts[item] < 1:
+                del self._counts[item], self._errors[item]
+
+    def __contains__(self, item: str) -> bool:
+        return item in self._counts
+
+    def __len__(self) -> int:
+        return len(self._counts)
+
+
+_tracker = SpaceSaving(POPULAR_QUERY_CAPACITY)
+# A recent phrasing of each tracked query, sent to the LLM when precomputing
+_phrasings: dict[str, str] = {}
+
+# Per process, like the tracker deciding what goes in them
+_precomputed_filters = make_cache(
+    "precomputed_filters", maxsize=POPULAR_QUERY_CAPACITY,
+    ttl=POPULAR_QUERY_REFRESH_INTERVAL * 3, shared=False,
+)
+_precomputed_results = make_cache(
+    "precomputed_results", maxsize=POPULAR_QUERY_CAPACITY,
+    ttl=POPULAR_QUERY_RESULT_TTL, shared=False,
+)
+_task: asyncio.Task | None = None
+
+
+def record_query(user_query: str) -> None:
+    key = normalize_query(user_query)
+    evicted = _tracker.add(key)
+
+    _phrasings[key] = user_query
+
+    if evicted is not None:
+        _phrasings.pop(evicted, None)
+
+
+def top_queries(k: int = POPULAR_QUERY_TOP_K, min_count: float | None = None) -> list[Counted]:
+    """The top `k` queries surely seen at least `min_count` times, POPULAR_QUERY_MIN_COUNT by default.
+
+    Rarer ones may be a single user's search, and are neither listed nor precomputed.
+    """
+    min_count = POPULAR_QUERY_MIN_COUNT if min_count is None else min_count
+
+    return [counted for counted in _tracker.top(k) if counted.count - counted.error >= min_count]
+
+
+async def get_precomputed(
+        user_query: str, schema_version: str | None
+    ) -> tuple[dict, bytes | None] | None:
+    """Filters, and inventory results if still fresh, precomputed for the query"""
+    key = (normalize_query(user_query), schema_version)
+
+    filters = await _precomputed_filters.get(key)
+
+    if filters is None:
+        CACHE_REQUESTS.inc("precomputed_query", "miss")
+        return None
+
+    results = await _precomputed_results.get(key)
+
+    CACHE_REQUESTS.inc("precomputed_query", "filters_only" if results is None else "hit")
+
+    return filters, results
+
+
+def precompute_hit_rate() -> dict:
+    counts = {
+        result: CACHE_REQUESTS.value("precomputed_query", result)
+        for result in ("hit", "filters_only", "miss")
+    }
+    total = sum(counts.values())
+
+    return dict(
+        **counts,
+        hitRate=(counts["hit"] + counts["filters_only"]) / total if total else None,
+    )
+
+
+async def precompute(user_query: str, query_schema: dict, schema_version: str | None) -> bool:
+    """Translate a query, and fetch its results, ahead of the next request for it"""
+    data = InventoryRequest(query=user_query, api_documentation=query_schema).model_dump()
+
+    status_code, llm_query = await translate_query(user_query, data, schema_version)
+
+    if status_code != 200 or llm_query is None:
+        return False
+
+    key = (normalize_query(user_query), schema_version)
+    filters = normalize_query_filters(llm_query.get_parsed_params(), query_schema)
+
+    await _precomputed_filters.set(key, filters)
+
+    # Results are dropped on inventory writes like cached responses, so only kept when those are
+    if POPULAR_QUERY_PRECOMPUTE_RESULTS and response_cache_enabled():
+        results = await async_fetch_bytes(PROPERTY_QUERY_ENDPOINT, params=filters)
+
+        if results is not None:
+            await _precomputed_results.set(key, results)
+
+    return True
+
+
+async def refresh_popular_queries() -> int:
+    """Precompute the current top queries one at a time, returning how many succeeded"""
+    query_schema = await get_query_schema()
+
+    if query_schema is None:
+        return 0
+
+    schema_version = get_query_schema_version()
+    precomputed = 0
+
+    for counted in top_queries():
+        user_query = _phrasings.get(counted.item, counted.item)
+
+        try:
+            precomputed += await precompute(user_query, query_schema, schema_version)
+        except httpx.HTTPError as exc:
+            logger.warning("Precomputing popular query %r failed: %r", counted.item, exc)
+
+    _tracker.decay(POPULAR_QUERY_DECAY)
+
+    for key in [key for key in _phrasings if key not in _tracker]:
+        del _phrasings[key]
+
+    return precomputed
+
+
+async def _forget_results(call_url: str | None, params: dict | None) -> None:
+    # Any inventory write may change the results of any query
+    if call_url in (None, INVENTORY_SERVICE_URL):
+        await _precomputed_results.clear()
+
+
+add_invalidation_listener(_forget_results)
+
+
+async def _refresh_periodically() -> None:
+    while True:
+        await asyncio.sleep(POPULAR_QUERY_REFRESH_INTERVAL)
+
+        try:
+            precomputed = await refresh_popular_queries()
+        except Exception:
+            logger.exception("Precomputing popular queries failed")
+            continue
+
+        if precomputed:
+            logger.info("Precomputed %s popular queries", precomputed)
+
+
+def start_precompute() -> None:
+    global _task
+
+    if _task is None or _task.done():
+        _task = asyncio.ensure_future(_refresh_periodically())
+
+
+async def stop_precompute() -> None:
+    global _task
+
+    if _task is not None:
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
+        _task = None
+
+
+async def clear_popular_queries() -> None:
+    global _tracker
+
+    _tracker = SpaceSaving(POPULAR_QUERY_CAPACITY)
+    _phrasings.clear()
+
+    await _precomputed_filters.clear()
+    await _precomputed_results.clear()
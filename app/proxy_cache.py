@@ -0,0 +1,167 @@
+import logging
+from typing import Awaitable, Callable, NamedTuple
+from urllib.parse import parse_qsl
+
+from fastapi import Request
+
+from app.cache_backends import (InvalidationBus, LocalCache,
+                                get_invalidation_bus, make_cache)
+from app.config import (COALESCE_VARY_HEADERS, DEBUG, RESPONSE_CACHE_MAX_BYTES,
+                        RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_MAX_TTL,
+                        SERVER_WORKERS)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+UNCACHEABLE_DIRECTIVES = frozenset({"no-store", "no-cache", "private"})
+
+
+class CachedResponse(NamedTuple):
+    status_code: int
+    headers: dict
+    body: bytes
+
+
+InvalidationListener = Callable[[str | None, dict | None], Awaitable[None]]
+
+
+class ResponseCache:
+    """Proxied responses cached in this process, invalidated in every process through `bus`.
+
+    The cache is local, as invalidation matches keys by their query
+    parameters, which needs the keys at hand.
+    """
+
+    namespace = "response"
+
+    def __init__(self, cache: LocalCache, bus: InvalidationBus | None = None):
+        self.cache = cache
+        self.bus = bus
+        self.listeners: list[InvalidationListener] = []
+
+        if bus is not None:
+            bus.subscribe(self.namespace, self._invalidated_elsewhere)
+
+    async def _invalidate_here(self, call_url: str | None, params: dict | None) -> None:
+        expected = set((params or {}).items())
+
+        for key in self.cache.keys():
+            if call_url in (None, key[0]) and expected <= set(key[3]):
+                await self.cache.delete(key)
+
+        for listener in self.listeners:
+            await listener(call_url, params)
+
+    async def _invalidated_elsewhere(self, key: list | None) -> None:
+        # None when invalidations were missed, which may have been of any upstream
+        call_url, params = (None, None) if key is None else key
+
+        await self._invalidate_here(call_url, params)
+
+    async def invalidate(self, call_url: str, params: dict | None = None) -> None:
+        await self._invalidate_here(call_url, params)
+
+        if self.bus is not None:
+            await self.bus.publish(self.namespace, [call_url, params])
+
+
+_bus = get_invalidation_bus()
+_responses = ResponseCache(
+    make_cache(
+        "response",
+        maxsize=RESPONSE_CACHE_MAX_SIZE,
+        ttl=RESPONSE_CACHE_MAX_TTL,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        sizeof=lambda response: len(response.body),
+        shared=False,
+    ),
+    _bus,
+)
+
+
+def response_cache_enabled() -> bool:
+    """Whether a write invalidates the cached responses of every worker.
+
+    Without a bus, it would only reach the worker that handled it, and the
+    others would keep serving stale responses.
+    """
+    return _bus is not None or DEBUG or SERVER_WORKERS <= 1
+
+
+if not response_cache_enabled():
+    logger.warning(
+        "Response caching is off: %s workers and no shared CACHE_BACKEND to invalidate them with",
+        SERVER_WORKERS,
+    )
+
+
+def response_cache_key(call_url: str, request: Request) -> tuple:
+    """Key on upstream, method, path and the query with its parameters sorted"""
+    query = tuple(sorted(parse_qsl(request.url.query, keep_blank_values=True)))
+
+    return call_url, request.method, request.url.path, query
+
+
+def coalesce_key(call_url: str, request: Request) -> tuple:
+    """Like the cache key, but also covering the request headers responses vary on"""
+    headers = tuple(request.headers.get(name) for name in COALESCE_VARY_HEADERS)
+
+    return response_cache_key(call_url, request) + (headers,)
+
+
+def _parse_cache_control(value: str) -> dict:
+    directives = {}
+
+    for directive in value.split(","):
+        name, _, argument = directive.strip().partition("=")
+        directives[name.lower()] = argument.strip('"')
+
+    return directives
+
+
+def response_ttl(headers: dict, default_ttl: float) -> float:
+    """How long a response may be cached according to its Cache-Control header"""
+    if "set-cookie" in headers or headers.get("vary") == "*":
+        return 0
+
+    directives = _parse_cache_control(headers.get("cache-control", ""))
+
+    if UNCACHEABLE_DIRECTIVES & directives.keys():
+        return 0
+
+    for name in ("s-maxage", "max-age"):
+        if directives.get(name, "").isdigit():
+            return float(directives[name])
+
+    return default_ttl
+
+
+async def get_cached_response(key: tuple) -> CachedResponse | None:
+    return await _responses.cache.get(key)
+
+
+async def store_response(key: tuple, response: CachedResponse, default_ttl: float) -> None:
+    if response.status_code != 200 or not response_cache_enabled():
+        return
+
+    ttl = response_ttl(response.headers, default_ttl)
+
+    if ttl > 0:
+        await _responses.cache.set(key, response, ttl=ttl)
+
+
+async def invalidate_responses(call_url: str, params: dict | None = None) -> None:
+    """Drop cached responses of an upstream in every worker, optionally only those with matching query params"""
+    await _responses.invalidate(call_url, params)
+
+
+def add_invalidation_listener(listener: InvalidationListener) -> None:
+    """Have `listener(call_url, params)` awaited whenever responses of an upstream are invalidated.
+
+    `call_url` is None when responses of any upstream may have changed.
+    """
+    _responses.listeners.append(listener)
+
+
+async def clear_response_cache() -> None:
+    await _responses.cache.clear()
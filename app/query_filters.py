@@ -0,0 +1,292 @@
+import logging
+import math
+from typing import Any, Callable
+
+from app.metrics import LLM_REJECTED_FIELDS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Path whose query parameters describe the filters, when the schema is an OpenAPI document
+QUERY_OPERATION_PATH = "/queryProperties"
+
+_TRUE = frozenset({"true", "1", "yes", "y", "on"})
+_FALSE = frozenset({"false", "0", "no", "n", "off"})
+
+
+class Rejected(Exception):
+    """Raised by a field normalizer for a value it can't make valid"""
+
+
+def _resolve(schema, root: dict, seen: frozenset = frozenset()) -> tuple[dict, frozenset]:
+    """Follow local $refs and unwrap Optional[...] style anyOf/oneOf.
+
+    Also returns the $refs followed so far. A node that isn't an object, and a
+    $ref that is missing or already followed on the way here, resolve to the
+    empty schema, which lets any value through.
+    """
+    for _ in range(10):
+        if not isinstance(schema, dict):
+            return {}, seen
+
+        if "$ref" in schema:
+            ref = schema["$ref"]
+
+            if not isinstance(ref, str) or ref in seen:
+                return {}, seen
+
+            seen |= {ref}
+            target = root
+
+            for part in ref.lstrip("#/").split("/"):
+                target = target.get(part) if isinstance(target, dict) else None
+
+            schema = target
+            continue
+
+        variants = schema.get("anyOf") or schema.get("oneOf")
+
+        if isinstance(variants, list):
+            non_null = [
+                variant for variant in variants
+                if not (isinstance(variant, dict) and variant.get("type") == "null")
+            ]
+
+            if len(non_null) == 1:
+                schema = non_null[0]
+                continue
+
+        break
+
+    return (schema if isinstance(schema, dict) else {}), seen
+
+
+def _query_fields(schema: dict) -> dict | None:
+    """Field name -> field schema, from a JSON Schema object or an OpenAPI document"""
+    if isinstance(schema.get("properties"), dict):
+        return schema["properties"]
+
+    paths = schema.get("paths")
+
+    for path, operations in (paths.items() if isinstance(paths, dict) else ()):
+        if str(path).rstrip("/").endswith(QUERY_OPERATION_PATH) and isinstance(operations, dict):
+            operation = operations.get("get")
+            parameters = operation.get("parameters") if isinstance(operation, dict) else None
+
+            return {
+                parameter["name"]: parameter.get("schema", {})
+                for parameter in (parameters if isinstance(parameters, list) else ())
+                if isinstance(parameter, dict) and parameter.get("in") == "query" and "name" in parameter
+            }
+
+    return None
+
+
+def _to_integer(value) -> int:
+    if isinstance(value, bool):
+        raise Rejected
+
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise Rejected
+
+    if not math.isfinite(number):
+        raise Rejected
+
+    return round(number)
+
+
+def _to_number(value) -> float | int:
+    if isinstance(value, bool):
+        raise Rejected
+
+    if isinstance(value, (int, float)):
+        number = value
+    else:
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            raise Rejected
+
+    if not math.isfinite(number):
+        raise Rejected
+
+    return number
+
+
+def _to_boolean(value) -> bool:
+    if isinstance(value, bool):
+        return value
+
+    text = str(value).strip().lower()
+
+    if text in _TRUE:
+        return True
+
+    if text in _FALSE:
+        return False
+
+    raise Rejected
+
+
+def _to_string(value) -> str:
+    if isinstance(value, (dict, list)):
+        raise Rejected
+
+    return str(value).strip()
+
+
+_CONVERTERS = {
+    "integer": _to_integer,
+    "number": _to_number,
+    "boolean": _to_boolean,
+    "string": _to_string,
+}
+
+
+def _clamp(schema: dict, integer: bool) -> Callable[[Any], Any] | None:
+    step = 1 if integer else 0
+    low = schema.get("minimum")
+    high = schema.get("maximum")
+
+    if schema.get("exclusiveMinimum") is not None and not isinstance(schema["exclusiveMinimum"], bool):
+        low = schema["exclusiveMinimum"] + step
+    if schema.get("exclusiveMaximum") is not None and not isinstance(schema["exclusiveMaximum"], bool):
+        high = schema["exclusiveMaximum"] - step
+
+    if low is None and high is None:
+        return None
+
+    def clamp(value):
+        if low is not None and value < low:
+            return low
+        if high is not None and value > high:
+            return high
+        return value
+
+    return clamp
+
+
+def _compile_field(schema, root: dict, seen: frozenset = frozenset()) -> Callable[[Any], Any]:
+    schema, seen = _resolve(schema, root, seen)
+    kind = schema.get("type")
+
+    # ["integer", "null"] is the same as an Optional integer
+    if isinstance(kind, list):
+        types = [name for name in kind if name != "null"]
+        kind = types[0] if len(types) == 1 else None
+
+    if kind == "array":
+        # The $refs seen so far stop an array of itself from recursing forever
+        item = _compile_field(schema.get("items", {}), root, seen)
+
+        def normalize_array(value):
+            values = []
+
+            for element in value if isinstance(value, list) else [value]:
+                try:
+                    values.append(item(element))
+                except Rejected:
+                    pass
+
+            if not values:
+                raise Rejected
+
+            return values
+
+        return normalize_array
+
+    convert = _CONVERTERS.get(kind if isinstance(kind, str) else None, lambda value: value)
+    steps = [convert]
+
+    if kind in ("integer", "number"):
+        clamp = _clamp(schema, integer=kind == "integer")
+
+        if clamp is not None:
+            steps.append(clamp)
+
+    if kind == "string" and schema.get("maxLength") is not None:
+        max_length = schema["maxLength"]
+        steps.append(lambda value: value[:max_length])
+
+    if isinstance(schema.get("enum"), list) and schema["enum"]:
+        # Match case-insensitively, answering with the schema's own spelling
+        choices = {
+            (choice.casefold() if isinstance(choice, str) else choice): choice
+            for choice in schema["enum"]
+        }
+
+        def pick(value):
+            key = value.casefold() if isinstance(value, str) else value
+
+            try:
+                return choices[key]
+            except (KeyError, TypeError):
+                raise Rejected
+
+        steps.append(pick)
+
+    def normalize(value):
+        for step in steps:
+            value = step(value)
+
+        return value
+
+    return normalize
+
+
+class QueryFilterNormalizer:
+    """Coerce, clamp and filter LLM generated query filters against the query schema.
+
+    Unknown keys and values that can't be made valid are dropped and counted in
+    LLM_REJECTED_FIELDS. A schema without recognisable fields lets everything
+    through, rather than dropping every filter.
+    """
+
+    def __init__(self, schema: dict | None):
+        fields = _query_fields(schema) if isinstance(schema, dict) else None
+
+        self.fields = None if not fields else {
+            name: _compile_field(field, schema) for name, field in fields.items()
+        }
+
+    def normalize(self, params: dict) -> dict:
+        if self.fields is None:
+            return params
+
+        normalized = {}
+
+        for key, value in params.items():
+            field = self.fields.get(key)
+
+            if field is None:
+                LLM_REJECTED_FIELDS.inc("unknown")
+                logger.info("Dropped unknown query filter %s", key)
+                continue
+
+            try:
+                normalized[key] = field(value)
+            except Rejected:
+                LLM_REJECTED_FIELDS.inc("invalid")
+                logger.info("Dropped invalid query filter %s = %r", key, value)
+
+        return normalized
+
+
+_compiled: tuple[dict | None, QueryFilterNormalizer] | None = None
+
+
+def normalize_query_filters(params: dict, schema: dict | None) -> dict:
+    """Normalize `params` with the normalizer compiled from `schema`.
+
+    The schema cache keeps handing out the same object until the inventory
+    sends a changed schema, so it is only compiled again after that.
+    """
+    global _compiled
+
+    if _compiled is None or _compiled[0] is not schema:
+        _compiled = schema, QueryFilterNormalizer(schema)
+        logger.info("Compiled query filters for %s schema fields", len(_compiled[1].fields or ()))
+
+    return _compiled[1].normalize(params)
@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+
+import httpx
+
+from app.deadlines import DEADLINE_BOUND, DeadlineExceeded
+from app.metrics import (UPSTREAM_ERRORS, UPSTREAM_HEDGED, UPSTREAM_IN_FLIGHT,
+                         UPSTREAM_REQUEST_DURATION)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Latency samples needed before hedging switches from the configured delay to the p95
+MIN_HEDGE_SAMPLES = 20
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+
+    def __init__(self, upstream: str, retry_after: float, request: httpx.Request):
+        super().__init__(f"Circuit breaker for {upstream} is open", request=request)
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Fail fast after `failure_threshold` consecutive failures.
+
+    After `reset_timeout` seconds a limited number of trial calls is let
+    through (half-open). A successful trial closes the breaker again, a
+    failed one reopens it.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float, half_open_max_calls: int = 1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_calls = 0
+
+    @property
+    def retry_after(self) -> float:
+        return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def allow_request(self) -> bool:
+        if self.state == self.OPEN:
+            if self.retry_after > 0:
+                return False
+
+            self.state = self.HALF_OPEN
+            self._trial_calls = 0
+
+        if self.state == self.HALF_OPEN:
+            if self._trial_calls >= self.half_open_max_calls:
+                return False
+
+            self._trial_calls += 1
+
+        return True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+
+    def record_cancelled(self) -> None:
+        """Give back the trial slot of a call that never completed"""
+        if self.state == self.HALF_OPEN and self._trial_calls > 0:
+            self._trial_calls -= 1
+
+
+class LatencyTracker:
+    def __init__(self, size: int = 200):
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def observe(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if len(self._samples) < MIN_HEDGE_SAMPLES:
+            return None
+
+        ordered = sorted(self._samples)
+
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+
+
+def _close_response(task: asyncio.Task) -> None:
+    if not task.cancelled() and task.exception() is None:
+        asyncio.ensure_future(task.result().aclose())
+
+
+class ResilientTransport(httpx.AsyncBaseTransport):
+    """Transport wrapper adding a circuit breaker and hedged GETs to an upstream.
+
+    Only GETs with an in-memory body are hedged, a streamed one can't be sent twice.
+    """
+
+    def __init__(
+            self,
+            upstream: str,
+            transport: httpx.AsyncBaseTransport,
+            breaker: CircuitBreaker,
+            hedge: bool = False,
+            hedge_delay: float = 0.2,
+        ):
+        self.upstream = upstream
+        self.transport = transport
+        self.breaker = breaker
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.latency = LatencyTracker()
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        start = time.perf_counter()
+        UPSTREAM_IN_FLIGHT.inc(self.upstream)
+
+        try:
+            response = await self.transport.handle_async_request(request)
+        except httpx.TransportError as exc:
+            UPSTREAM_ERRORS.inc(self.upstream, type(exc).__name__)
+            raise
+        finally:
+            UPSTREAM_IN_FLIGHT.dec(self.upstream)
+
+        elapsed = time.perf_counter() - start
+        self.latency.observe(elapsed)
+        UPSTREAM_REQUEST_DURATION.observe(elapsed, self.upstream, request.method)
+
+        if response.status_code >= 500:
+            UPSTREAM_ERRORS.inc(self.upstream, "HTTP5xx")
+
+        return response
+
+    async def _send_hedged(self, request: httpx.Request) -> httpx.Response:
+        delay = self.latency.percentile(0.95) or self.hedge_delay
+
+        tasks = {asyncio.ensure_future(self._send(request))}
+
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+
+            if not done:
+                logger.info("Hedging GET %s after %.3fs", request.url, delay)
+                UPSTREAM_HEDGED.inc(self.upstream)
+                tasks.add(asyncio.ensure_future(self._send(request)))
+
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+
+                if winner is not None:
+                    return winner.result()
+
+            # Both attempts failed, surface the last error
+            raise done.pop().exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(_close_response)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if not self.breaker.allow_request():
+            UPSTREAM_ERRORS.inc(self.upstream, "CircuitOpen")
+            raise CircuitOpenError(self.upstream, self.breaker.retry_after, request)
+
+        try:
+            if self.hedge and request.method == "GET" and isinstance(request.stream, httpx.ByteStream):
+                response = await self._send_hedged(request)
+            else:
+                response = await self._send(request)
+        except asyncio.CancelledError:
+            self.breaker.record_cancelled()
+            raise
+        except httpx.TimeoutException as exc:
+            # Timed out on the caller's deadline, which says nothing about the upstream's health
+            if request.extensions.get(DEADLINE_BOUND):
+                self.breaker.record_cancelled()
+                raise DeadlineExceeded("Request deadline exceeded", request=request) from exc
+
+            self.breaker.record_failure()
+            raise
+        except httpx.TransportError:
+            self.breaker.record_failure()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        return response
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
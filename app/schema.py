@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+import httpx
+
+from app.clients import get_client_for_url
+from app.config import QUERY_SCHEMA_ENDPOINT, QUERY_SCHEMA_MAX_AGE
+from app.deadlines import deadline_var
+from app.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class QuerySchemaCache:
+    """In-process copy of the inventory query schema.
+
+    A fresh copy is returned as is. A stale copy is still returned immediately
+    while a background task revalidates it with If-None-Match, and it keeps
+    being served if the inventory is unavailable.
+    """
+
+    def __init__(self, endpoint: str, max_age: float):
+        self.endpoint = endpoint
+        self.max_age = max_age
+        self.schema: dict | None = None
+        self.etag: str | None = None
+        self.version: str | None = None
+        self._fetched_at = 0.0
+        self._refresh_task: asyncio.Task | None = None
+
+    def is_stale(self) -> bool:
+        return time.monotonic() - self._fetched_at > self.max_age
+
+    async def get(self) -> dict | None:
+        if self.schema is None:
+            CACHE_REQUESTS.inc("query_schema", "miss")
+            return await self.refresh()
+
+        if self.is_stale():
+            CACHE_REQUESTS.inc("query_schema", "stale")
+            self._start_refresh(force=False)
+        else:
+            CACHE_REQUESTS.inc("query_schema", "hit")
+
+        return self.schema
+
+    async def refresh(self, force: bool = False) -> dict | None:
+        """Fetch the schema now, joining a refresh that is already running"""
+        return await asyncio.shield(self._start_refresh(force))
+
+    def _start_refresh(self, force: bool) -> asyncio.Task:
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._fetch(force))
+
+        return self._refresh_task
+
+    async def _fetch(self, force: bool) -> dict | None:
+        # Shared by every request waiting for the schema, so bound by none of their deadlines
+        deadline_var.set(None)
+
+        headers = {}
+
+        if self.etag is not None and not force:
+            headers["If-None-Match"] = self.etag
+
+        try:
+            res = await get_client_for_url(self.endpoint).get(self.endpoint, headers=headers)
+        except httpx.HTTPError as exc:
+            logger.warning("Query schema refresh failed: %r", exc)
+            return self.schema
+
+        if res.status_code == 304:
+            self._fetched_at = time.monotonic()
+        elif res.status_code == 200:
+            self.schema = res.json()
+            self.etag = res.headers.get("ETag")
+            self.version = self.etag or hashlib.sha256(res.content).hexdigest()
+            self._fetched_at = time.monotonic()
+            logger.info("Query schema refreshed, version = %s", self.version)
+        else:
+            logger.warning("Query schema refresh failed with status %s", res.status_code)
+
+        return self.schema
+
+
+query_schema_cache = QuerySchemaCache(QUERY_SCHEMA_ENDPOINT, QUERY_SCHEMA_MAX_AGE)
+
+
+async def get_query_schema() -> dict | None:
+    return await query_schema_cache.get()
+
+
+async def refresh_query_schema(force: bool = True) -> dict | None:
+    return await query_schema_cache.refresh(force=force)
+
+
+def get_query_schema_version() -> str | None:
+    return query_schema_cache.version
@@ -0,0 +1,60 @@
+import json
+
+from fastapi.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ORJSON_AVAILABLE = orjson is not None
+
+
+def dumps(content) -> bytes:
+    """Compact JSON as bytes, through orjson when it is installed"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content)
+
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(content: bytes | str):
+    if ORJSON_AVAILABLE:
+        return orjson.loads(content)
+
+    return json.loads(content)
+
+
+def splice_field(payload: bytes, key: str, value) -> bytes:
+    """Add `key` to the JSON object in `payload` without decoding the rest of it.
+
+    If the object already has `key`, the spliced one comes last and wins when
+    parsed.
+    """
+    body = payload.rstrip()
+
+    if not (body.lstrip().startswith(b"{") and body.endswith(b"}")):
+        raise ValueError("Can only add a field to a JSON object")
+
+    field = dumps(key) + b":" + dumps(value)
+    head = body[:-1].rstrip()
+
+    separator = b"" if head.endswith(b"{") else b","
+
+    return head + separator + field + b"}"
+
+
+class RawJSONResponse(Response):
+    """JSON response that sends bytes as they are and encodes anything else with `dumps`.
+
+    Returned from an endpoint it also skips FastAPI's response validation and
+    `jsonable_encoder`, so only use it with plain JSON-compatible content.
+    """
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+
+        return dumps(content)
@@ -0,0 +1,63 @@
+import logging
+from importlib.util import find_spec
+from pathlib import Path
+
+import uvicorn
+
+from app.config import (DEBUG, FORWARDED_ALLOW_IPS, SERVER_ACCESS_LOG,
+                        SERVER_BACKLOG, SERVER_GRACEFUL_SHUTDOWN_TIMEOUT,
+                        SERVER_HOST, SERVER_KEEPALIVE_TIMEOUT,
+                        SERVER_LIMIT_CONCURRENCY, SERVER_MAX_REQUESTS,
+                        SERVER_PORT, SERVER_WORKERS)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+UVLOOP_AVAILABLE = find_spec("uvloop") is not None
+HTTPTOOLS_AVAILABLE = find_spec("httptools") is not None
+
+LOG_CONFIG_PATH = Path(__file__).parent / "log_config.yaml"
+
+# Workers import the app themselves, so it has to be passed by name
+APP = "app.main:app"
+
+
+def server_options() -> dict:
+    """uvicorn settings, taken from the environment via app.config"""
+    workers = max(1, SERVER_WORKERS)
+
+    if DEBUG and workers > 1:
+        logger.warning("DEBUG is on, running a single worker")
+        workers = 1
+
+    return dict(
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        workers=workers,
+        loop="uvloop" if UVLOOP_AVAILABLE else "asyncio",
+        http="httptools" if HTTPTOOLS_AVAILABLE else "h11",
+        # Nothing here serves websockets, skip loading a library for them
+        ws="none",
+        lifespan="on",
+        backlog=SERVER_BACKLOG,
+        timeout_keep_alive=SERVER_KEEPALIVE_TIMEOUT,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_SHUTDOWN_TIMEOUT,
+        limit_concurrency=SERVER_LIMIT_CONCURRENCY or None,
+        limit_max_requests=SERVER_MAX_REQUESTS or None,
+        access_log=SERVER_ACCESS_LOG,
+        # Clients are told apart by address, see app/admission.py
+        proxy_headers=True,
+        forwarded_allow_ips=FORWARDED_ALLOW_IPS,
+        log_config=str(LOG_CONFIG_PATH),
+    )
+
+
+def run() -> None:
+    # On SIGTERM uvicorn stops accepting connections, lets in-flight requests
+    # finish for up to `timeout_graceful_shutdown` seconds, then runs the
+    # lifespan shutdown that closes the upstream pools
+    uvicorn.run(APP, **server_options())
+
+
+if __name__ == "__main__":
+    run()
@@ -1,15 +1,32 @@
 import logging
+import os
+from typing import AsyncIterator
 
 import httpx
 from fastapi import HTTPException, Request
-from fastapi.responses import Response
-
-from app.config import TOKEN_VERIFICATION_ENDPOINT
+from fastapi.responses import Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.datastructures import UploadFile
+
+from app.auth import is_token_valid
+from app.cache import SingleFlight
+from app.clients import get_client, get_client_for_url
+from app.compression import negotiate_body, upstream_accept_encoding
+from app.config import PROXY_MAX_BUFFER_BYTES, TOKEN_VERIFICATION_ENDPOINT
+from app.logs import SAMPLED, Truncated
+from app.metrics import CACHE_REQUESTS
 from app.models import LLMQuery
+from app.proxy_cache import (CachedResponse, coalesce_key, get_cached_response,
+                             invalidate_responses, response_cache_key,
+                             store_response)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+_coalesced_requests = SingleFlight()
+
 
 def fetch_json(endpoint: str, params: dict | None = None) -> dict | None:
     res = httpx.get(endpoint, params=params)
@@ -38,7 +55,7 @@ def post_data(
     ) -> dict | str | None:
     res = httpx.post(endpoint, params=params, json=content, files=files)
 
-    logger.info(res.text)
+    logger.info("Response from %s = %s", endpoint, Truncated(res.content), extra=SAMPLED)
 
     if res.status_code != 200:
         return None
@@ -53,7 +70,7 @@ def put_data(
     ) -> dict | str | None:
     res = httpx.put(endpoint, params=params, json=content, files=files)
 
-    logger.info(res.text)
+    logger.info("Response from %s = %s", endpoint, Truncated(res.content), extra=SAMPLED)
 
     if res.status_code != 200:
         return None
@@ -76,7 +93,163 @@ def get_data_from_llm(endpoint: str, data: dict) -> tuple[int, LLMQuery | None]:
     return res.status_code, llm_query
 
 
-async def _reverse_proxy(call_url: str, request: Request):
+async def async_fetch_json(endpoint: str, params: dict | None = None) -> dict | None:
+    res = await get_client_for_url(endpoint).get(endpoint, params=params)
+
+    if res.status_code != 200:
+        return None
+
+    return res.json()
+
+
+async def async_fetch_bytes(endpoint: str, params: dict | None = None) -> bytes | None:
+    """Response body without parsing it, for passing JSON on as it is"""
+    res = await get_client_for_url(endpoint).get(endpoint, params=params)
+
+    if res.status_code != 200:
+        return None
+
+    return res.content
+
+
+async def async_fetch_text(endpoint: str, params: dict | None = None) -> str | None:
+    res = await get_client_for_url(endpoint).get(endpoint, params=params)
+
+    if res.status_code != 200:
+        return None
+
+    return res.text
+
+
+async def async_post_data(
+        endpoint: str,
+        content: dict | None = None,
+        params: dict | None = None,
+        files: dict | None = None,
+        return_json: bool = True
+    ) -> dict | str | None:
+    res = await get_client_for_url(endpoint).post(
+        endpoint, params=params, json=content, files=files
+    )
+
+    logger.info("Response from %s = %s", endpoint, Truncated(res.content), extra=SAMPLED)
+
+    if res.status_code != 200:
+        return None
+
+    return res.json() if return_json else res.text
+
+
+async def async_put_data(
+        endpoint: str,
+        content: dict | None = None,
+        params: dict | None = None,
+        files: dict | None = None,
+    ) -> dict | str | None:
+    res = await get_client_for_url(endpoint).put(
+        endpoint, params=params, json=content, files=files
+    )
+
+    logger.info("Response from %s = %s", endpoint, Truncated(res.content), extra=SAMPLED)
+
+    if res.status_code != 200:
+        return None
+
+    return res.text
+
+
+def _multipart_framing(upload: UploadFile, boundary: str) -> tuple[bytes, bytes]:
+    filename = (upload.filename or "upload").replace('"', "%22").replace("\r", "").replace("\n", "")
+    content_type = upload.content_type or "application/octet-stream"
+
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode("utf-8")
+    tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+    return head, tail
+
+
+async def _iter_multipart(upload: UploadFile, head: bytes, tail: bytes) -> AsyncIterator[bytes]:
+    yield head
+
+    await upload.seek(0)
+
+    while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+    yield tail
+
+
+async def async_upload_file(
+        endpoint: str,
+        upload: UploadFile,
+        params: dict | None = None,
+    ) -> str | None:
+    """POST an uploaded file as multipart `file` field, streaming it from its spool"""
+    boundary = os.urandom(16).hex()
+    head, tail = _multipart_framing(upload, boundary)
+
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+    if upload.size is not None:
+        headers["Content-Length"] = str(len(head) + upload.size + len(tail))
+
+    res = await get_client_for_url(endpoint).post(
+        endpoint,
+        params=params,
+        content=_iter_multipart(upload, head, tail),
+        headers=headers,
+    )
+
+    logger.info("Response from %s = %s", endpoint, Truncated(res.content), extra=SAMPLED)
+
+    if res.status_code != 200:
+        return None
+
+    return res.text
+
+
+async def async_get_data_from_llm(endpoint: str, data: dict) -> tuple[int, LLMQuery | None]:
+    res = await get_client_for_url(endpoint).post(
+        endpoint,
+        json=data,
+    )
+
+    llm_query = None
+
+    if res.status_code == 200:
+        llm_query = LLMQuery(**res.json())
+
+    return res.status_code, llm_query
+
+
+# Connection-level headers that must not be forwarded to the client
+HOP_BY_HOP_HEADERS = frozenset({
+    "connection", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade",
+})
+
+
+def _response_headers(rp_resp: httpx.Response) -> httpx.Headers:
+    return httpx.Headers([
+        (key, value) for key, value in rp_resp.headers.multi_items()
+        if key.lower() not in HOP_BY_HOP_HEADERS
+    ])
+
+
+def _fits_in_buffer(content_length: str | None) -> bool:
+    """Whether a declared Content-Length is within the buffer, a missing or malformed one isn't"""
+    try:
+        return content_length is not None and int(content_length) <= PROXY_MAX_BUFFER_BYTES
+    except ValueError:
+        return False
+
+
+def _build_upstream_request(
+        client: httpx.AsyncClient, request: Request, content
+    ) -> httpx.Request:
     query = request.url.query.encode("utf-8")
 
     url = httpx.URL(
@@ -84,22 +257,210 @@ async def _reverse_proxy(call_url: str, request: Request):
         query=query if query else None,
     )
 
-    async with httpx.AsyncClient(base_url=f"http://{call_url}") as client:
-        rp_req = client.build_request(
-            request.method,
-            url,
-            headers=request.headers.raw,
-            content=await request.body(),
+    rp_req = client.build_request(
+        request.method,
+        url,
+        headers=request.headers.raw,
+        content=content,
+    )
+
+    # httpx would otherwise ask for gzip on behalf of a client that can't decode it,
+    # and streamed bodies are passed through without decoding. Buffered bodies may
+    # be cached or shared with clients accepting less, so they must stay decodable.
+    rp_req.headers["Accept-Encoding"] = upstream_accept_encoding(request.headers.get("accept-encoding"))
+
+    logger.info("Redirect URL = %s", rp_req.url, extra=SAMPLED)
+
+    return rp_req
+
+
+class _OversizedResponse:
+    """An upstream response too large to buffer, with the chunks of it already read.
+
+    Its body can only be streamed once, by whichever request claims it first.
+    """
+
+    def __init__(self, rp_resp: httpx.Response, chunks: list[bytes], rest: AsyncIterator[bytes]):
+        self.rp_resp = rp_resp
+        self.chunks = chunks
+        self.rest = rest
+        self.claimed = False
+
+    def claim(self) -> bool:
+        claimed, self.claimed = self.claimed, True
+
+        return not claimed
+
+    async def discard(self) -> None:
+        """Close the upstream response unless a request claimed it"""
+        if self.claim():
+            await self.rp_resp.aclose()
+
+    async def _body(self) -> AsyncIterator[bytes]:
+        for chunk in self.chunks:
+            yield chunk
+
+        async for chunk in self.rest:
+            yield chunk
+
+    def streaming_response(self) -> StreamingResponse:
+        return StreamingResponse(
+            self._body(),
+            status_code=self.rp_resp.status_code,
+            headers=_response_headers(self.rp_resp),
+            background=BackgroundTask(self.rp_resp.aclose),
         )
-        logger.info(f"Redirect URL = {rp_req.url}")
-        rp_resp = await client.send(rp_req)
 
-        return Response(
-            rp_resp.content,
-            status_code=rp_resp.status_code,
-            headers=rp_resp.headers,
+
+async def _read_buffered(rp_resp: httpx.Response) -> CachedResponse | _OversizedResponse:
+    """Read the body as sent, still compressed if the upstream compressed it.
+
+    Bodies without a Content-Length are read until they exceed
+    PROXY_MAX_BUFFER_BYTES, after which the rest is left to be streamed.
+    """
+    rest = rp_resp.aiter_raw()
+    content_length = rp_resp.headers.get("content-length")
+
+    if content_length is not None and not _fits_in_buffer(content_length):
+        return _OversizedResponse(rp_resp, [], rest)
+
+    chunks = []
+    size = 0
+
+    try:
+        async for chunk in rest:
+            chunks.append(chunk)
+            size += len(chunk)
+
+            if size > PROXY_MAX_BUFFER_BYTES:
+                return _OversizedResponse(rp_resp, chunks, rest)
+    except BaseException:
+        await rp_resp.aclose()
+        raise
+
+    await rp_resp.aclose()
+
+    return CachedResponse(rp_resp.status_code, _response_headers(rp_resp), b"".join(chunks))
+
+
+def _buffered_response(buffered: CachedResponse, request: Request) -> Response:
+    """Respond with a buffered upstream response, decoded only if the client can't take it as is"""
+    body, headers = negotiate_body(
+        buffered.body, buffered.headers, request.headers.get("accept-encoding")
+    )
+
+    return Response(body, status_code=buffered.status_code, headers=headers)
+
+
+async def _fetch_shared(
+        call_url: str,
+        request: Request,
+        cache_key: tuple | None,
+        cache_ttl: float | None,
+    ) -> CachedResponse | _OversizedResponse:
+    """Fetch a GET response on behalf of every identical in-flight request.
+
+    A response too large to be shared from memory is left for one of the
+    requests to stream.
+    """
+    client = get_client(call_url)
+
+    rp_resp = await client.send(_build_upstream_request(client, request, b""), stream=True)
+    buffered = await _read_buffered(rp_resp)
+
+    if cache_key is not None and isinstance(buffered, CachedResponse):
+        await store_response(cache_key, buffered, cache_ttl)
+
+    return buffered
+
+
+async def _discard_shared(shared: CachedResponse | _OversizedResponse) -> None:
+    if isinstance(shared, _OversizedResponse):
+        await shared.discard()
+
+
+async def _reverse_proxy(
+        call_url: str,
+        request: Request,
+        stream: bool = False,
+        cache_ttl: float | None = None,
+        invalidates: bool = False,
+        coalesce: bool = False,
+    ):
+    """Forward the request to `call_url`.
+
+    With `stream=True` the request and response bodies are passed through as
+    byte streams. Otherwise bodies are buffered, unless they are larger than
+    PROXY_MAX_BUFFER_BYTES, in which case they are streamed as well. So are
+    request bodies of unknown size.
+
+    With `cache_ttl`, successful GET responses that fit in the buffer are
+    cached for that long, unless the upstream's Cache-Control says otherwise.
+    With `invalidates`, a successful request drops the cached responses of
+    the upstream. With `coalesce`, identical concurrent GETs share a single
+    upstream call.
+    """
+    cache_key = None
+
+    if cache_ttl is not None and request.method == "GET":
+        cache_key = response_cache_key(call_url, request)
+        cached = await get_cached_response(cache_key)
+
+        CACHE_REQUESTS.inc("response", "miss" if cached is None else "hit")
+
+        if cached is not None:
+            return _buffered_response(cached, request)
+
+    if coalesce and request.method == "GET":
+        shared = await _coalesced_requests.do(
+            coalesce_key(call_url, request),
+            lambda: _fetch_shared(call_url, request, cache_key, cache_ttl),
+            discard=_discard_shared,
         )
 
+        if isinstance(shared, CachedResponse):
+            return _buffered_response(shared, request)
+
+        # Only one request can stream the shared response on, the others fetch their own
+        if shared.claim():
+            return shared.streaming_response()
+
+    client = get_client(call_url)
+
+    buffer_request = "transfer-encoding" not in request.headers and _fits_in_buffer(
+        request.headers.get("content-length", "0")
+    )
+
+    # GETs keep their (usually empty) body in memory even on streamed routes, so they can be hedged
+    if not buffer_request or (stream and request.method != "GET"):
+        content = request.stream()
+    else:
+        content = await request.body()
+
+    rp_resp = await client.send(_build_upstream_request(client, request, content), stream=True)
+
+    if invalidates and rp_resp.status_code < 400:
+        await invalidate_responses(call_url)
+
+    # Cacheable responses are buffered even on streamed routes, if they fit
+    if not stream or cache_key is not None:
+        buffered = await _read_buffered(rp_resp)
+
+        if isinstance(buffered, _OversizedResponse):
+            return buffered.streaming_response()
+
+        if cache_key is not None:
+            await store_response(cache_key, buffered, cache_ttl)
+
+        return _buffered_response(buffered, request)
+
+    return StreamingResponse(
+        rp_resp.aiter_raw(),
+        status_code=rp_resp.status_code,
+        headers=_response_headers(rp_resp),
+        background=BackgroundTask(rp_resp.aclose),
+    )
+
 
 def raise_for_invalid_token(token: str | None):
     """Raise HTTPException when the token is invalid"""
@@ -120,19 +481,34 @@ def raise_for_invalid_token(token: str | None):
         )
 
 
-async def _reverse_auth_proxy(call_url: str, request: Request):
+async def async_raise_for_invalid_token(token: str | None):
+    """Raise HTTPException when the token is invalid, without blocking the event loop"""
+    if token is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Request does not contain authorization token.",
+        )
+
+    if not await is_token_valid(token):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid authorization token.",
+        )
+
+
+async def _reverse_auth_proxy(call_url: str, request: Request, **options):
     token = request.headers.get("Authorization")
 
-    raise_for_invalid_token(token)
+    await async_raise_for_invalid_token(token)
 
-    return await _reverse_proxy(call_url, request)
+    return await _reverse_proxy(call_url, request, **options)
 
 
 def require_auth_token(func):
     async def wrapper(call_url: str, request: Request):
         token = request.headers.get("Authorization")
 
-        raise_for_invalid_token(token)
+        await async_raise_for_invalid_token(token)
 
         return await func(call_url, request)
 
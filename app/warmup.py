@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import time
+
+import httpx
+
+from app.clients import get_client, get_http_transport
+from app.config import (DEFAULT_UPSTREAM_SETTINGS, UPSTREAM_SETTINGS,
+                        WARMUP_TIMEOUT)
+from app.schema import refresh_query_schema
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+_state = dict(ready=False, steps={})
+_task: asyncio.Task | None = None
+
+
+def is_ready() -> bool:
+    return _state["ready"]
+
+
+def readiness() -> dict:
+    return dict(ready=_state["ready"], steps=dict(_state["steps"]))
+
+
+async def _step(name: str, coro) -> None:
+    try:
+        await coro
+    except Exception as exc:
+        # A down upstream must not keep the instance out of rotation
+        logger.warning("Warm-up step %s failed: %r", name, exc)
+        _state["steps"][name] = "failed"
+    else:
+        _state["steps"][name] = "done"
+
+
+async def _open_connection(upstream: str, transport: httpx.AsyncBaseTransport) -> None:
+    settings = UPSTREAM_SETTINGS.get(upstream, DEFAULT_UPSTREAM_SETTINGS)
+    request = httpx.Request("HEAD", f"{settings['scheme']}://{upstream}/")
+
+    response = await transport.handle_async_request(request)
+
+    # Reading the response hands the connection back to the pool
+    try:
+        await response.aread()
+    finally:
+        await response.aclose()
+
+
+async def _open_connections(upstream: str) -> None:
+    settings = UPSTREAM_SETTINGS.get(upstream, DEFAULT_UPSTREAM_SETTINGS)
+    count = settings["warmup_connections"]
+
+    if count <= 0:
+        return
+
+    # Connecting resolves the upstream through the DNS cache as well
+    get_client(upstream)
+    transport = get_http_transport(upstream)
+
+    # Concurrent requests make the pool open one connection each
+    results = await asyncio.gather(
+        *(_open_connection(upstream, transport) for _ in range(count)), return_exceptions=True
+    )
+    errors = [result for result in results if isinstance(result, Exception)]
+
+    if errors:
+        raise errors[0]
+
+
+async def _prefetch_query_schema() -> None:
+    if await refresh_query_schema(force=False) is None:
+        raise RuntimeError("query schema unavailable")
+
+
+async def warm_up() -> None:
+    """Resolve and connect to every upstream and fetch the query schema"""
+    started_at = time.monotonic()
+
+    steps = [
+        _step(f"connections:{upstream}", _open_connections(upstream))
+        for upstream in UPSTREAM_SETTINGS
+    ]
+    steps.append(_step("query_schema", _prefetch_query_schema()))
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*steps), WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning("Warm-up did not finish within %ss", WARMUP_TIMEOUT)
+
+    _state["ready"] = True
+    logger.info("Warm-up finished in %.2fs: %s", time.monotonic() - started_at, _state["steps"])
+
+
+def start_warm_up() -> None:
+    global _task
+
+    _state["ready"] = False
+    _state["steps"].clear()
+    _task = asyncio.ensure_future(warm_up())
+
+
+async def stop_warm_up() -> None:
+    """Report not ready again, so traffic is drained before shutdown"""
+    _state["ready"] = False
+
+    if _task is not None and not _task.done():
+        _task.cancel()
+        await asyncio.gather(_task, return_exceptions=True)
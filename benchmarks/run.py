@@ -0,0 +1,240 @@
+"""Drive load at the gateway against in-process stub upstreams.
+
+    python -m benchmarks.run --requests 500 --concurrency 50
+    python -m benchmarks.run --output after.json --compare before.json
+
+Everything runs in one process over ASGI transports, so no network, ports
+or real backends are needed. Reported latencies therefore contain the
+gateway's own overhead plus the configured stub latencies.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+import httpx
+
+AUTH_HEADERS = {"Authorization": "bench-token"}
+
+PROPERTY_CONTENT = json.dumps({
+    "title": "Benchmark flat",
+    "address": "Bahnhofstrasse 1",
+    "location": "Zurich",
+    "images": [],
+})
+
+
+@dataclass
+class Scenario:
+    name: str
+    send: Callable[[httpx.AsyncClient, int], Awaitable[httpx.Response]]
+
+
+def build_scenarios(images: int, image_bytes: int) -> list[Scenario]:
+    image = b"\x89PNG" + b"\x00" * max(0, image_bytes - 4)
+
+    def create_property(client: httpx.AsyncClient, i: int):
+        return client.post(
+            "/createProperty",
+            data={"content": PROPERTY_CONTENT},
+            files=[("images", (f"{n}.png", image, "image/png")) for n in range(images)],
+            headers=AUTH_HEADERS,
+        )
+
+    return [
+        Scenario("proxy_get", lambda client, i: client.get(
+            "/fetchInterestsByProperty", params={"propertyId": i}
+        )),
+        Scenario("proxy_get_cached", lambda client, i: client.get("/properties")),
+        Scenario("query_properties_with_images", lambda client, i: client.get(
+            "/queryProperties", params={"rooms": i % 5 + 1, "withImages": "true"}
+        )),
+        Scenario("auth_proxy_post", lambda client, i: client.post(
+            "/properties", json={"title": f"Property {i}"}, headers=AUTH_HEADERS
+        )),
+        Scenario("initial_query_cold", lambda client, i: client.get(
+            "/initial_query", params={"user_query": f"{i} room flat in Zurich"}
+        )),
+        Scenario("initial_query_warm", lambda client, i: client.get(
+            "/initial_query", params={"user_query": "2 room flat in Zurich"}
+        )),
+        Scenario(f"create_property_{images}_images", create_property),
+    ]
+
+
+def percentile(ordered: list[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_scenario(
+        client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int
+    ) -> dict:
+    latencies = []
+    errors = 0
+    indices = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+
+        for i in indices:
+            start = time.perf_counter()
+
+            try:
+                res = await scenario.send(client, i)
+                failed = res.status_code >= 400
+            except Exception:
+                failed = True
+
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    ordered = sorted(latencies)
+
+    return dict(
+        name=scenario.name,
+        requests=requests,
+        concurrency=concurrency,
+        errors=errors,
+        throughput=requests / elapsed,
+        mean_ms=statistics.fmean(ordered) * 1000,
+        p50_ms=percentile(ordered, 0.50) * 1000,
+        p95_ms=percentile(ordered, 0.95) * 1000,
+        p99_ms=percentile(ordered, 0.99) * 1000,
+    )
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # Imported here, so that main() can configure the app first
+    from app.clients import close_clients, mount_transport
+    from app.main import app
+    from benchmarks.stubs import build_stubs
+
+    stubs = build_stubs(
+        inventory_latency=args.inventory_latency,
+        user_latency=args.user_latency,
+        image_latency=args.image_latency,
+        llm_latency=args.llm_latency,
+        geocoder_latency=args.geocoder_latency,
+        listing_size=args.listing_size,
+    )
+
+    for upstream, stub in stubs.items():
+        mount_transport(upstream, httpx.ASGITransport(app=stub))
+
+    # Pools created before the stubs were mounted would still hit the network
+    await close_clients()
+
+    scenarios = build_scenarios(args.images, args.image_bytes)
+
+    if args.scenario:
+        scenarios = [scenario for scenario in scenarios if scenario.name in args.scenario]
+
+    results = []
+
+    try:
+        async with app.router.lifespan_context(app):
+            transport = httpx.ASGITransport(app=app)
+
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://gateway", timeout=60
+            ) as client:
+                # Measure the warm instance, as the orchestrator would route to it
+                while (await client.get("/ready")).status_code != 200:
+                    await asyncio.sleep(0.01)
+
+                for scenario in scenarios:
+                    results.append(
+                        await run_scenario(client, scenario, args.requests, args.concurrency)
+                    )
+    finally:
+        for upstream in stubs:
+            mount_transport(upstream, None)
+
+    return dict(
+        timestamp=datetime.now(timezone.utc).isoformat(),
+        python=platform.python_version(),
+        settings={key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        scenarios=results,
+    )
+
+
+def print_report(report: dict, baseline: dict | None = None) -> None:
+    previous = {result["name"]: result for result in (baseline or {}).get("scenarios", [])}
+
+    print(f"{'scenario':28} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+
+    for result in report["scenarios"]:
+        print(
+            f"{result['name']:28} {result['throughput']:10.1f} {result['p50_ms']:9.2f} "
+            f"{result['p95_ms']:9.2f} {result['p99_ms']:9.2f} {result['errors']:7d}"
+        )
+
+        before = previous.get(result["name"])
+
+        if before is not None:
+            print(
+                f"{'  vs baseline':28} "
+                f"{(result['throughput'] / before['throughput'] - 1) * 100:+9.1f}% "
+                f"{(result['p50_ms'] / before['p50_ms'] - 1) * 100:+8.1f}% "
+                f"{(result['p95_ms'] / before['p95_ms'] - 1) * 100:+8.1f}% "
+                f"{(result['p99_ms'] / before['p99_ms'] - 1) * 100:+8.1f}%"
+            )
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--scenario", action="append", help="only run the named scenario(s)")
+    parser.add_argument("--images", type=int, default=5, help="images per /createProperty")
+    parser.add_argument("--image-bytes", type=int, default=256 * 1024)
+    parser.add_argument("--listing-size", type=int, default=20, help="properties per listing page")
+    parser.add_argument("--inventory-latency", type=float, default=0.005, help="seconds")
+    parser.add_argument("--user-latency", type=float, default=0.002, help="seconds")
+    parser.add_argument("--image-latency", type=float, default=0.01, help="seconds")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds")
+    parser.add_argument("--geocoder-latency", type=float, default=0.05, help="seconds")
+    parser.add_argument("--output", default="bench_output.json", help="where to save the results")
+    parser.add_argument("--compare", help="results file of an earlier run to compare against")
+
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> dict:
+    args = parse_args(argv)
+
+    # All load comes from one client, so per-client rate limits would only measure
+    # themselves. Set before app.config is imported; concurrency limits stay on.
+    for lane in ("LLM", "PROPERTY_WRITE"):
+        os.environ.setdefault(f"ADMISSION_{lane}_RATE", "0")
+
+    report = asyncio.run(run(args))
+
+    baseline = None
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    print_report(report, baseline)
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Results saved to {args.output}")
+
+    return report
+
+
+if __name__ == "__main__":
+    main()
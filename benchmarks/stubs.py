@@ -0,0 +1,189 @@
+"""In-process stand-ins for the services the gateway talks to.
+
+Every stub answers after a configurable latency, and the inventory returns
+listings of a configurable size, so gateway overhead can be measured without
+any network or real backend.
+"""
+import asyncio
+import json
+import random
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+from app.config import (GEOLOCATION_SERVICE_URL, IMAGE_SERVICE_URL,
+                        INVENTORY_SERVICE_URL, LLM_SERVICE_URL,
+                        USER_SERVICE_URL)
+
+QUERY_SCHEMA = {
+    "title": "PropertyQuery",
+    "type": "object",
+    "properties": {
+        "location": {"anyOf": [{"type": "string"}, {"type": "null"}]},
+        "rooms": {"anyOf": [{"type": "integer", "minimum": 1}, {"type": "null"}]},
+        "priceMax": {"anyOf": [{"type": "integer", "minimum": 0}, {"type": "null"}]},
+    },
+}
+
+
+def make_listing(size: int, description_bytes: int) -> dict:
+    return {
+        "properties": [
+            {
+                "propertyId": i,
+                "title": f"Property {i}",
+                "address": f"Street {i}",
+                "location": "Zurich",
+                "rooms": i % 5 + 1,
+                "price": 1000 + i,
+                "description": "x" * description_bytes,
+            }
+            for i in range(size)
+        ],
+        "total": size,
+    }
+
+
+def _delayed(latency: float, jitter: float = 0.1):
+    """Sleep for `latency` seconds, +/- `jitter` of it"""
+    async def delay():
+        if latency > 0:
+            await asyncio.sleep(latency * random.uniform(1 - jitter, 1 + jitter))
+
+    return delay
+
+
+def inventory_stub(latency: float, listing_size: int, description_bytes: int) -> Starlette:
+    delay = _delayed(latency)
+    listing = json.dumps(make_listing(listing_size, description_bytes)).encode()
+    next_property_id = 0
+
+    async def listing_response(request: Request) -> Response:
+        await delay()
+        return Response(listing, media_type="application/json")
+
+    async def create_property(request: Request) -> Response:
+        nonlocal next_property_id
+        await request.body()
+        await delay()
+        next_property_id += 1
+        return JSONResponse({"propertyId": next_property_id})
+
+    async def get_property(request: Request) -> Response:
+        await delay()
+        return JSONResponse({
+            "propertyId": int(request.path_params["property_id"]),
+            "address": "Bahnhofstrasse 1",
+            "location": "Zurich",
+            "longitude": 8.54,
+            "latitude": 47.37,
+        })
+
+    async def update_property(request: Request) -> Response:
+        await request.body()
+        await delay()
+        return PlainTextResponse("updated")
+
+    async def schema(request: Request) -> Response:
+        await delay()
+        return JSONResponse(QUERY_SCHEMA, headers={"ETag": '"bench"'})
+
+    async def interests(request: Request) -> Response:
+        await delay()
+        return JSONResponse([])
+
+    return Starlette(routes=[
+        Route("/properties", listing_response, methods=["GET"]),
+        Route("/properties/", create_property, methods=["POST"]),
+        Route("/properties", create_property, methods=["POST"]),
+        Route("/properties/{property_id:int}", get_property, methods=["GET"]),
+        Route("/properties/{property_id:int}", update_property, methods=["PUT"]),
+        Route("/queryProperties", listing_response, methods=["GET"]),
+        Route("/fetchPropertiesByUser", listing_response, methods=["GET"]),
+        Route("/fetchInterestsByProperty", interests, methods=["GET"]),
+        Route("/schema/propertyQuery", schema, methods=["GET"]),
+    ])
+
+
+def user_stub(latency: float) -> Starlette:
+    delay = _delayed(latency)
+
+    async def verify(request: Request) -> Response:
+        await delay()
+        return JSONResponse(True)
+
+    async def user_id(request: Request) -> Response:
+        await delay()
+        return PlainTextResponse("user-1")
+
+    return Starlette(routes=[
+        Route("/verifyAccessToken", verify),
+        Route("/userId", user_id),
+    ])
+
+
+def image_stub(latency: float) -> Starlette:
+    delay = _delayed(latency)
+
+    async def upload(request: Request) -> Response:
+        # Drain the multipart body like a real service would
+        async for _ in request.stream():
+            pass
+        await delay()
+        return PlainTextResponse("uploaded")
+
+    async def primary_image(request: Request) -> Response:
+        await delay()
+        return PlainTextResponse(f"https://images/{request.query_params.get('propertyId')}/0.png")
+
+    async def all_images(request: Request) -> Response:
+        await delay()
+        return JSONResponse([f"https://images/{request.query_params.get('propertyId')}/0.png"])
+
+    return Starlette(routes=[
+        Route("/upload", upload, methods=["POST"]),
+        Route("/getPrimaryImageUrl", primary_image),
+        Route("/getImageUrls", all_images),
+    ])
+
+
+def llm_stub(latency: float) -> Starlette:
+    delay = _delayed(latency)
+
+    async def generate(request: Request) -> Response:
+        await request.body()
+        await delay()
+        return JSONResponse({"content": json.dumps({"location": "Zurich", "rooms": 2})})
+
+    return Starlette(routes=[Route("/generates/query", generate, methods=["POST"])])
+
+
+def geocoder_stub(latency: float) -> Starlette:
+    delay = _delayed(latency)
+
+    async def search(request: Request) -> Response:
+        await delay()
+        return JSONResponse([{"lon": "8.54", "lat": "47.37"}])
+
+    return Starlette(routes=[Route("/v1/search", search)])
+
+
+def build_stubs(
+        inventory_latency: float = 0.005,
+        user_latency: float = 0.002,
+        image_latency: float = 0.01,
+        llm_latency: float = 0.5,
+        geocoder_latency: float = 0.05,
+        listing_size: int = 20,
+        description_bytes: int = 500,
+    ) -> dict[str, Starlette]:
+    """Stub ASGI apps keyed by the upstream name the gateway uses for them"""
+    return {
+        INVENTORY_SERVICE_URL: inventory_stub(inventory_latency, listing_size, description_bytes),
+        USER_SERVICE_URL: user_stub(user_latency),
+        IMAGE_SERVICE_URL: image_stub(image_latency),
+        LLM_SERVICE_URL: llm_stub(llm_latency),
+        GEOLOCATION_SERVICE_URL: geocoder_stub(geocoder_latency),
+    }
@@ -0,0 +1,158 @@
+import asyncio
+import unittest
+
+import httpx
+from fastapi import FastAPI
+from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
+
+from app.admission import (AdmissionMiddleware, Lane, Rejected, TokenBuckets,
+                           client_id)
+from app.metrics import ADMISSION_SHED
+
+
+def make_lane(**overrides) -> Lane:
+    settings = dict(
+        paths=("/expensive",), concurrency=1, queue_size=1, queue_timeout=1.0, rate=0, burst=1,
+    )
+    settings.update(overrides)
+    return Lane("test", **settings)
+
+
+class TestTokenBuckets(unittest.TestCase):
+
+    def test_burst_then_rate_limited(self):
+        buckets = TokenBuckets(rate=1.0, burst=2)
+
+        self.assertEqual(buckets.take("a"), 0)
+        self.assertEqual(buckets.take("a"), 0)
+        self.assertGreater(buckets.take("a"), 0)
+
+        # Other clients have their own bucket
+        self.assertEqual(buckets.take("b"), 0)
+
+    def test_zero_rate_disables_limit(self):
+        buckets = TokenBuckets(rate=0, burst=0)
+
+        self.assertEqual(buckets.take("a"), 0)
+
+
+class TestClientId(unittest.TestCase):
+
+    def test_unverified_tokens_do_not_get_their_own_bucket(self):
+        scopes = [
+            {"type": "http", "client": ("10.0.0.1", 1234), "headers": [(b"authorization", token)]}
+            for token in (b"made-up-1", b"made-up-2")
+        ]
+
+        self.assertEqual({client_id(scope) for scope in scopes}, {"10.0.0.1"})
+
+
+class TestForwardedClients(unittest.IsolatedAsyncioTestCase):
+
+    async def test_clients_behind_a_trusted_proxy_have_their_own_bucket(self):
+        app = FastAPI()
+
+        @app.get("/expensive")
+        async def expensive():
+            return "done"
+
+        app.add_middleware(AdmissionMiddleware, lanes={"test": dict(
+            paths=("/expensive",), concurrency=1, queue_size=0, queue_timeout=1.0, rate=0.001, burst=1,
+        )})
+        # As uvicorn runs it with proxy_headers, see app/server.py
+        proxied = ProxyHeadersMiddleware(app, trusted_hosts="10.0.0.1")
+        transport = httpx.ASGITransport(app=proxied, client=("10.0.0.1", 1234))
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            statuses = [
+                (await client.get("/expensive", headers={"X-Forwarded-For": address})).status_code
+                for address in ("203.0.113.1", "203.0.113.2", "203.0.113.1")
+            ]
+
+        self.assertEqual(statuses, [200, 200, 429])
+
+
+class TestLane(unittest.IsolatedAsyncioTestCase):
+
+    async def test_full_queue_is_shed(self):
+        lane = make_lane()
+        shed = ADMISSION_SHED.value("test", "queue_full")
+
+        await lane.acquire("a")
+        waiting = asyncio.ensure_future(lane.acquire("b"))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(Rejected) as cm:
+            await lane.acquire("c")
+
+        self.assertEqual(cm.exception.status_code, 503)
+        self.assertEqual(ADMISSION_SHED.value("test", "queue_full"), shed + 1)
+
+        lane.release()
+        await waiting
+        lane.release()
+
+    async def test_queue_timeout(self):
+        lane = make_lane(queue_timeout=0.01)
+
+        await lane.acquire("a")
+
+        with self.assertRaises(Rejected) as cm:
+            await lane.acquire("b")
+
+        self.assertEqual(cm.exception.reason, "queue_timeout")
+
+        lane.release()
+
+    async def test_rate_limited(self):
+        lane = make_lane(rate=0.5, burst=1, concurrency=10)
+
+        await lane.acquire("a")
+
+        with self.assertRaises(Rejected) as cm:
+            await lane.acquire("a")
+
+        self.assertEqual(cm.exception.status_code, 429)
+        self.assertAlmostEqual(cm.exception.retry_after, 2, delta=0.1)
+
+
+class TestAdmissionMiddleware(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.release = asyncio.Event()
+        app = FastAPI()
+
+        @app.get("/expensive")
+        async def expensive():
+            await self.release.wait()
+            return "done"
+
+        @app.get("/cheap")
+        async def cheap():
+            return "done"
+
+        app.add_middleware(AdmissionMiddleware, lanes={"test": dict(
+            paths=("/expensive",), concurrency=1, queue_size=0, queue_timeout=1.0, rate=0, burst=1,
+        )})
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def test_busy_lane_sheds_but_cheap_routes_pass(self):
+        first = asyncio.ensure_future(self.client.get("/expensive"))
+        await asyncio.sleep(0.01)
+
+        shed = await self.client.get("/expensive")
+        cheap = await self.client.get("/cheap")
+
+        self.assertEqual(shed.status_code, 503)
+        self.assertEqual(shed.headers["Retry-After"], "1")
+        self.assertEqual(cheap.status_code, 200)
+
+        self.release.set()
+        self.assertEqual((await first).status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
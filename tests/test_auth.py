@@ -0,0 +1,71 @@
+import asyncio
+import base64
+import json
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from httpx import Response
+
+from app import auth
+
+
+def make_token(exp: float) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({"exp": exp}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+class TestAuth(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await auth.clear_auth_cache()
+
+    @patch("app.auth.get_client_for_url")
+    async def test_valid_token_is_cached(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            return_value=Response(200, json=True)
+        )
+
+        self.assertTrue(await auth.is_token_valid("token"))
+        self.assertTrue(await auth.is_token_valid("token"))
+
+        mock_get.assert_awaited_once()
+
+    @patch("app.auth.get_client_for_url")
+    async def test_concurrent_verifications_are_collapsed(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            return_value=Response(200, json=True)
+        )
+
+        results = await asyncio.gather(*(auth.is_token_valid("token") for _ in range(10)))
+
+        self.assertTrue(all(results))
+        mock_get.assert_awaited_once()
+
+    @patch("app.auth.get_client_for_url")
+    async def test_upstream_errors_are_not_cached(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(return_value=Response(503))
+
+        self.assertFalse(await auth.is_token_valid("token"))
+        self.assertFalse(await auth.is_token_valid("token"))
+
+        self.assertEqual(mock_get.await_count, 2)
+
+    @patch("app.auth.get_client_for_url")
+    async def test_get_user_id(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            return_value=Response(200, text="user-1")
+        )
+
+        self.assertEqual(await auth.get_user_id("token"), "user-1")
+        self.assertEqual(await auth.get_user_id("token"), "user-1")
+
+        mock_get.assert_awaited_once()
+
+    def test_token_ttl_follows_expiry(self):
+        self.assertLessEqual(auth._token_ttl(make_token(time.time() + 10)), 10)
+        self.assertLessEqual(auth._token_ttl(make_token(time.time() - 10)), 0)
+        self.assertEqual(auth._token_ttl("opaque-token"), auth.AUTH_CACHE_TTL)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,29 @@
+import os
+import tempfile
+import unittest
+
+from benchmarks.run import main
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_smoke_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, "results.json")
+
+            report = main([
+                "--requests", "4",
+                "--concurrency", "2",
+                "--images", "1",
+                "--image-bytes", "1024",
+                "--llm-latency", "0",
+                "--geocoder-latency", "0",
+                "--output", output,
+            ])
+
+            self.assertTrue(os.path.exists(output))
+
+        self.assertEqual(len(report["scenarios"]), 7)
+
+        for result in report["scenarios"]:
+            self.assertEqual(result["errors"], 0, result["name"])
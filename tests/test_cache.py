@@ -0,0 +1,137 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from app.cache import SingleFlight, TTLCache
+from app.deadlines import deadline_var
+
+
+class TestTTLCache(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+
+        # Touch "a" so "b" becomes the least recently used entry
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    @patch("app.cache.time.monotonic")
+    def test_expiry(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=5)
+
+        mock_monotonic.return_value = 110.0
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertNotIn("b", cache)
+
+    def test_ttl_is_capped(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        cache.set("a", 1, ttl=-1)
+
+        self.assertNotIn("a", cache)
+
+    def test_max_bytes_eviction(self):
+        cache = TTLCache(maxsize=10, ttl=60, max_bytes=10, sizeof=len)
+        cache.set("a", "x" * 4)
+        cache.set("b", "x" * 4)
+        cache.set("c", "x" * 4)
+
+        # "a" is evicted to stay under 10 bytes, oversized values are not stored
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.size_bytes, 8)
+
+        cache.set("d", "x" * 11)
+
+        self.assertNotIn("d", cache)
+        self.assertEqual(cache.size_bytes, 8)
+
+
+class TestSingleFlight(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_calls_are_collapsed(self):
+        single_flight = SingleFlight()
+        calls = 0
+
+        async def func():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*(single_flight.do("key", func) for _ in range(5)))
+
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(calls, 1)
+        self.assertEqual(len(single_flight), 0)
+
+    async def test_shared_call_has_no_deadline(self):
+        single_flight = SingleFlight()
+        deadlines = []
+
+        async def func():
+            deadlines.append(deadline_var.get())
+            await asyncio.sleep(0.01)
+
+        # Mock a leader with a short deadline
+        token = deadline_var.set(0.0)
+        try:
+            await single_flight.do("key", func)
+        finally:
+            deadline_var.reset(token)
+
+        self.assertEqual(deadlines, [None])
+
+    async def test_result_nobody_waited_for_is_discarded(self):
+        single_flight = SingleFlight()
+        release = asyncio.Event()
+        discarded = []
+
+        async def func():
+            await release.wait()
+            return "response"
+
+        async def discard(result):
+            discarded.append(result)
+
+        callers = [asyncio.ensure_future(single_flight.do("key", func, discard)) for _ in range(3)]
+        await asyncio.sleep(0)
+
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+
+        release.set()
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(discarded, ["response"])
+
+    async def test_result_taken_by_a_caller_is_not_discarded(self):
+        single_flight = SingleFlight()
+        release = asyncio.Event()
+        discard = AsyncMock()
+
+        async def func():
+            await release.wait()
+            return "response"
+
+        cancelled = asyncio.ensure_future(single_flight.do("key", func, discard))
+        waiting = asyncio.ensure_future(single_flight.do("key", func, discard))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+
+        release.set()
+
+        self.assertEqual(await waiting, "response")
+        await asyncio.sleep(0.01)
+        discard.assert_not_awaited()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+import asyncio
+import fnmatch
+import time
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from app import cache_backends
+from app.cache_backends import (Codec, InvalidationBus, LocalCache, RedisCache,
+                                TwoTierCache, make_cache)
+from app.serialization import dumps
+
+
+class FakeRedis:
+    """The few Redis commands the cache uses, kept in a dict"""
+
+    def __init__(self):
+        self.data = {}
+        self.published = []
+
+    async def get(self, key):
+        value, expires_at = self.data.get(key, (None, 0))
+        return value if expires_at > time.monotonic() else None
+
+    async def set(self, key, value, px):
+        self.data[key] = (value, time.monotonic() + px / 1000)
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    async def scan_iter(self, match):
+        for key in list(self.data):
+            if fnmatch.fnmatch(key, match):
+                yield key
+
+    async def publish(self, channel, message):
+        self.published.append((channel, message))
+
+
+class TestRedisCache(unittest.IsolatedAsyncioTestCase):
+    async def test_values_round_trip_through_the_codec(self):
+        client = FakeRedis()
+        cache = RedisCache(client, "geocode", ttl=60, codec=Codec(
+            cache_backends.JSON_CODEC.encode, lambda raw: tuple(cache_backends.JSON_CODEC.decode(raw))
+        ))
+
+        await cache.set(("Main St 1", None), (8.5, 47.3))
+
+        self.assertEqual(await cache.get(("Main St 1", None)), (8.5, 47.3))
+        self.assertIsNone(await cache.get("other"))
+
+        await cache.clear()
+
+        self.assertEqual(client.data, {})
+
+    async def test_ttl_is_capped_and_expired_entries_are_skipped(self):
+        client = FakeRedis()
+        client.set = AsyncMock()
+        cache = RedisCache(client, "auth", ttl=60)
+
+        await cache.set("token", True, ttl=600)
+        await cache.set("expired", True, ttl=-1)
+
+        client.set.assert_awaited_once()
+        self.assertEqual(client.set.await_args.kwargs["px"], 60000)
+
+    async def test_errors_are_misses(self):
+        client = MagicMock()
+        client.get = AsyncMock(side_effect=ConnectionRefusedError())
+        client.set = AsyncMock(side_effect=ConnectionRefusedError())
+        cache = RedisCache(client, "auth", ttl=60)
+
+        await cache.set("token", True)
+
+        self.assertIsNone(await cache.get("token"))
+        self.assertGreaterEqual(cache_backends.CACHE_BACKEND_ERRORS.value("auth", "get"), 1)
+
+    async def test_values_that_do_not_decode_are_misses(self):
+        client = FakeRedis()
+        cache = RedisCache(client, "geocode", ttl=60, codec=Codec(
+            cache_backends.JSON_CODEC.encode, lambda raw: tuple(cache_backends.JSON_CODEC.decode(raw))
+        ))
+
+        # Mock a corrupt entry and one the codec can't turn back into a value
+        await client.set(cache_backends._redis_key("geocode", "corrupt"), b"{not json", px=60000)
+        await client.set(cache_backends._redis_key("geocode", "null"), b"null", px=60000)
+
+        self.assertIsNone(await cache.get("corrupt"))
+        self.assertIsNone(await cache.get("null"))
+        self.assertEqual(cache_backends.CACHE_BACKEND_ERRORS.value("geocode", "decode"), 2)
+
+
+class TestTwoTierCache(unittest.IsolatedAsyncioTestCase):
+    def replica(self, client):
+        bus = InvalidationBus(client, channel="invalidate")
+        cache = TwoTierCache("llm", LocalCache(100, 60), RedisCache(client, "llm", ttl=60), near_ttl=30, bus=bus)
+
+        return cache, bus
+
+    async def test_shared_entries_are_kept_near(self):
+        client = FakeRedis()
+        first, _ = self.replica(client)
+        second, _ = self.replica(client)
+
+        await first.set("flat zurich", "query")
+
+        client.get = AsyncMock(wraps=client.get)
+        self.assertEqual(await second.get("flat zurich"), "query")
+        self.assertEqual(await second.get("flat zurich"), "query")
+
+        client.get.assert_awaited_once()
+
+    async def test_writes_drop_the_near_copies_of_other_replicas(self):
+        client = FakeRedis()
+        first, first_bus = self.replica(client)
+        second, second_bus = self.replica(client)
+
+        await first.set("flat zurich", "old")
+        self.assertEqual(await second.get("flat zurich"), "old")
+
+        await first.set("flat zurich", "new")
+
+        # Deliver the broadcasts as the subscriber task would
+        for _, message in client.published:
+            await first_bus.handle(message)
+            await second_bus.handle(message)
+
+        self.assertEqual(await second.get("flat zurich"), "new")
+
+        await first.delete("flat zurich")
+        await second_bus.handle(client.published[-1][1])
+
+        self.assertIsNone(await second.get("flat zurich"))
+
+    async def test_malformed_broadcasts_are_skipped(self):
+        client = FakeRedis()
+        first, first_bus = self.replica(client)
+        second, second_bus = self.replica(client)
+
+        await first.set("flat zurich", "old")
+        self.assertEqual(await second.get("flat zurich"), "old")
+        await first.set("flat zurich", "new")
+
+        for data in (b"{not json", b"[]", b"null"):
+            await second_bus.handle(data)
+        await second_bus.handle(client.published[-1][1])
+
+        self.assertEqual(await second.get("flat zurich"), "new")
+
+    async def test_listener_survives_a_bad_message(self):
+        messages = [dict(type="subscribe", data=1)] + [
+            dict(type="message", data=data) for data in (
+                b"{not json",
+                dumps(dict(sender="other", namespace="llm", key="boom")),
+                dumps(dict(sender="other", namespace="llm", key="flat zurich")),
+            )
+        ]
+
+        async def listen():
+            for message in messages:
+                yield message
+            # Mock the subscription staying open
+            await asyncio.Event().wait()
+
+        pubsub = MagicMock()
+        pubsub.subscribe = AsyncMock()
+        pubsub.aclose = AsyncMock()
+        pubsub.listen = listen
+        client = MagicMock()
+        client.pubsub.return_value = pubsub
+        bus = InvalidationBus(client, channel="invalidate")
+        dropped = []
+
+        async def drop(key):
+            if key == "boom":
+                raise RuntimeError(key)
+            dropped.append(key)
+
+        bus.subscribe("llm", drop)
+        bus.start()
+        await asyncio.sleep(0.01)
+        await bus.stop()
+
+        self.assertEqual(dropped, ["flat zurich"])
+
+
+class TestMakeCache(unittest.TestCase):
+    def test_local_unless_shared_and_configured(self):
+        self.assertIsInstance(make_cache("auth", 10, 60, backend="local"), LocalCache)
+        self.assertIsInstance(make_cache("response", 10, 60, shared=False, backend="two_tier"), LocalCache)
+
+    @patch("app.cache_backends.REDIS_AVAILABLE", False)
+    def test_redis_backend_without_redis_fails(self):
+        with self.assertRaises(RuntimeError):
+            make_cache("auth", 10, 60, backend="two_tier")
+
+        self.assertIsInstance(make_cache("response", 10, 60, shared=False, backend="two_tier"), LocalCache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+from app import clients
+from app.config import GEOLOCATION_SERVICE_URL, INVENTORY_SERVICE_URL, UPSTREAM_SETTINGS
+
+
+class TestClients(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self):
+        await clients.close_clients()
+
+    async def test_get_client_reuses_pool(self):
+        client = clients.get_client(INVENTORY_SERVICE_URL)
+
+        # The same pool is returned for every call to the same upstream
+        self.assertIs(client, clients.get_client(INVENTORY_SERVICE_URL))
+        self.assertEqual(str(client.base_url), f"http://{INVENTORY_SERVICE_URL}")
+
+    async def test_get_client_for_url(self):
+        client = clients.get_client_for_url(f"https://{GEOLOCATION_SERVICE_URL}/v1/search")
+
+        self.assertIs(client, clients.get_client(GEOLOCATION_SERVICE_URL))
+        self.assertEqual(str(client.base_url), f"https://{GEOLOCATION_SERVICE_URL}")
+
+    async def test_geolocation_uses_http2(self):
+        clients.get_client(GEOLOCATION_SERVICE_URL)
+        clients.get_client(INVENTORY_SERVICE_URL)
+
+        self.assertTrue(clients.HTTP2_AVAILABLE)
+        self.assertTrue(clients._http_transports[GEOLOCATION_SERVICE_URL]._pool._http2)
+        self.assertFalse(clients._http_transports[INVENTORY_SERVICE_URL]._pool._http2)
+
+    async def test_open_and_close_clients(self):
+        await clients.open_clients()
+
+        opened = [clients.get_client(upstream) for upstream in UPSTREAM_SETTINGS]
+
+        await clients.close_clients()
+
+        # Closed pools are not handed out again
+        self.assertTrue(all(client.is_closed for client in opened))
+        self.assertIsNot(opened[0], clients.get_client(INVENTORY_SERVICE_URL))
+
+
+if __name__ == "__main__":
+    unittest.main()
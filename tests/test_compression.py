@@ -0,0 +1,113 @@
+import gzip
+import unittest
+from unittest.mock import patch
+
+import httpx
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+
+from app import compression
+from app.compression import CompressionMiddleware
+
+
+class TestNegotiation(unittest.TestCase):
+
+    def test_accepted_encodings(self):
+        self.assertEqual(
+            compression.accepted_encodings("gzip, deflate;q=0.5, br;q=0"), {"gzip", "deflate"}
+        )
+        self.assertEqual(compression.accepted_encodings(None), set())
+
+    def test_accepts(self):
+        self.assertTrue(compression.accepts("gzip", "gzip"))
+        self.assertTrue(compression.accepts(None, "identity"))
+        self.assertTrue(compression.accepts("*", "br"))
+        self.assertFalse(compression.accepts("br", "gzip"))
+
+    def test_negotiate_body_decodes_only_when_needed(self):
+        headers = httpx.Headers({"Content-Encoding": "gzip", "Content-Length": "99"})
+        body = gzip.compress(b"listing")
+
+        self.assertEqual(compression.negotiate_body(body, headers, "gzip"), (body, headers))
+
+        decoded, decoded_headers = compression.negotiate_body(body, headers, None)
+        self.assertEqual(decoded, b"listing")
+        self.assertNotIn("content-encoding", decoded_headers)
+        self.assertNotIn("content-length", decoded_headers)
+
+    def test_unknown_encoding_is_passed_on_only_when_accepted(self):
+        headers = httpx.Headers({"Content-Encoding": "zstd"})
+
+        self.assertEqual(compression.negotiate_body(b"data", headers, "zstd"), (b"data", headers))
+
+        with self.assertRaises(HTTPException) as ctx:
+            compression.negotiate_body(b"data", headers, "gzip")
+
+        self.assertEqual(ctx.exception.status_code, 502)
+
+    @patch("app.compression.BROTLI_AVAILABLE", False)
+    def test_brotli_is_not_passed_to_clients_without_support(self):
+        headers = httpx.Headers({"Content-Encoding": "br"})
+
+        with self.assertRaises(HTTPException) as ctx:
+            compression.negotiate_body(b"data", headers, "gzip")
+
+        self.assertEqual(ctx.exception.status_code, 502)
+
+    @patch("app.compression.DECODABLE_ENCODINGS", ("gzip", "deflate"))
+    def test_upstreams_are_only_asked_for_decodable_encodings(self):
+        self.assertEqual(compression.upstream_accept_encoding("gzip, br, zstd"), "gzip")
+        self.assertEqual(compression.upstream_accept_encoding("*"), "gzip, deflate")
+        self.assertEqual(compression.upstream_accept_encoding("br"), "identity")
+        self.assertEqual(compression.upstream_accept_encoding(None), "identity")
+
+
+class TestCompressionMiddleware(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        app = FastAPI()
+
+        @app.get("/large")
+        async def large():
+            return {"properties": ["x" * 100] * 50}
+
+        @app.get("/small")
+        async def small():
+            return {"properties": []}
+
+        @app.get("/other")
+        async def other():
+            return {"properties": ["x" * 100] * 50}
+
+        @app.get("/streamed")
+        async def streamed():
+            return StreamingResponse(iter([b"x" * 2000, b"y" * 2000]))
+
+        app.add_middleware(CompressionMiddleware, routes=("/large", "/small", "/streamed"))
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def test_large_bodies_are_compressed(self):
+        res = await self.client.get("/large", headers={"Accept-Encoding": "gzip"})
+
+        self.assertEqual(res.headers["content-encoding"], "gzip")
+        self.assertEqual(res.headers["vary"], "Accept-Encoding")
+        self.assertLess(int(res.headers["content-length"]), 5000)
+        self.assertEqual(len(res.json()["properties"]), 50)
+
+    async def test_not_compressed_when_not_accepted(self):
+        res = await self.client.get("/large", headers={"Accept-Encoding": "identity"})
+
+        self.assertNotIn("content-encoding", res.headers)
+
+    async def test_small_other_and_streamed_bodies_are_left_alone(self):
+        for path in ("/small", "/other", "/streamed"):
+            res = await self.client.get(path, headers={"Accept-Encoding": "gzip"})
+
+            self.assertNotIn("content-encoding", res.headers, path)
+
+
+if __name__ == "__main__":
+    unittest.main()
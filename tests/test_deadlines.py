@@ -0,0 +1,143 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from app import deadlines
+from app.deadlines import DeadlineMiddleware, REQUESTS_CANCELLED
+
+
+def make_scope(path="/initial_query", method="GET", headers=()):
+    return {"type": "http", "method": method, "path": path, "headers": list(headers)}
+
+
+class TestDeadlines(unittest.IsolatedAsyncioTestCase):
+    def test_request_timeout(self):
+        routes = {"/initial_query": 40.0}
+
+        self.assertEqual(deadlines.request_timeout(make_scope(), routes), 40.0)
+        self.assertEqual(deadlines.request_timeout(make_scope("/getUserId"), routes), deadlines.DEADLINE_DEFAULT)
+        self.assertEqual(
+            deadlines.request_timeout(make_scope(headers=[(b"x-request-timeout", b"2.5")]), routes), 2.5
+        )
+        self.assertEqual(
+            deadlines.request_timeout(make_scope(headers=[(b"x-request-timeout", b"0.05")]), routes),
+            deadlines.DEADLINE_MIN,
+        )
+        self.assertEqual(
+            deadlines.request_timeout(make_scope(headers=[(b"x-request-timeout", b"99999")]), routes),
+            deadlines.DEADLINE_MAX,
+        )
+        self.assertEqual(
+            deadlines.request_timeout(make_scope(headers=[(b"x-request-timeout", b"soon")]), routes), 40.0
+        )
+
+    async def test_upstream_gets_the_time_left(self):
+        request = httpx.Request("GET", "http://inventory-service/properties")
+        request.extensions["timeout"] = {"connect": 2.0, "read": 5.0, "write": 5.0, "pool": 5.0}
+        token = deadlines.deadline_var.set(time.monotonic() + 3)
+
+        try:
+            await deadlines.apply_deadline(request)
+        finally:
+            deadlines.deadline_var.reset(token)
+
+        self.assertLessEqual(float(request.headers["X-Request-Timeout"]), 3)
+        self.assertEqual(request.extensions["timeout"]["connect"], 2.0)
+        self.assertLessEqual(request.extensions["timeout"]["read"], 3)
+        self.assertTrue(request.extensions[deadlines.DEADLINE_BOUND])
+
+    async def test_expired_deadline_is_not_sent_upstream(self):
+        request = httpx.Request("GET", "http://inventory-service/properties")
+        token = deadlines.deadline_var.set(time.monotonic() - 1)
+
+        try:
+            with self.assertRaises(httpx.TimeoutException):
+                await deadlines.apply_deadline(request)
+        finally:
+            deadlines.deadline_var.reset(token)
+
+        # Without a deadline nothing changes
+        await deadlines.apply_deadline(request)
+        self.assertNotIn("X-Request-Timeout", request.headers)
+
+
+class TestDeadlineMiddleware(unittest.IsolatedAsyncioTestCase):
+    async def call(self, app, scope, messages):
+        sent = []
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            # Mock a client that stays connected
+            await asyncio.Event().wait()
+
+        async def send(message):
+            sent.append(message)
+
+        await DeadlineMiddleware(app, routes={})(scope, receive, send)
+
+        return sent
+
+    async def test_request_body_reaches_the_app(self):
+        async def app(scope, receive, send):
+            body = b""
+            while True:
+                message = await receive()
+                body += message.get("body", b"")
+                if not message.get("more_body"):
+                    break
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": body})
+
+        sent = await self.call(app, make_scope(method="POST", headers=[(b"content-length", b"4")]), [
+            {"type": "http.request", "body": b"ab", "more_body": True},
+            {"type": "http.request", "body": b"cd", "more_body": False},
+        ])
+
+        self.assertEqual(sent[-1]["body"], b"abcd")
+
+    async def test_slow_request_is_cancelled_at_its_deadline(self):
+        cancelled = asyncio.Event()
+        before = REQUESTS_CANCELLED.value("deadline")
+
+        async def app(scope, receive, send):
+            self.assertIsNotNone(deadlines.remaining())
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        sent = await self.call(app, make_scope(headers=[(b"x-request-timeout", b"0.05")]), [
+            {"type": "http.request", "body": b"", "more_body": False},
+        ])
+
+        self.assertTrue(cancelled.is_set())
+        self.assertEqual(sent[0]["status"], 504)
+        self.assertEqual(REQUESTS_CANCELLED.value("deadline"), before + 1)
+
+    async def test_disconnect_cancels_the_request(self):
+        cancelled = asyncio.Event()
+        before = REQUESTS_CANCELLED.value("disconnect")
+
+        async def app(scope, receive, send):
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        sent = await self.call(app, make_scope(), [
+            {"type": "http.request", "body": b"", "more_body": False},
+            {"type": "http.disconnect"},
+        ])
+
+        self.assertTrue(cancelled.is_set())
+        self.assertEqual(sent[0]["status"], 499)
+        self.assertEqual(REQUESTS_CANCELLED.value("disconnect"), before + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpcore
+
+from app import dns
+
+
+class TestDnsCache(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        dns.clear_dns_cache()
+
+    async def test_lookups_are_cached(self):
+        infos = [(2, 1, 6, "", ("10.0.0.1", 80)), (2, 1, 6, "", ("10.0.0.1", 80))]
+
+        with patch("asyncio.BaseEventLoop.getaddrinfo", new_callable=AsyncMock, return_value=infos) as mock_lookup:
+            self.assertEqual(await dns.resolve("inventory-service", 80), ["10.0.0.1"])
+            self.assertEqual(await dns.resolve("inventory-service", 80), ["10.0.0.1"])
+            self.assertEqual(await dns.resolve("10.0.0.2", 80), ["10.0.0.2"])
+
+        mock_lookup.assert_awaited_once()
+
+    async def test_lookup_failure_is_a_connect_error(self):
+        with patch("asyncio.BaseEventLoop.getaddrinfo", new_callable=AsyncMock, side_effect=OSError("nxdomain")):
+            with self.assertRaises(httpcore.ConnectError):
+                await dns.resolve("missing-service", 80)
+
+    @patch("app.dns.resolve", new_callable=AsyncMock, return_value=["10.0.0.1", "10.0.0.2"])
+    async def test_backend_tries_the_next_address(self, mock_resolve):
+        stream = MagicMock()
+        inner = MagicMock()
+        inner.connect_tcp = AsyncMock(side_effect=[httpcore.ConnectError("refused"), stream])
+
+        result = await dns.CachingNetworkBackend(inner).connect_tcp("inventory-service", 80, timeout=1)
+
+        self.assertIs(result, stream)
+        self.assertEqual([call.args[0] for call in inner.connect_tcp.await_args_list], ["10.0.0.1", "10.0.0.2"])
+
+    @patch("app.dns.forget")
+    @patch("app.dns.resolve", new_callable=AsyncMock, return_value=["10.0.0.1"])
+    async def test_unreachable_host_is_looked_up_again(self, mock_resolve, mock_forget):
+        inner = MagicMock()
+        inner.connect_tcp = AsyncMock(side_effect=httpcore.ConnectError("refused"))
+
+        with self.assertRaises(httpcore.ConnectError):
+            await dns.CachingNetworkBackend(inner).connect_tcp("inventory-service", 80)
+
+        mock_forget.assert_called_once_with("inventory-service", 80)
+
+
+if __name__ == "__main__":
+    unittest.main()
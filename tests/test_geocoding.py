@@ -0,0 +1,80 @@
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from httpx import Response
+
+from app import geocoding
+
+
+class TestGeocoding(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await geocoding.clear_geocode_cache()
+
+    @patch("app.geocoding._rate_limiter", geocoding.RateLimiter(1000))
+    @patch("app.geocoding.get_client_for_url")
+    async def test_geocode_is_cached_by_normalized_address(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            return_value=Response(200, json=[{"lon": "8.54", "lat": "47.37"}])
+        )
+
+        self.assertEqual(await geocoding.geocode("Bahnhofstrasse 1", "Zurich"), (8.54, 47.37))
+        self.assertEqual(await geocoding.geocode("bahnhofstrasse  1,", "ZURICH "), (8.54, 47.37))
+
+        mock_get.assert_awaited_once()
+
+    @patch("app.geocoding._rate_limiter", geocoding.RateLimiter(1000))
+    @patch("app.geocoding.get_client_for_url")
+    async def test_geocode_retries_when_throttled(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(side_effect=[
+            Response(429),
+            Response(200, json=[{"lon": "8.54", "lat": "47.37"}]),
+        ])
+
+        self.assertEqual(await geocoding.geocode("Bahnhofstrasse 1", "Zurich"), (8.54, 47.37))
+        self.assertEqual(mock_get.await_count, 2)
+
+    @patch("app.geocoding._rate_limiter", geocoding.RateLimiter(1000))
+    @patch("app.geocoding.get_client_for_url")
+    async def test_geocode_failure(self, mock_get_client):
+        mock_get_client.return_value.get = AsyncMock(return_value=Response(404))
+
+        self.assertIsNone(await geocoding.geocode("Nowhere", "Atlantis"))
+
+    @patch("app.geocoding._rate_limiter", geocoding.RateLimiter(1000))
+    @patch("app.geocoding.get_client_for_url")
+    async def test_address_without_match(self, mock_get_client):
+        mock_get_client.return_value.get = AsyncMock(return_value=Response(200, json=[]))
+
+        with self.assertRaises(geocoding.AddressNotFoundError):
+            await geocoding.geocode("Nowhere", "Atlantis")
+
+    async def test_rate_limiter_spaces_calls(self):
+        rate_limiter = geocoding.RateLimiter(100)
+
+        start = time.monotonic()
+        for _ in range(3):
+            await rate_limiter.acquire()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.02)
+
+    async def test_rate_limiter_without_a_rate_does_not_wait(self):
+        for rate in (0, -1):
+            rate_limiter = geocoding.RateLimiter(rate)
+
+            start = time.monotonic()
+            for _ in range(3):
+                await rate_limiter.acquire()
+
+            self.assertEqual(rate_limiter.interval, 0)
+            self.assertLess(time.monotonic() - start, 0.01)
+
+    def test_is_same_address(self):
+        current = {"address": "Bahnhofstrasse 1", "location": "Zurich"}
+
+        self.assertTrue(geocoding.is_same_address(current, {"address": "bahnhofstrasse 1 ", "location": "zurich"}))
+        self.assertFalse(geocoding.is_same_address(current, {"address": "Bahnhofstrasse 2", "location": "Zurich"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
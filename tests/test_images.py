@@ -0,0 +1,91 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import httpx
+from httpx import Response
+
+from app import images
+from app.config import IMAGE_SERVICE_URL, INVENTORY_SERVICE_URL
+from app.proxy_cache import invalidate_responses
+
+
+class TestPrimaryImages(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await images.clear_primary_image_cache()
+
+    @patch("app.images.get_client_for_url")
+    async def test_urls_are_added_and_cached(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            side_effect=lambda url, params: Response(200, text=f"img/{params['propertyId']}")
+        )
+        result = {"properties": [{"propertyId": 1}, {"propertyId": 2}]}
+
+        await images.add_primary_image_urls(result)
+        await images.add_primary_image_urls({"properties": [{"propertyId": 1}]})
+
+        self.assertEqual(
+            [item["primaryImageUrl"] for item in result["properties"]], ["img/1", "img/2"]
+        )
+        self.assertEqual(mock_get.await_count, 2)
+
+    @patch("app.images.get_client_for_url")
+    async def test_missing_image_is_cached_as_none(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(return_value=Response(404))
+
+        self.assertIsNone(await images.get_primary_image_url(1))
+        self.assertIsNone(await images.get_primary_image_url(1))
+
+        mock_get.assert_awaited_once()
+
+    @patch("app.images.get_client_for_url")
+    async def test_failures_do_not_fail_the_search(self, mock_get_client):
+        mock_get_client.return_value.get = AsyncMock(side_effect=[
+            Response(200, text="img/1"), httpx.ConnectError("down"),
+        ])
+        result = [{"propertyId": 1}, {"propertyId": 2}]
+
+        await images.add_primary_image_urls(result)
+
+        self.assertEqual([item["primaryImageUrl"] for item in result], ["img/1", None])
+
+    @patch("app.images.get_client_for_url")
+    async def test_image_service_writes_forget_the_property(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            side_effect=lambda url, params: Response(200, text=f"img/{params['propertyId']}")
+        )
+        await images.add_primary_image_urls([{"propertyId": 1}, {"propertyId": 2}])
+
+        await invalidate_responses(INVENTORY_SERVICE_URL)
+        await invalidate_responses(IMAGE_SERVICE_URL, dict(propertyId="1"))
+        await images.add_primary_image_urls([{"propertyId": 1}, {"propertyId": 2}])
+
+        self.assertEqual([call.kwargs["params"]["propertyId"] for call in mock_get.await_args_list], [1, 2, 1])
+
+        await invalidate_responses(IMAGE_SERVICE_URL)
+        await images.add_primary_image_urls([{"propertyId": 1}, {"propertyId": 2}])
+
+        self.assertEqual(mock_get.await_count, 5)
+
+    @patch("app.images.IMAGE_ENRICHMENT_CONCURRENCY", 2)
+    @patch("app.images.get_client_for_url")
+    async def test_fan_out_is_bounded(self, mock_get_client):
+        in_flight = peak = 0
+
+        async def get(url, params):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return Response(200, text="img")
+
+        mock_get_client.return_value.get = get
+
+        await images.add_primary_image_urls([{"propertyId": i} for i in range(6)])
+
+        self.assertEqual(peak, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
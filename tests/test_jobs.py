@@ -0,0 +1,198 @@
+import asyncio
+import io
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import httpx
+from starlette.datastructures import Headers, UploadFile
+
+from app import jobs
+from app.geocoding import AddressNotFoundError
+
+
+def _image(name: str, content: bytes) -> UploadFile:
+    return UploadFile(
+        io.BytesIO(content), filename=name, headers=Headers({"content-type": "image/png"})
+    )
+
+
+class TestCreatePropertyJobs(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.store = jobs.JobStore(self.tmp.name)
+
+        patcher = patch("app.jobs._store", self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.store._db.close()
+        self.tmp.cleanup()
+
+    async def _enqueue(self, images=()):
+        return await jobs.enqueue_create_property(
+            7, {"address": "Main St 1", "location": "Town", "price": 100}, list(images)
+        )
+
+    @patch("app.jobs.async_upload_file", new_callable=AsyncMock, return_value="ok")
+    @patch("app.jobs.async_post_data", new_callable=AsyncMock, return_value={"propertyId": 42})
+    @patch("app.jobs.geocode", new_callable=AsyncMock, return_value=(1.5, 2.5))
+    async def test_job_creates_property_and_uploads_images(self, mock_geocode, mock_post, mock_upload):
+        job_id = await self._enqueue([_image("a.png", b"aaa"), _image("b.png", b"bbbb")])
+
+        # Images are spooled to disk before the request returns
+        self.assertEqual(len(os.listdir(self.store.spool_dir(job_id))), 2)
+
+        await jobs.run_job(job_id)
+
+        job = await jobs.get_job(job_id)
+        self.assertEqual(job["status"], jobs.SUCCEEDED)
+        self.assertEqual(job["owner"], "7")
+        self.assertEqual(job["result"]["propertyId"], 42)
+        self.assertEqual([image["uploaded"] for image in job["result"]["images"]], [True, True])
+
+        inventory_data = mock_post.await_args.args[1]
+        self.assertEqual((inventory_data["longitude"], inventory_data["latitude"]), (1.5, 2.5))
+
+        primary = {call.args[1].filename: call.kwargs["params"]["primary"] for call in mock_upload.await_args_list}
+        self.assertEqual(primary, {"a.png": True, "b.png": False})
+        self.assertFalse(os.path.exists(self.store.spool_dir(job_id)))
+
+    @patch("app.jobs.async_upload_file", new_callable=AsyncMock)
+    @patch("app.jobs.async_post_data", new_callable=AsyncMock, return_value={"propertyId": 42})
+    @patch("app.jobs.geocode", new_callable=AsyncMock, return_value=(1.5, 2.5))
+    async def test_retry_resumes_after_the_last_finished_step(self, mock_geocode, mock_post, mock_upload):
+        # Mock the second image failing once
+        mock_upload.side_effect = ["ok", httpx.ConnectError("down"), "ok"]
+        job_id = await self._enqueue([_image("a.png", b"aaa"), _image("b.png", b"bbbb")])
+
+        await jobs.run_job(job_id)
+
+        job = await jobs.get_job(job_id)
+        self.assertEqual(job["status"], jobs.QUEUED)
+        self.assertIn("images [1]", job["error"])
+
+        # Due immediately instead of after the backoff
+        self.store._execute("UPDATE jobs SET not_before = 0 WHERE id = ?", (job_id,))
+        await jobs.run_job(job_id)
+
+        job = await jobs.get_job(job_id)
+        self.assertEqual(job["status"], jobs.SUCCEEDED)
+        self.assertEqual(job["attempts"], 2)
+        mock_geocode.assert_awaited_once()
+        mock_post.assert_awaited_once()
+        self.assertEqual(mock_upload.await_count, 3)
+
+    @patch("app.jobs.geocode", new_callable=AsyncMock, side_effect=AddressNotFoundError("Main St 1 Town"))
+    async def test_unknown_address_fails_without_retrying(self, mock_geocode):
+        job_id = await self._enqueue()
+
+        await jobs.run_job(job_id)
+
+        job = await jobs.get_job(job_id)
+        self.assertEqual(job["status"], jobs.FAILED)
+        self.assertEqual(job["error"], "Address not found.")
+        self.assertEqual(job["attempts"], 1)
+
+    @patch("app.jobs.JOB_MAX_ATTEMPTS", 1)
+    @patch("app.jobs.geocode", new_callable=AsyncMock, return_value=None)
+    async def test_job_fails_after_max_attempts(self, mock_geocode):
+        job_id = await self._enqueue([_image("a.png", b"aaa")])
+
+        await jobs.run_job(job_id)
+
+        job = await jobs.get_job(job_id)
+        self.assertEqual(job["status"], jobs.FAILED)
+        self.assertEqual(job["error"], "Couldn't fetch coordinates of a location.")
+        self.assertIsNone(job["result"]["propertyId"])
+        self.assertFalse(os.path.exists(self.store.spool_dir(job_id)))
+
+    @patch("app.jobs.async_post_data", new_callable=AsyncMock, return_value={"id": 42})
+    @patch("app.jobs.geocode", new_callable=AsyncMock, return_value=(1.5, 2.5))
+    async def test_unexpected_errors_fail_the_job(self, mock_geocode, mock_post):
+        # Mock the inventory answering without a propertyId
+        job_id = await self._enqueue([_image("a.png", b"aaa")])
+
+        await jobs.run_job(job_id)
+
+        job = await jobs.get_job(job_id)
+        self.assertEqual(job["status"], jobs.FAILED)
+        self.assertIn("KeyError", job["error"])
+        self.assertFalse(os.path.exists(self.store.spool_dir(job_id)))
+
+    @patch("app.jobs.JOB_LEASE", 0.09)
+    @patch("app.jobs.async_post_data", new_callable=AsyncMock, return_value={"propertyId": 42})
+    @patch("app.jobs.geocode", new_callable=AsyncMock)
+    async def test_lease_is_renewed_while_a_step_runs(self, mock_geocode, mock_post):
+        job_id = await self._enqueue()
+        leases = []
+
+        # Mock geocoding taking longer than the lease
+        async def slow_geocode(address, location):
+            await asyncio.sleep(0.3)
+            leases.append(self.store.get(job_id)["lease_until"] - time.time())
+            return 1.5, 2.5
+
+        mock_geocode.side_effect = slow_geocode
+
+        await jobs.run_job(job_id)
+
+        self.assertGreater(leases[0], 0)
+        self.assertEqual((await jobs.get_job(job_id))["status"], jobs.SUCCEEDED)
+
+    async def test_running_job_is_claimed_again_only_after_its_lease(self):
+        job_id = await self._enqueue()
+
+        self.assertIsNotNone(self.store.claim(job_id, lease=60))
+        self.assertIsNone(self.store.claim(job_id, lease=60))
+        self.assertEqual(self.store.claimable(), [])
+
+        # Mock the worker holding it having died
+        self.store._execute("UPDATE jobs SET lease_until = 0 WHERE id = ?", (job_id,))
+
+        self.assertEqual(self.store.claimable(), [job_id])
+        self.assertEqual(self.store.claim(job_id, lease=60)["attempts"], 2)
+
+    async def test_abandoned_job_without_attempts_left_fails(self):
+        job_id = await self._enqueue([_image("a.png", b"aaa")])
+        self.store.claim(job_id, lease=60, max_attempts=1)
+
+        # Mock the worker holding its last attempt having died
+        self.store._execute("UPDATE jobs SET lease_until = 0 WHERE id = ?", (job_id,))
+
+        self.assertEqual(self.store.claimable(max_attempts=1), [])
+        self.assertIsNone(self.store.claim(job_id, lease=60, max_attempts=1))
+
+        self.assertEqual(self.store.fail_abandoned(max_attempts=1), 1)
+        self.assertEqual(self.store.get(job_id)["status"], jobs.FAILED)
+        self.assertFalse(os.path.exists(self.store.spool_dir(job_id)))
+
+    @patch("app.jobs.JOB_POLL_INTERVAL", 0.01)
+    @patch("app.jobs.JOB_WORKERS", 0)
+    async def test_due_jobs_are_queued_once(self):
+        job_id = await self._enqueue()
+
+        # No workers take jobs off the queue while it is rescanned
+        await jobs.start_job_workers()
+        try:
+            await asyncio.sleep(0.1)
+
+            self.assertEqual(jobs._queue.qsize(), 1)
+            self.assertEqual(jobs._queue.get_nowait(), job_id)
+        finally:
+            await jobs.stop_job_workers()
+
+    async def test_prune_removes_old_finished_jobs(self):
+        finished, queued = await self._enqueue(), await self._enqueue()
+        self.store.finish(finished, jobs.SUCCEEDED, {})
+
+        self.assertEqual(self.store.prune(older_than=-1), 1)
+        self.assertIsNone(self.store.get(finished))
+        self.assertIsNotNone(self.store.get(queued))
+
+
+if __name__ == "__main__":
+    unittest.main()
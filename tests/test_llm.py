@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+from app.llm import clear_llm_cache, normalize_query, translate_query
+from app.models import LLMQuery
+
+
+class TestLLM(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await clear_llm_cache()
+
+    def test_normalize_query(self):
+        self.assertEqual(normalize_query(" 2-room Flat  in Zurich. "), "2-room flat in zurich")
+        self.assertEqual(normalize_query("2-room flat in zurich"), normalize_query("2-ROOM Flat in ZURICH!"))
+
+        # Symbols and words may change what is searched for
+        self.assertNotEqual(normalize_query("price <2000"), normalize_query("price >2000"))
+        self.assertNotEqual(normalize_query("3+ rooms"), normalize_query("3 rooms"))
+        self.assertNotEqual(normalize_query("flat in Zurich"), normalize_query("flat at Zurich"))
+
+    @patch("app.llm.async_get_data_from_llm")
+    async def test_translation_is_cached(self, mock_get_data_from_llm):
+        mock_get_data_from_llm.return_value = (200, LLMQuery(content='{"rooms": 2}'))
+
+        first = await translate_query("2 room flat in Zurich", {}, "v1")
+        second = await translate_query("2 Room flat in  Zurich ", {}, "v1")
+
+        self.assertEqual(first, second)
+        mock_get_data_from_llm.assert_awaited_once()
+
+    @patch("app.llm.async_get_data_from_llm")
+    async def test_schema_change_invalidates_translation(self, mock_get_data_from_llm):
+        mock_get_data_from_llm.return_value = (200, LLMQuery(content='{"rooms": 2}'))
+
+        await translate_query("2 room flat", {}, "v1")
+        await translate_query("2 room flat", {}, "v2")
+
+        self.assertEqual(mock_get_data_from_llm.await_count, 2)
+
+    @patch("app.llm.async_get_data_from_llm")
+    async def test_concurrent_queries_are_collapsed(self, mock_get_data_from_llm):
+        async def slow_llm(endpoint, data):
+            await asyncio.sleep(0.01)
+            return 200, LLMQuery(content='{"rooms": 2}')
+
+        mock_get_data_from_llm.side_effect = slow_llm
+
+        await asyncio.gather(*(translate_query("2 room flat", {}, "v1") for _ in range(5)))
+
+        mock_get_data_from_llm.assert_awaited_once()
+
+    @patch("app.llm.async_get_data_from_llm")
+    async def test_failures_are_not_cached(self, mock_get_data_from_llm):
+        mock_get_data_from_llm.return_value = (500, None)
+
+        self.assertEqual(await translate_query("2 room flat", {}, "v1"), (500, None))
+        await translate_query("2 room flat", {}, "v1")
+
+        self.assertEqual(mock_get_data_from_llm.await_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import io
+import json
+import logging
+import queue
+import time
+import unittest
+from unittest.mock import patch
+
+import httpx
+from fastapi import FastAPI
+
+from app.logs import (SAMPLED, DroppingQueueHandler, JsonFormatter,
+                      RequestIdFilter, RequestIdMiddleware, SamplingFilter,
+                      Truncated, queue_handler, request_id_var)
+from app.metrics import LOG_RECORDS_DROPPED
+
+
+def make_record(msg="message", *args, level=logging.INFO, **extra) -> logging.LogRecord:
+    record = logging.LogRecord("app.test", level, __file__, 1, msg, args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestTruncated(unittest.TestCase):
+
+    @patch("app.logs.LOG_MAX_PAYLOAD_CHARS", 10)
+    def test_long_text_is_cut(self):
+        self.assertEqual(str(Truncated("a" * 50)), "a" * 10 + "... (truncated)")
+        self.assertEqual(str(Truncated(b"b" * 50)), "b" * 10 + "... (truncated)")
+
+    def test_short_text_is_kept(self):
+        self.assertEqual(str(Truncated("short")), "short")
+
+    def test_large_payload_is_bounded(self):
+        payload = {"properties": [{"description": "x" * 10000} for _ in range(1000)]}
+
+        self.assertLess(len(str(Truncated(payload))), 1100)
+
+    def test_not_rendered_when_level_disabled(self):
+        rendered = []
+
+        class Payload:
+            def __repr__(self):
+                rendered.append(True)
+                return "payload"
+
+        logger = logging.getLogger("app.test.disabled")
+        logger.setLevel(logging.WARNING)
+
+        logger.info("payload = %s", Truncated(Payload()))
+
+        self.assertEqual(rendered, [])
+
+
+class TestFilters(unittest.TestCase):
+
+    def test_request_id_is_attached(self):
+        token = request_id_var.set("abc")
+
+        try:
+            record = make_record()
+            RequestIdFilter().filter(record)
+        finally:
+            request_id_var.reset(token)
+
+        self.assertEqual(record.request_id, "abc")
+
+    def test_sampling_only_applies_to_marked_info_lines(self):
+        sampling = SamplingFilter(rate=0.0)
+
+        self.assertFalse(sampling.filter(make_record(**SAMPLED)))
+        self.assertTrue(sampling.filter(make_record()))
+        self.assertTrue(sampling.filter(make_record(level=logging.WARNING, **SAMPLED)))
+
+    def test_full_rate_keeps_everything(self):
+        self.assertTrue(SamplingFilter(rate=1.0).filter(make_record(**SAMPLED)))
+
+
+class TestQueueLogging(unittest.TestCase):
+
+    def test_json_formatter(self):
+        line = JsonFormatter().format(make_record("got %s", 1, request_id="abc"))
+
+        entry = json.loads(line)
+        self.assertEqual(entry["message"], "got 1")
+        self.assertEqual(entry["request_id"], "abc")
+        self.assertEqual(entry["level"], "INFO")
+
+    def test_records_are_written_in_the_background(self):
+        stream = io.StringIO()
+        handler = queue_handler(format="json", stream=stream)
+
+        handler.handle(make_record("written %s", "later"))
+
+        # Wait for the writer thread to catch up
+        for _ in range(100):
+            if stream.getvalue():
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(json.loads(stream.getvalue())["message"], "written later")
+
+    def test_full_queue_drops_records(self):
+        handler = DroppingQueueHandler(queue.Queue(1))
+        dropped = LOG_RECORDS_DROPPED.value()
+
+        handler.handle(make_record())
+        handler.handle(make_record())
+
+        self.assertEqual(LOG_RECORDS_DROPPED.value(), dropped + 1)
+
+
+class TestRequestIdMiddleware(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        app = FastAPI()
+
+        @app.get("/id")
+        async def get_id():
+            return request_id_var.get()
+
+        app.add_middleware(RequestIdMiddleware)
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test")
+
+    async def asyncTearDown(self):
+        await self.client.aclose()
+
+    async def test_uses_incoming_request_id(self):
+        res = await self.client.get("/id", headers={"X-Request-ID": "abc"})
+
+        self.assertEqual(res.json(), "abc")
+        self.assertEqual(res.headers["X-Request-ID"], "abc")
+
+    async def test_generates_request_id(self):
+        res = await self.client.get("/id")
+
+        self.assertEqual(res.json(), res.headers["X-Request-ID"])
+        self.assertEqual(len(res.json()), 32)
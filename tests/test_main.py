@@ -1,19 +1,34 @@
+import json
 import unittest
 from unittest.mock import patch
 
-from app.main import list_properties
+import httpx
+
+from app.config import IMAGE_SERVICE_URL
+from app.geocoding import AddressNotFoundError, clear_geocode_cache
+from app.main import app, list_properties
 from app.models import LLMQuery
 
 from fastapi import HTTPException
+from fastapi.responses import Response
+
+
+def reset_middleware() -> None:
+    """Rebuild the app's middleware on the next request, dropping the rate limits other tests used up"""
+    app.middleware_stack = None
 
 
 class TestApp(unittest.IsolatedAsyncioTestCase):
-    @patch("app.main.fetch_json")
-    @patch("app.main.get_data_from_llm")
-    async def test_list_properties_success(self, mock_get_data_from_llm, mock_fetch_json):
-        # Mock the fetch_json and get_data_from_llm functions
-        mock_fetch_json.return_value = {"param1": "value1", "param2": "value2"}
-        mock_get_data_from_llm.return_value = (
+    @patch("app.main.get_query_schema")
+    @patch("app.main.async_fetch_bytes")
+    @patch("app.main.translate_query")
+    async def test_list_properties_success(
+        self, mock_translate_query, mock_fetch_bytes, mock_get_query_schema
+    ):
+        # Mock the fetch_bytes and translate_query functions
+        mock_get_query_schema.return_value = {"param1": "value1", "param2": "value2"}
+        mock_fetch_bytes.return_value = b'{"param1": "value1", "param2": "value2"}'
+        mock_translate_query.return_value = (
             200,
             LLMQuery(content='{"param1": "value1", "param2": "value2"}'),
         )
@@ -22,16 +37,18 @@ class TestApp(unittest.IsolatedAsyncioTestCase):
         result = await list_properties("user_query")
 
         # Assert the returned value
-        self.assertEqual(result, {"param1": "value1", "param2": "value2", 'filters': {'param1': 'value1', 'param2': 'value2'}})
+        self.assertEqual(json.loads(result.body), {"param1": "value1", "param2": "value2", 'filters': {'param1': 'value1', 'param2': 'value2'}})
 
-    @patch("app.main.fetch_json")
-    @patch("app.main.get_data_from_llm")
+    @patch("app.main.get_query_schema")
+    @patch("app.main.async_fetch_json")
+    @patch("app.main.translate_query")
     async def test_list_properties_inventory_service_error(
-        self, mock_get_data_from_llm, mock_fetch_json
+        self, mock_translate_query, mock_fetch_json, mock_get_query_schema
     ):
-        # Mock the fetch_json and get_data_from_llm functions
+        # Mock the fetch_json and translate_query functions
+        mock_get_query_schema.return_value = None
         mock_fetch_json.return_value = None
-        mock_get_data_from_llm.return_value = (
+        mock_translate_query.return_value = (
             200,
             LLMQuery(content='{"param1": "value1", "param2": "value2"}'),
         )
@@ -47,14 +64,16 @@ class TestApp(unittest.IsolatedAsyncioTestCase):
             "Something went wrong with the inventory service. Initial request failed.",
         )
 
-    @patch("app.main.fetch_json")
-    @patch("app.main.get_data_from_llm")
+    @patch("app.main.get_query_schema")
+    @patch("app.main.async_fetch_json")
+    @patch("app.main.translate_query")
     async def test_list_properties_llm_service_error(
-        self, mock_get_data_from_llm, mock_fetch_json
+        self, mock_translate_query, mock_fetch_json, mock_get_query_schema
     ):
-        # Mock the fetch_json and get_data_from_llm functions
+        # Mock the fetch_json and translate_query functions
+        mock_get_query_schema.return_value = {"param1": "value1", "param2": "value2"}
         mock_fetch_json.return_value = {"param1": "value1", "param2": "value2"}
-        mock_get_data_from_llm.return_value = (500, None)
+        mock_translate_query.return_value = (500, None)
 
         # Call the list_properties function and expect an exception
         with self.assertRaises(HTTPException) as cm:
@@ -66,6 +85,225 @@ class TestApp(unittest.IsolatedAsyncioTestCase):
             cm.exception.detail, "Something went wrong with the LLM service."
         )
 
+    @patch("app.main.add_primary_image_urls")
+    @patch("app.main.async_fetch_json")
+    async def test_query_properties_with_images(self, mock_fetch_json, mock_add_images):
+        mock_fetch_json.return_value = {"properties": [{"propertyId": 1}]}
+        mock_add_images.side_effect = lambda res: {**res, "enriched": True}
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            res = await client.get("/queryProperties", params={"rooms": 2, "withImages": "true"})
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.json()["enriched"])
+        # The flag is not forwarded to the inventory
+        self.assertEqual(mock_fetch_json.await_args.kwargs["params"], [("rooms", "2")])
+
+    @patch("app.main.refresh_query_schema")
+    async def test_refresh_query_schema_requires_a_token(self, mock_refresh):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            res = await client.post("/refreshQuerySchema")
+
+        self.assertEqual(res.status_code, 401)
+        mock_refresh.assert_not_called()
+
+
+    @patch("app.main.invalidate_responses")
+    @patch("app.main._reverse_auth_proxy")
+    async def test_upload_invalidates_the_property_images(self, mock_proxy, mock_invalidate):
+        # Mock the image service accepting the upload, then rejecting one
+        mock_proxy.side_effect = [Response("ok"), Response("invalid", status_code=400)]
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            res = await client.post("/upload", params={"propertyId": 7}, content=b"image")
+            await client.post("/upload", params={"propertyId": 8}, content=b"image")
+
+        self.assertEqual(res.status_code, 200)
+        mock_invalidate.assert_awaited_once_with(IMAGE_SERVICE_URL, dict(propertyId="7"))
+
+
+class TestUpdateProperty(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        reset_middleware()
+        await clear_geocode_cache()
+
+    async def update_property(self, content: dict) -> httpx.Response:
+        transport = httpx.ASGITransport(app=app)
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.put(
+                "/updateProperty/1",
+                json={"content": content},
+                headers={"Authorization": "token"},
+            )
+
+    @patch("app.main.async_put_data")
+    @patch("app.main.geocode")
+    @patch("app.main.async_fetch_json")
+    @patch("app.main.get_user_id")
+    @patch("app.main.async_raise_for_invalid_token")
+    async def test_unchanged_address_is_not_geocoded(
+        self, mock_raise, mock_get_user_id, mock_fetch_json, mock_geocode, mock_put_data
+    ):
+        mock_get_user_id.return_value = "user-1"
+        mock_fetch_json.return_value = {
+            "address": "Bahnhofstrasse 1", "location": "Zurich",
+            "longitude": 8.54, "latitude": 47.37,
+        }
+        mock_put_data.return_value = "ok"
+
+        res = await self.update_property(
+            {"address": "Bahnhofstrasse 1", "location": "Zurich", "images": []}
+        )
+
+        self.assertEqual(res.status_code, 200)
+        mock_geocode.assert_not_awaited()
+        self.assertEqual(mock_put_data.await_args.args[1]["longitude"], 8.54)
+
+    @patch("app.main.async_put_data")
+    @patch("app.main.geocode")
+    @patch("app.main.async_fetch_json")
+    @patch("app.main.get_user_id")
+    @patch("app.main.async_raise_for_invalid_token")
+    async def test_changed_address_is_geocoded(
+        self, mock_raise, mock_get_user_id, mock_fetch_json, mock_geocode, mock_put_data
+    ):
+        mock_get_user_id.return_value = "user-1"
+        mock_fetch_json.return_value = {
+            "address": "Bahnhofstrasse 1", "location": "Zurich",
+            "longitude": 8.54, "latitude": 47.37,
+        }
+        mock_geocode.return_value = (7.44, 46.95)
+        mock_put_data.return_value = "ok"
+
+        res = await self.update_property(
+            {"address": "Bundesplatz 3", "location": "Bern", "images": []}
+        )
+
+        self.assertEqual(res.status_code, 200)
+        mock_geocode.assert_awaited_once_with("Bundesplatz 3", "Bern")
+        self.assertEqual(mock_put_data.await_args.args[1]["latitude"], 46.95)
+
+    @patch("app.main.async_put_data")
+    @patch("app.main.geocode")
+    @patch("app.main.async_fetch_json")
+    @patch("app.main.get_user_id")
+    @patch("app.main.async_raise_for_invalid_token")
+    async def test_unknown_address_is_unprocessable(
+        self, mock_raise, mock_get_user_id, mock_fetch_json, mock_geocode, mock_put_data
+    ):
+        mock_get_user_id.return_value = "user-1"
+        mock_fetch_json.return_value = {"address": "Bahnhofstrasse 1", "location": "Zurich"}
+        mock_geocode.side_effect = AddressNotFoundError("Nowhere 1 Atlantis")
+
+        res = await self.update_property({"address": "Nowhere 1", "location": "Atlantis", "images": []})
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.json(), {"detail": "Address not found."})
+        mock_put_data.assert_not_awaited()
+
+
+class TestCreateProperty(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        reset_middleware()
+
+    @patch("app.main.async_upload_file")
+    @patch("app.main.async_post_data")
+    @patch("app.main.geocode")
+    @patch("app.main.get_user_id")
+    @patch("app.main.async_raise_for_invalid_token")
+    async def test_partial_upload_failure_reports_each_image(
+        self, mock_raise, mock_get_user_id, mock_geocode, mock_post_data, mock_upload_file
+    ):
+        mock_get_user_id.return_value = "user-1"
+        mock_geocode.return_value = (8.54, 47.37)
+        mock_post_data.return_value = {"propertyId": 7}
+        mock_upload_file.side_effect = lambda endpoint, img, params: (
+            None if img.filename == "b.png" else "ok"
+        )
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            res = await client.post(
+                "/createProperty",
+                data={"content": '{"address": "Bahnhofstrasse 1", "location": "Zurich", "images": []}'},
+                files=[("images", ("a.png", b"a")), ("images", ("b.png", b"b")), ("images", ("c.png", b"c"))],
+                headers={"Authorization": "token"},
+            )
+
+        self.assertEqual(res.status_code, 500)
+        self.assertEqual(
+            [image["uploaded"] for image in res.json()["detail"]["images"]], [True, False, True]
+        )
+
+        # Only the first image is uploaded as primary
+        primaries = {call.args[1].filename: call.kwargs["params"]["primary"] for call in mock_upload_file.await_args_list}
+        self.assertEqual(primaries, {"a.png": True, "b.png": False, "c.png": False})
+
+    @patch("app.main.enqueue_create_property")
+    @patch("app.main.get_user_id")
+    @patch("app.main.async_raise_for_invalid_token")
+    async def test_property_without_address_is_rejected(self, mock_raise, mock_get_user_id, mock_enqueue):
+        mock_get_user_id.return_value = "user-1"
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            res = await client.post(
+                "/createProperty",
+                params={"async": "true"},
+                data={"content": '{"location": "Zurich", "images": []}'},
+                headers={"Authorization": "token"},
+            )
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(res.json()["detail"], "Missing property fields: address.")
+        mock_enqueue.assert_not_called()
+
+    @patch("app.main.get_job")
+    @patch("app.main.enqueue_create_property")
+    @patch("app.main.geocode")
+    @patch("app.main.get_user_id")
+    @patch("app.main.async_raise_for_invalid_token")
+    async def test_async_mode_answers_with_a_job(
+        self, mock_raise, mock_get_user_id, mock_geocode, mock_enqueue, mock_get_job
+    ):
+        mock_get_user_id.return_value = "user-1"
+        mock_enqueue.return_value = "job-1"
+        mock_get_job.return_value = {
+            "id": "job-1", "owner": "user-1", "status": "queued", "attempts": 0,
+            "result": None, "error": None, "created_at": 1.0, "updated_at": 1.0,
+        }
+
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            res = await client.post(
+                "/createProperty",
+                params={"async": "true"},
+                data={"content": '{"address": "Bahnhofstrasse 1", "location": "Zurich", "images": []}'},
+                files=[("images", ("a.png", b"a"))],
+                headers={"Authorization": "token"},
+            )
+            status = await client.get(res.headers["location"], headers={"Authorization": "token"})
+
+            # Mock another user polling the same job
+            mock_get_user_id.return_value = "user-2"
+            foreign = await client.get("/jobs/job-1", headers={"Authorization": "token"})
+
+        self.assertEqual(res.status_code, 202)
+        self.assertEqual(res.json(), {"jobId": "job-1", "status": "queued"})
+        mock_geocode.assert_not_called()
+
+        owner, inventory_data, images = mock_enqueue.await_args.args
+        self.assertEqual((owner, inventory_data["owner"]), ("user-1", "user-1"))
+        self.assertNotIn("images", inventory_data)
+        self.assertEqual([image.filename for image in images], ["a.png"])
+
+        self.assertEqual(status.json()["status"], "queued")
+        self.assertEqual(foreign.status_code, 404)
+
 
 if __name__ == "__main__":
     unittest.main()
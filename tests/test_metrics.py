@@ -0,0 +1,55 @@
+import unittest
+
+import httpx
+
+from app.main import app
+from app.metrics import Counter, Histogram, render_metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter("test_counter_total", "Test counter.", ("route",))
+        counter.inc("/a")
+        counter.inc("/a", amount=2)
+
+        self.assertEqual(counter.value("/a"), 3)
+        self.assertIn('test_counter_total{route="/a"} 3.0', render_metrics())
+
+    def test_histogram(self):
+        histogram = Histogram("test_duration_seconds", "Test histogram.", ("stage",), buckets=(0.1, 1.0))
+        histogram.observe(0.05, "llm")
+        histogram.observe(0.5, "llm")
+        histogram.observe(5, "llm")
+
+        rendered = histogram.render()
+
+        self.assertIn('test_duration_seconds_bucket{stage="llm",le="0.1"} 1', rendered)
+        self.assertIn('test_duration_seconds_bucket{stage="llm",le="1.0"} 2', rendered)
+        self.assertIn('test_duration_seconds_bucket{stage="llm",le="+Inf"} 3', rendered)
+        self.assertIn('test_duration_seconds_count{stage="llm"} 3', rendered)
+        self.assertEqual(histogram.count("llm"), 3)
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("test_escaped_total", "Test counter.", ("value",))
+        counter.inc('a"b')
+
+        self.assertIn('test_escaped_total{value="a\\"b"} 1.0', counter.render())
+
+
+class TestMetricsEndpoint(unittest.IsolatedAsyncioTestCase):
+    async def test_requests_are_labelled_by_route_template(self):
+        transport = httpx.ASGITransport(app=app)
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            await client.get("/not-a-route")
+            res = await client.get("/metrics")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(
+            'service_manager_http_requests_total{method="GET",route="unmatched",status="404"}',
+            res.text,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
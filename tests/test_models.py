@@ -1,4 +1,6 @@
+import json
 import unittest
+from unittest.mock import patch
 
 from app.models import LLMQuery
 
@@ -36,6 +38,15 @@ class TestLLMQuery(unittest.TestCase):
         # Assert the returned value
         self.assertEqual(parsed_params, {})
 
+    @patch("app.models.loads", wraps=json.loads)
+    def test_content_is_parsed_once(self, mock_loads):
+        llm_query = LLMQuery(content='{"rooms": 2}')
+
+        llm_query.get_parsed_params()["rooms"] = 3
+
+        self.assertEqual(llm_query.get_parsed_params(), {"rooms": 2})
+        mock_loads.assert_called_once()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import httpx
+
+from app import popular
+from app.main import app, list_properties
+from app.models import LLMQuery
+from app.proxy_cache import invalidate_responses
+from app.serialization import loads
+
+
+class TestSpaceSaving(unittest.TestCase):
+    def test_frequent_items_survive_eviction(self):
+        tracker = popular.SpaceSaving(3)
+
+        for item in ["flat"] * 5 + ["house"] * 3 + ["loft", "villa", "barn", "flat"]:
+            tracker.add(item)
+
+        top = tracker.top(2)
+
+        self.assertEqual([counted.item for counted in top], ["flat", "house"])
+        self.assertEqual((top[0].count, top[0].error), (6, 0))
+        self.assertEqual(len(tracker), 3)
+
+    def test_evicted_count_becomes_the_error(self):
+        tracker = popular.SpaceSaving(1)
+        tracker.add("flat")
+        tracker.add("flat")
+
+        self.assertEqual(tracker.add("house"), "flat")
+        self.assertEqual(tracker.top(1), [popular.Counted("house", 3, 2)])
+
+    def test_decay_forgets_rare_items(self):
+        tracker = popular.SpaceSaving(10)
+        for item in ["flat"] * 4 + ["house"]:
+            tracker.add(item)
+
+        tracker.decay(0.5)
+
+        self.assertEqual(tracker.top(10), [popular.Counted("flat", 2, 0)])
+
+
+@patch("app.proxy_cache.SERVER_WORKERS", 1)
+@patch("app.popular.POPULAR_QUERY_MIN_COUNT", 2)
+@patch("app.popular.get_query_schema_version", return_value="v1")
+@patch("app.popular.get_query_schema", new_callable=AsyncMock, return_value={})
+@patch("app.popular.async_fetch_bytes", new_callable=AsyncMock, return_value=b'{"properties": []}')
+@patch("app.popular.translate_query", new_callable=AsyncMock, return_value=(200, LLMQuery(content='{"rooms": 2}')))
+class TestPrecompute(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await popular.clear_popular_queries()
+
+    async def test_only_popular_queries_are_precomputed(self, mock_translate, mock_fetch, *_):
+        for user_query in ["2 room flat in Zurich", "2 Room flat in  Zurich.", "villa Bern"]:
+            popular.record_query(user_query)
+
+        # A query searched for once may be a single user's
+        self.assertEqual([counted.item for counted in popular.top_queries()], ["2 room flat in zurich"])
+        self.assertEqual(await popular.refresh_popular_queries(), 1)
+
+        # Sent with its latest phrasing
+        self.assertEqual(mock_translate.await_args.args[0], "2 Room flat in  Zurich.")
+        self.assertEqual(
+            await popular.get_precomputed("2 room flat in zurich", "v1"),
+            ({"rooms": 2}, b'{"properties": []}'),
+        )
+        self.assertIsNone(await popular.get_precomputed("villa Bern", "v1"))
+        self.assertIsNone(await popular.get_precomputed("2 room flat in zurich", "v2"))
+        self.assertEqual(popular.top_queries(min_count=0)[0].count, 1)
+
+    async def test_inventory_writes_drop_precomputed_results(self, *_):
+        popular.record_query("flat")
+        popular.record_query("flat")
+        await popular.refresh_popular_queries()
+
+        await invalidate_responses(popular.INVENTORY_SERVICE_URL)
+
+        self.assertEqual(await popular.get_precomputed("flat", "v1"), ({"rooms": 2}, None))
+
+    @patch("app.main.get_query_schema_version", return_value="v1")
+    @patch("app.main.get_query_schema", new_callable=AsyncMock, return_value={})
+    @patch("app.main.translate_query", new_callable=AsyncMock)
+    async def test_popular_query_skips_the_llm(self, mock_main_translate, *_):
+        popular.record_query("flat")
+        popular.record_query("flat")
+        await popular.refresh_popular_queries()
+
+        result = await list_properties("Flat")
+
+        self.assertEqual(loads(result.body), {"properties": [], "filters": {"rooms": 2}})
+        mock_main_translate.assert_not_awaited()
+        self.assertGreaterEqual(popular.precompute_hit_rate()["hit"], 1)
+
+
+class TestPopularQueriesEndpoint(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await popular.clear_popular_queries()
+
+    async def get(self, headers: dict) -> httpx.Response:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/popularQueries", headers=headers)
+
+    async def test_requires_a_token(self):
+        self.assertEqual((await self.get({})).status_code, 401)
+
+    @patch("app.popular.POPULAR_QUERY_MIN_COUNT", 2)
+    @patch("app.main.async_raise_for_invalid_token", new_callable=AsyncMock)
+    async def test_lists_only_popular_queries(self, mock_raise):
+        for user_query in ["flat", "flat", "my street 12"]:
+            popular.record_query(user_query)
+
+        res = await self.get({"Authorization": "token"})
+
+        self.assertEqual([top["query"] for top in res.json()["top"]], ["flat"])
+        mock_raise.assert_awaited_once_with("token")
+
+
+if __name__ == "__main__":
+    unittest.main()
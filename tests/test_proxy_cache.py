@@ -0,0 +1,123 @@
+import unittest
+from unittest.mock import patch
+
+from httpx import Headers
+from starlette.requests import Request
+
+from app import proxy_cache
+from app.cache_backends import InvalidationBus, LocalCache
+from tests.test_cache_backends import FakeRedis
+
+
+def make_request(path: str, query: bytes) -> Request:
+    return Request(scope={
+        "type": "http",
+        "method": "GET",
+        "headers": [],
+        "path": path,
+        "query_string": query,
+        "root_path": "",
+        "client": ("127.0.0.1", 12345),
+        "server": ("example.com", 443),
+        "scheme": "https",
+    })
+
+
+@patch("app.proxy_cache.SERVER_WORKERS", 1)
+class TestProxyCache(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await proxy_cache.clear_response_cache()
+
+    def test_cache_key_normalizes_query(self):
+        first = proxy_cache.response_cache_key("inventory-service", make_request("/queryProperties", b"b=2&a=1"))
+        second = proxy_cache.response_cache_key("inventory-service", make_request("/queryProperties", b"a=1&b=2"))
+
+        self.assertEqual(first, second)
+
+    def test_response_ttl_honors_cache_control(self):
+        self.assertEqual(proxy_cache.response_ttl(Headers(), 30), 30)
+        self.assertEqual(proxy_cache.response_ttl(Headers({"Cache-Control": "public, max-age=60"}), 30), 60)
+        self.assertEqual(proxy_cache.response_ttl(Headers({"Cache-Control": "no-store"}), 30), 0)
+        self.assertEqual(proxy_cache.response_ttl(Headers({"Cache-Control": "private, max-age=60"}), 30), 0)
+        self.assertEqual(proxy_cache.response_ttl(Headers({"Set-Cookie": "a=b"}), 30), 0)
+
+    async def test_only_successful_responses_are_stored(self):
+        await proxy_cache.store_response(("a",), proxy_cache.CachedResponse(500, Headers(), b""), 30)
+        await proxy_cache.store_response(("b",), proxy_cache.CachedResponse(200, Headers(), b"ok"), 30)
+
+        self.assertIsNone(await proxy_cache.get_cached_response(("a",)))
+        self.assertEqual((await proxy_cache.get_cached_response(("b",))).body, b"ok")
+
+    async def test_invalidate_responses(self):
+        response = proxy_cache.CachedResponse(200, Headers(), b"ok")
+        keys = [
+            ("inventory-service", "GET", "/properties", ()),
+            ("image-service:8080", "GET", "/getImageUrls", (("propertyId", "1"),)),
+            ("image-service:8080", "GET", "/getImageUrls", (("propertyId", "2"),)),
+        ]
+        for key in keys:
+            await proxy_cache.store_response(key, response, 30)
+
+        await proxy_cache.invalidate_responses("image-service:8080", dict(propertyId="1"))
+
+        self.assertEqual(
+            [await proxy_cache.get_cached_response(key) is not None for key in keys], [True, False, True]
+        )
+
+        await proxy_cache.invalidate_responses("inventory-service")
+
+        self.assertIsNone(await proxy_cache.get_cached_response(keys[0]))
+
+    async def test_nothing_is_cached_by_several_workers_without_a_bus(self):
+        with patch("app.proxy_cache.SERVER_WORKERS", 4):
+            await proxy_cache.store_response(("b",), proxy_cache.CachedResponse(200, Headers(), b"ok"), 30)
+
+        self.assertIsNone(await proxy_cache.get_cached_response(("b",)))
+
+
+class TestResponseCacheInvalidation(unittest.IsolatedAsyncioTestCase):
+    def worker(self, client):
+        bus = InvalidationBus(client, channel="invalidate")
+
+        return proxy_cache.ResponseCache(LocalCache(100, 60), bus), bus
+
+    async def test_invalidation_reaches_the_other_workers(self):
+        client = FakeRedis()
+        first, _ = self.worker(client)
+        second, second_bus = self.worker(client)
+        forgotten = []
+
+        async def listener(call_url, params):
+            forgotten.append(call_url)
+
+        second.listeners.append(listener)
+
+        key = ("image-service:8080", "GET", "/getImageUrls", (("propertyId", "1"),))
+        for worker in (first, second):
+            await worker.cache.set(key, proxy_cache.CachedResponse(200, {}, b"old"))
+
+        await first.invalidate("image-service:8080", dict(propertyId="1"))
+
+        # Deliver the broadcast as the subscriber task would
+        await second_bus.handle(client.published[-1][1])
+
+        self.assertIsNone(await first.cache.get(key))
+        self.assertIsNone(await second.cache.get(key))
+        self.assertEqual(forgotten, ["image-service:8080"])
+
+    async def test_cleared_namespace_drops_everything(self):
+        client = FakeRedis()
+        _, first_bus = self.worker(client)
+        second, second_bus = self.worker(client)
+        key = ("inventory-service", "GET", "/properties", ())
+        await second.cache.set(key, proxy_cache.CachedResponse(200, {}, b"old"))
+
+        # As sent when invalidations may have been missed
+        await first_bus.publish(proxy_cache.ResponseCache.namespace, None)
+        await second_bus.handle(client.published[-1][1])
+
+        self.assertIsNone(await second.cache.get(key))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+from unittest.mock import patch
+
+from app.metrics import LLM_REJECTED_FIELDS
+from app.query_filters import QueryFilterNormalizer, normalize_query_filters
+
+JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "location": {"anyOf": [{"type": "string"}, {"type": "null"}]},
+        "rooms": {"anyOf": [{"type": "integer", "minimum": 1, "maximum": 10}, {"type": "null"}]},
+        "priceMax": {"type": "number", "exclusiveMinimum": 0},
+        "furnished": {"type": "boolean"},
+        "type": {"$ref": "#/$defs/PropertyType"},
+        "features": {"type": "array", "items": {"type": "string", "enum": ["balcony", "garden"]}},
+    },
+    "$defs": {"PropertyType": {"type": "string", "enum": ["Flat", "House"]}},
+}
+
+OPENAPI_SCHEMA = {
+    "openapi": "3.0.0",
+    "paths": {
+        "/queryProperties": {
+            "get": {
+                "parameters": [
+                    {"name": "rooms", "in": "query", "schema": {"type": "integer", "minimum": 1}},
+                    {"name": "Authorization", "in": "header", "schema": {"type": "string"}},
+                ],
+            },
+        },
+    },
+}
+
+
+class TestQueryFilterNormalizer(unittest.TestCase):
+
+    def test_values_are_coerced_and_clamped(self):
+        normalizer = QueryFilterNormalizer(JSON_SCHEMA)
+
+        self.assertEqual(
+            normalizer.normalize({
+                "location": "Zurich",
+                "rooms": "25",
+                "priceMax": "2000.5",
+                "furnished": "yes",
+                "type": "flat",
+                "features": ["Garden", "pool"],
+            }),
+            {
+                "location": "Zurich",
+                "rooms": 10,
+                "priceMax": 2000.5,
+                "furnished": True,
+                "type": "Flat",
+                "features": ["garden"],
+            },
+        )
+
+    def test_unknown_and_invalid_fields_are_dropped_and_counted(self):
+        normalizer = QueryFilterNormalizer(JSON_SCHEMA)
+        unknown = LLM_REJECTED_FIELDS.value("unknown")
+        invalid = LLM_REJECTED_FIELDS.value("invalid")
+
+        normalized = normalizer.normalize(
+            {"rooms": "many", "type": "castle", "features": ["pool"], "pets": True}
+        )
+
+        self.assertEqual(normalized, {})
+        self.assertEqual(LLM_REJECTED_FIELDS.value("unknown"), unknown + 1)
+        self.assertEqual(LLM_REJECTED_FIELDS.value("invalid"), invalid + 3)
+
+    def test_openapi_query_parameters(self):
+        normalizer = QueryFilterNormalizer(OPENAPI_SCHEMA)
+
+        self.assertEqual(normalizer.normalize({"rooms": 0, "Authorization": "x"}), {"rooms": 1})
+
+    def test_unrecognised_schema_lets_everything_through(self):
+        params = {"param1": "value1"}
+
+        self.assertEqual(QueryFilterNormalizer({"param1": "value1"}).normalize(params), params)
+        self.assertEqual(QueryFilterNormalizer(None).normalize(params), params)
+
+    def test_recursive_refs_are_compiled_once(self):
+        schema = {
+            "properties": {
+                "tags": {"$ref": "#/$defs/Tags"},
+                "loop": {"$ref": "#/$defs/Loop"},
+                "rooms": {"type": ["integer", "null"], "maximum": 10},
+            },
+            "$defs": {
+                # An array of itself, and a $ref pointing back at itself
+                "Tags": {"type": "array", "items": {"$ref": "#/$defs/Tags"}},
+                "Loop": {"$ref": "#/$defs/Loop"},
+            },
+        }
+        normalizer = QueryFilterNormalizer(schema)
+
+        self.assertEqual(
+            normalizer.normalize({"tags": ["a", 1], "loop": "x", "rooms": "12"}),
+            {"tags": ["a", 1], "loop": "x", "rooms": 10},
+        )
+
+    def test_malformed_nodes_let_values_through(self):
+        schema = {
+            "properties": {
+                "notSchema": "string",
+                "badRef": {"$ref": 42},
+                "missingRef": {"$ref": "#/$defs/Missing/Deeper"},
+                "badItems": {"type": "array", "items": ["string"]},
+                "badVariants": {"anyOf": ["string", {"type": "null"}]},
+                "badEnum": {"type": "string", "enum": "abc"},
+            },
+            "$defs": {"Missing": "not an object"},
+        }
+        params = {
+            "notSchema": 1, "badRef": 2, "missingRef": 3, "badItems": [4], "badVariants": 5, "badEnum": "x",
+        }
+
+        self.assertEqual(QueryFilterNormalizer(schema).normalize(params), params)
+
+    def test_malformed_openapi_document(self):
+        for paths in ([], {"/queryProperties": []}, {"/queryProperties": {"get": {"parameters": {}}}}):
+            params = {"rooms": 2}
+
+            self.assertEqual(QueryFilterNormalizer({"paths": paths}).normalize(params), params)
+
+        schema = {"paths": {"/queryProperties": {"get": {"parameters": [
+            "rooms", {"name": "rooms", "in": "query", "schema": {"type": "integer"}},
+        ]}}}}
+
+        self.assertEqual(QueryFilterNormalizer(schema).normalize({"rooms": "2"}), {"rooms": 2})
+
+    @patch("app.query_filters._compiled", None)
+    def test_compiled_once_per_schema(self):
+        with patch("app.query_filters.QueryFilterNormalizer", wraps=QueryFilterNormalizer) as mock_compile:
+            normalize_query_filters({"rooms": 2}, JSON_SCHEMA)
+            normalize_query_filters({"rooms": 3}, JSON_SCHEMA)
+            normalize_query_filters({"rooms": 3}, OPENAPI_SCHEMA)
+
+        self.assertEqual(mock_compile.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
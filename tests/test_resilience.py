@@ -0,0 +1,149 @@
+import asyncio
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+from app.deadlines import DEADLINE_BOUND, DeadlineExceeded
+from app.resilience import CircuitBreaker, CircuitOpenError, ResilientTransport
+
+
+def make_transport(handler, breaker: CircuitBreaker, hedge: bool = False) -> ResilientTransport:
+    return ResilientTransport(
+        "inventory-service", httpx.MockTransport(handler), breaker, hedge=hedge, hedge_delay=0.01
+    )
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    @patch("app.resilience.time.monotonic")
+    def test_opens_and_half_opens(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+        breaker.record_failure()
+        self.assertTrue(breaker.allow_request())
+
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow_request())
+
+        # After the reset timeout exactly one trial call is let through
+        mock_monotonic.return_value = 111.0
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    @patch("app.resilience.time.monotonic")
+    def test_failed_trial_reopens(self, mock_monotonic):
+        mock_monotonic.return_value = 100.0
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        breaker.record_failure()
+
+        mock_monotonic.return_value = 111.0
+        self.assertTrue(breaker.allow_request())
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.retry_after, 10)
+
+
+class TestResilientTransport(unittest.IsolatedAsyncioTestCase):
+    async def test_open_breaker_fails_fast(self):
+        calls = 0
+
+        def handler(request):
+            nonlocal calls
+            calls += 1
+            return httpx.Response(503)
+
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+        async with httpx.AsyncClient(transport=make_transport(handler, breaker)) as client:
+            for _ in range(2):
+                self.assertEqual((await client.get("http://inventory-service/")).status_code, 503)
+
+            with self.assertRaises(CircuitOpenError):
+                await client.get("http://inventory-service/")
+
+        self.assertEqual(calls, 2)
+
+    async def test_timeouts_on_the_callers_deadline_do_not_open_the_breaker(self):
+        def handler(request):
+            raise httpx.ReadTimeout("timed out", request=request)
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+        transport = make_transport(handler, breaker)
+
+        # Mock a deadline shortening the read timeout
+        request = httpx.Request("GET", "http://inventory-service/", extensions={DEADLINE_BOUND: True})
+
+        for _ in range(3):
+            with self.assertRaises(DeadlineExceeded):
+                await transport.handle_async_request(request)
+
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+        with self.assertRaises(httpx.ReadTimeout):
+            await transport.handle_async_request(httpx.Request("GET", "http://inventory-service/"))
+
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    async def test_slow_gets_are_hedged(self):
+        calls = 0
+
+        async def handler(request):
+            nonlocal calls
+            calls += 1
+            # Only the first attempt is slow
+            await asyncio.sleep(1 if calls == 1 else 0)
+            return httpx.Response(200, text=f"attempt {calls}")
+
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=10)
+
+        async with httpx.AsyncClient(transport=make_transport(handler, breaker, hedge=True)) as client:
+            response = await asyncio.wait_for(client.get("http://inventory-service/"), 0.5)
+
+        self.assertEqual(response.text, "attempt 2")
+        self.assertEqual(calls, 2)
+
+    async def test_streamed_gets_are_not_hedged(self):
+        calls = 0
+
+        async def handler(request):
+            nonlocal calls
+            calls += 1
+            await request.aread()
+            await asyncio.sleep(0.05)
+            return httpx.Response(200)
+
+        async def body():
+            yield b"once"
+
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=10)
+
+        async with httpx.AsyncClient(transport=make_transport(handler, breaker, hedge=True)) as client:
+            await client.request("GET", "http://inventory-service/", content=body())
+
+        self.assertEqual(calls, 1)
+
+    async def test_posts_are_not_hedged(self):
+        calls = 0
+
+        async def handler(request):
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.05)
+            return httpx.Response(200)
+
+        breaker = CircuitBreaker(failure_threshold=5, reset_timeout=10)
+
+        async with httpx.AsyncClient(transport=make_transport(handler, breaker, hedge=True)) as client:
+            await client.post("http://inventory-service/")
+
+        self.assertEqual(calls, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import asyncio
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import httpx
+from httpx import Response
+
+from app.schema import QuerySchemaCache
+
+ENDPOINT = "http://inventory-service/schema/propertyQuery"
+
+
+class TestQuerySchemaCache(unittest.IsolatedAsyncioTestCase):
+    @patch("app.schema.get_client_for_url")
+    async def test_fresh_schema_is_served_from_memory(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            return_value=Response(200, json={"a": 1}, headers={"ETag": '"v1"'})
+        )
+        cache = QuerySchemaCache(ENDPOINT, max_age=60)
+
+        self.assertEqual(await cache.get(), {"a": 1})
+        self.assertEqual(await cache.get(), {"a": 1})
+
+        mock_get.assert_awaited_once()
+        self.assertEqual(cache.version, '"v1"')
+
+    @patch("app.schema.get_client_for_url")
+    async def test_stale_schema_is_revalidated_in_background(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            return_value=Response(200, json={"a": 1}, headers={"ETag": '"v1"'})
+        )
+        cache = QuerySchemaCache(ENDPOINT, max_age=0)
+        await cache.get()
+
+        mock_get.return_value = Response(304)
+
+        # The stale copy is returned right away, revalidation uses the ETag
+        self.assertEqual(await cache.get(), {"a": 1})
+        await asyncio.sleep(0)
+
+        self.assertEqual(mock_get.await_count, 2)
+        self.assertEqual(mock_get.await_args.kwargs["headers"], {"If-None-Match": '"v1"'})
+
+    @patch("app.schema.get_client_for_url")
+    async def test_stale_schema_survives_upstream_errors(self, mock_get_client):
+        mock_get = mock_get_client.return_value.get = AsyncMock(
+            return_value=Response(200, json={"a": 1})
+        )
+        cache = QuerySchemaCache(ENDPOINT, max_age=60)
+        await cache.get()
+
+        mock_get.side_effect = httpx.ConnectError("down")
+
+        self.assertEqual(await cache.refresh(force=True), {"a": 1})
+        self.assertEqual(mock_get.await_args.kwargs["headers"], {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import json
+import unittest
+from unittest.mock import patch
+
+from app import serialization
+from app.serialization import RawJSONResponse, splice_field
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_splice_into_object(self):
+        spliced = splice_field(b'{"properties": [1, 2]}\n', "filters", {"rooms": 2})
+
+        self.assertEqual(json.loads(spliced), {"properties": [1, 2], "filters": {"rooms": 2}})
+        self.assertTrue(spliced.startswith(b'{"properties": [1, 2]'))
+
+    def test_splice_into_empty_object(self):
+        self.assertEqual(json.loads(splice_field(b"{ }", "filters", {})), {"filters": {}})
+
+    def test_splice_rejects_non_objects(self):
+        with self.assertRaises(ValueError):
+            splice_field(b"[1, 2]", "filters", {})
+
+    @patch("app.serialization.ORJSON_AVAILABLE", False)
+    def test_dumps_without_orjson(self):
+        self.assertEqual(serialization.dumps({"city": "Zürich"}), '{"city":"Zürich"}'.encode())
+
+    def test_orjson_and_json_agree(self):
+        content = {"city": "Zürich", "rooms": [1, 2.5], "filters": {"balcony": True, "floor": None}}
+
+        self.assertTrue(serialization.ORJSON_AVAILABLE)
+        with_orjson = serialization.dumps(content)
+
+        with patch("app.serialization.ORJSON_AVAILABLE", False):
+            without_orjson = serialization.dumps(content)
+            self.assertEqual(serialization.loads(with_orjson), content)
+
+        self.assertEqual(with_orjson, without_orjson)
+        self.assertEqual(serialization.loads(without_orjson), content)
+
+    def test_loads_rejects_invalid_json_either_way(self):
+        with self.assertRaises(ValueError):
+            serialization.loads(b"{not json")
+
+        with patch("app.serialization.ORJSON_AVAILABLE", False), self.assertRaises(ValueError):
+            serialization.loads(b"{not json")
+
+    def test_raw_response_passes_bytes_through(self):
+        self.assertEqual(RawJSONResponse(b'{"a": 1}').body, b'{"a": 1}')
+        self.assertEqual(json.loads(RawJSONResponse({"a": 1}).body), {"a": 1})
+        self.assertEqual(RawJSONResponse(b"{}").headers["content-type"], "application/json")
+
+
+if __name__ == "__main__":
+    unittest.main()
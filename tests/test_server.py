@@ -0,0 +1,56 @@
+import unittest
+from unittest.mock import patch
+
+from app import server
+
+
+class TestServerOptions(unittest.TestCase):
+
+    @patch("app.server.SERVER_WORKERS", 4)
+    @patch("app.server.DEBUG", False)
+    @patch("app.server.UVLOOP_AVAILABLE", True)
+    @patch("app.server.HTTPTOOLS_AVAILABLE", True)
+    def test_uses_fast_loop_and_parser_when_installed(self):
+        options = server.server_options()
+
+        self.assertEqual(options["workers"], 4)
+        self.assertEqual(options["loop"], "uvloop")
+        self.assertEqual(options["http"], "httptools")
+
+    @patch("app.server.UVLOOP_AVAILABLE", False)
+    @patch("app.server.HTTPTOOLS_AVAILABLE", False)
+    def test_falls_back_to_pure_python_defaults(self):
+        options = server.server_options()
+
+        self.assertEqual(options["loop"], "asyncio")
+        self.assertEqual(options["http"], "h11")
+
+    @patch("app.server.SERVER_WORKERS", 8)
+    @patch("app.server.DEBUG", True)
+    def test_debug_runs_single_worker(self):
+        self.assertEqual(server.server_options()["workers"], 1)
+
+    @patch("app.server.FORWARDED_ALLOW_IPS", "10.0.0.0/8")
+    def test_trusts_forwarded_headers_of_the_configured_proxies(self):
+        options = server.server_options()
+
+        self.assertTrue(options["proxy_headers"])
+        self.assertEqual(options["forwarded_allow_ips"], "10.0.0.0/8")
+
+    @patch("app.server.SERVER_LIMIT_CONCURRENCY", 0)
+    @patch("app.server.SERVER_MAX_REQUESTS", 0)
+    @patch("app.server.SERVER_GRACEFUL_SHUTDOWN_TIMEOUT", 15)
+    def test_zero_means_no_limit(self):
+        options = server.server_options()
+
+        self.assertIsNone(options["limit_concurrency"])
+        self.assertIsNone(options["limit_max_requests"])
+        self.assertEqual(options["timeout_graceful_shutdown"], 15)
+
+    @patch("app.server.uvicorn.run")
+    def test_run_passes_app_by_import_string(self, mock_run):
+        server.run()
+
+        args, kwargs = mock_run.call_args
+        self.assertEqual(args, ("app.main:app",))
+        self.assertIn("backlog", kwargs)
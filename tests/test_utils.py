@@ -1,9 +1,19 @@
+import asyncio
+import gzip
+import io
 import unittest
-from unittest.mock import patch
+from unittest.mock import AsyncMock, patch
 
+import httpx
 from httpx import Response
 from fastapi import HTTPException
-from app.utils import get_data_from_llm, _reverse_proxy, _reverse_auth_proxy
+from app.utils import (get_data_from_llm, _reverse_proxy, _reverse_auth_proxy,
+                       async_fetch_json, async_get_data_from_llm,
+                       async_raise_for_invalid_token, async_upload_file)
+from app.auth import clear_auth_cache
+from app.proxy_cache import clear_response_cache
+from starlette.datastructures import Headers, UploadFile
+from starlette.responses import StreamingResponse
 from starlette.requests import Request
 
 class TestUtils(unittest.TestCase):
@@ -174,5 +184,360 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(context.exception.detail, "Request does not contain authorization token.")
 
 
+class TestAsyncUtils(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        await clear_auth_cache()
+
+    @patch("app.utils.get_client_for_url")
+    async def test_async_fetch_json(self, mock_get_client):
+        mock_get_client.return_value.get = AsyncMock(
+            return_value=Response(200, json={"param1": "value1"})
+        )
+
+        result = await async_fetch_json("http://inventory-service/schema", {"a": 1})
+
+        self.assertEqual(result, {"param1": "value1"})
+        mock_get_client.return_value.get.assert_awaited_once_with(
+            "http://inventory-service/schema", params={"a": 1}
+        )
+
+    @patch("app.utils.get_client_for_url")
+    async def test_async_fetch_json_failure(self, mock_get_client):
+        mock_get_client.return_value.get = AsyncMock(return_value=Response(500))
+
+        self.assertIsNone(await async_fetch_json("http://inventory-service/schema"))
+
+    @patch("app.utils.get_client_for_url")
+    async def test_async_get_data_from_llm_success(self, mock_get_client):
+        mock_get_client.return_value.post = AsyncMock(
+            return_value=Response(200, json={"content": '{"value":"key"}'})
+        )
+
+        status_code, llm_query = await async_get_data_from_llm(
+            "https://example.com/llm", {"param1": "value1"}
+        )
+
+        self.assertEqual(status_code, 200)
+        self.assertEqual(llm_query.content, '{"value":"key"}')
+
+    @patch("app.auth.get_client_for_url")
+    async def test_async_raise_for_invalid_token(self, mock_get_client):
+        mock_get_client.return_value.get = AsyncMock(return_value=Response(200, json=False))
+
+        with self.assertRaises(HTTPException) as context:
+            await async_raise_for_invalid_token("invalid_token")
+
+        self.assertEqual(context.exception.status_code, 401)
+        self.assertEqual(context.exception.detail, "Invalid authorization token.")
+
+    @patch("app.utils.get_client_for_url")
+    async def test_async_upload_file_streams_multipart(self, mock_get_client):
+        received = {}
+
+        def handler(request: httpx.Request) -> Response:
+            received["headers"] = request.headers
+            received["body"] = request.read()
+            return Response(200, text="uploaded")
+
+        mock_get_client.return_value = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        upload = UploadFile(
+            io.BytesIO(b"image-bytes"),
+            size=11,
+            filename="house.png",
+            headers=Headers({"content-type": "image/png"}),
+        )
+
+        res = await async_upload_file("http://image-service/upload", upload, params=dict(primary=True))
+
+        self.assertEqual(res, "uploaded")
+        self.assertEqual(int(received["headers"]["Content-Length"]), len(received["body"]))
+        self.assertIn(b'filename="house.png"', received["body"])
+        self.assertIn(b"Content-Type: image/png\r\n\r\nimage-bytes\r\n", received["body"])
+
+
+class UpstreamStream(httpx.AsyncByteStream):
+    def __init__(self, body: bytes):
+        self.body = body
+
+    async def __aiter__(self):
+        yield self.body
+
+
+def make_request(
+        method: str,
+        path: str,
+        body: bytes = b"",
+        headers: list | None = None,
+        content_length: bytes | None = None,
+    ) -> Request:
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    if content_length is None:
+        content_length = str(len(body)).encode()
+
+    return Request(scope={
+        "type": "http",
+        "method": method,
+        "headers": [(b"content-length", content_length)] + (headers or []),
+        "path": path,
+        "query_string": b"",
+        "root_path": "",
+        "client": ("127.0.0.1", 12345),
+        "server": ("example.com", 443),
+        "scheme": "https",
+    }, receive=receive)
+
+
+class TestReverseProxy(unittest.IsolatedAsyncioTestCase):
+    def mock_upstream(self, mock_get_client, body: bytes):
+        received = {}
+        self.upstream_calls = 0
+
+        async def handler(request: httpx.Request) -> Response:
+            self.upstream_calls += 1
+            received["body"] = await request.aread()
+            received["stream"] = request.stream
+            return Response(
+                200, stream=UpstreamStream(body), headers={"Content-Length": str(len(body))}
+            )
+
+        mock_get_client.return_value = httpx.AsyncClient(
+            base_url="http://inventory-service", transport=httpx.MockTransport(handler)
+        )
+
+        return received
+
+    @patch("app.utils.get_client")
+    async def test_small_bodies_are_buffered(self, mock_get_client):
+        received = self.mock_upstream(mock_get_client, b"listing")
+
+        response = await _reverse_proxy("inventory-service", make_request("POST", "/properties", b"{}"))
+
+        self.assertNotIsInstance(response, StreamingResponse)
+        self.assertEqual(response.body, b"listing")
+        self.assertEqual(received["body"], b"{}")
+
+    @patch("app.utils.get_client")
+    async def test_stream_mode(self, mock_get_client):
+        received = self.mock_upstream(mock_get_client, b"listing")
+
+        response = await _reverse_proxy(
+            "inventory-service", make_request("POST", "/upload", b"image"), stream=True
+        )
+
+        self.assertIsInstance(response, StreamingResponse)
+        self.assertEqual(b"".join([chunk async for chunk in response.body_iterator]), b"listing")
+        self.assertEqual(received["body"], b"image")
+
+    @patch("app.utils.get_client")
+    async def test_streamed_gets_are_sent_with_a_byte_body(self, mock_get_client):
+        received = self.mock_upstream(mock_get_client, b"image")
+
+        await _reverse_proxy("inventory-service", make_request("GET", "/images"), stream=True)
+
+        # So they can be hedged
+        self.assertIsInstance(received["stream"], httpx.ByteStream)
+
+    @patch("app.utils.get_client")
+    async def test_malformed_content_length_is_streamed(self, mock_get_client):
+        received = self.mock_upstream(mock_get_client, b"listing")
+
+        request = make_request("POST", "/properties", b"{}", content_length=b"2x")
+        response = await _reverse_proxy("inventory-service", request)
+
+        self.assertEqual(response.body, b"listing")
+        self.assertEqual(received["body"], b"{}")
+
+    @patch("app.utils.PROXY_MAX_BUFFER_BYTES", 4)
+    @patch("app.utils.get_client")
+    async def test_bodies_over_the_ceiling_are_streamed(self, mock_get_client):
+        self.mock_upstream(mock_get_client, b"large listing")
+
+        response = await _reverse_proxy("inventory-service", make_request("GET", "/properties"))
+
+        self.assertIsInstance(response, StreamingResponse)
+        self.assertEqual(b"".join([chunk async for chunk in response.body_iterator]), b"large listing")
+
+    @patch("app.proxy_cache.SERVER_WORKERS", 1)
+    @patch("app.utils.get_client")
+    async def test_cached_routes_hit_upstream_once(self, mock_get_client):
+        self.mock_upstream(mock_get_client, b"listing")
+        await clear_response_cache()
+
+        for _ in range(2):
+            response = await _reverse_proxy(
+                "inventory-service", make_request("GET", "/properties"), stream=True, cache_ttl=30
+            )
+            self.assertEqual(response.body, b"listing")
+
+        self.assertEqual(self.upstream_calls, 1)
+
+        # A write through the gateway drops the cached listing
+        await _reverse_proxy("inventory-service", make_request("POST", "/properties", b"{}"), invalidates=True)
+        await _reverse_proxy("inventory-service", make_request("GET", "/properties"), cache_ttl=30)
+
+        self.assertEqual(self.upstream_calls, 3)
+
+    @patch("app.utils.get_client")
+    async def test_identical_gets_are_coalesced(self, mock_get_client):
+        self.upstream_calls = 0
+
+        async def handler(request: httpx.Request) -> Response:
+            self.upstream_calls += 1
+            await asyncio.sleep(0.01)
+            return Response(200, stream=UpstreamStream(b"listing"), headers={"Content-Length": "7"})
+
+        mock_get_client.return_value = httpx.AsyncClient(
+            base_url="http://inventory-service", transport=httpx.MockTransport(handler)
+        )
+
+        responses = await asyncio.gather(*(
+            _reverse_proxy("inventory-service", make_request("GET", "/queryProperties"), coalesce=True)
+            for _ in range(5)
+        ))
+
+        self.assertEqual([response.body for response in responses], [b"listing"] * 5)
+        self.assertEqual(self.upstream_calls, 1)
+
+        # Requests with different credentials are not merged
+        await asyncio.gather(*(
+            _reverse_proxy(
+                "inventory-service",
+                make_request("GET", "/queryProperties", headers=[(b"authorization", token)]),
+                coalesce=True,
+            )
+            for token in (b"a", b"b")
+        ))
+
+        self.assertEqual(self.upstream_calls, 3)
+
+    def mock_chunked_upstream(self, mock_get_client, chunks: list[bytes]):
+        self.upstream_calls = 0
+
+        async def body():
+            for chunk in chunks:
+                yield chunk
+
+        # Mock an upstream sending its body without a Content-Length
+        async def handler(request: httpx.Request) -> Response:
+            self.upstream_calls += 1
+            await asyncio.sleep(0.01)
+            return Response(200, content=body())
+
+        mock_get_client.return_value = httpx.AsyncClient(
+            base_url="http://inventory-service", transport=httpx.MockTransport(handler)
+        )
+
+    @patch("app.utils.get_client")
+    async def test_bodies_of_unknown_length_are_buffered_and_coalesced(self, mock_get_client):
+        self.mock_chunked_upstream(mock_get_client, [b"list", b"ing"])
+
+        responses = await asyncio.gather(*(
+            _reverse_proxy("inventory-service", make_request("GET", "/queryProperties"), coalesce=True)
+            for _ in range(5)
+        ))
+
+        self.assertEqual([response.body for response in responses], [b"listing"] * 5)
+        self.assertEqual(self.upstream_calls, 1)
+
+    @patch("app.utils.PROXY_MAX_BUFFER_BYTES", 4)
+    @patch("app.utils.get_client")
+    async def test_coalesced_bodies_over_the_ceiling_are_streamed_once(self, mock_get_client):
+        self.mock_chunked_upstream(mock_get_client, [b"large ", b"listing"])
+
+        responses = await asyncio.gather(*(
+            _reverse_proxy("inventory-service", make_request("GET", "/queryProperties"), coalesce=True)
+            for _ in range(2)
+        ))
+
+        for response in responses:
+            self.assertIsInstance(response, StreamingResponse)
+            self.assertEqual(b"".join([chunk async for chunk in response.body_iterator]), b"large listing")
+
+        # One request streams the shared response on, the other fetches its own
+        self.assertEqual(self.upstream_calls, 2)
+
+    @patch("app.utils.PROXY_MAX_BUFFER_BYTES", 4)
+    @patch("app.utils.get_client")
+    async def test_shared_response_is_closed_when_every_request_is_cancelled(self, mock_get_client):
+        release = asyncio.Event()
+        closed = asyncio.Event()
+
+        class Body(httpx.AsyncByteStream):
+            async def __aiter__(self):
+                await release.wait()
+                yield b"large "
+                yield b"listing"
+
+            async def aclose(self):
+                closed.set()
+
+        # Mock an upstream still sending its large body when the clients give up
+        async def handler(request: httpx.Request) -> Response:
+            return Response(200, stream=Body())
+
+        mock_get_client.return_value = httpx.AsyncClient(
+            base_url="http://inventory-service", transport=httpx.MockTransport(handler)
+        )
+
+        requests = [
+            asyncio.ensure_future(
+                _reverse_proxy("inventory-service", make_request("GET", "/queryProperties"), coalesce=True)
+            )
+            for _ in range(3)
+        ]
+        await asyncio.sleep(0.01)
+
+        for request in requests:
+            request.cancel()
+        await asyncio.gather(*requests, return_exceptions=True)
+        self.assertFalse(closed.is_set())
+
+        release.set()
+        await asyncio.wait_for(closed.wait(), 1)
+
+    def mock_gzip_upstream(self, mock_get_client, body: bytes) -> dict:
+        received = {}
+        compressed = gzip.compress(body)
+
+        async def handler(request: httpx.Request) -> Response:
+            received["accept-encoding"] = request.headers.get("accept-encoding")
+            return Response(200, stream=UpstreamStream(compressed), headers={
+                "Content-Encoding": "gzip", "Content-Length": str(len(compressed)),
+            })
+
+        mock_get_client.return_value = httpx.AsyncClient(
+            base_url="http://inventory-service", transport=httpx.MockTransport(handler)
+        )
+
+        return received
+
+    @patch("app.utils.get_client")
+    async def test_compressed_bodies_are_passed_through(self, mock_get_client):
+        received = self.mock_gzip_upstream(mock_get_client, b"listing")
+
+        response = await _reverse_proxy(
+            "inventory-service",
+            make_request("GET", "/properties", headers=[(b"accept-encoding", b"gzip, zstd")]),
+        )
+
+        # Only the encodings the gateway could decode for other clients are asked for
+        self.assertEqual(received["accept-encoding"], "gzip")
+        self.assertEqual(response.headers["content-encoding"], "gzip")
+        self.assertEqual(gzip.decompress(response.body), b"listing")
+
+    @patch("app.utils.get_client")
+    async def test_compressed_bodies_are_decoded_for_clients_without_support(self, mock_get_client):
+        received = self.mock_gzip_upstream(mock_get_client, b"listing")
+
+        response = await _reverse_proxy("inventory-service", make_request("GET", "/properties"))
+
+        self.assertEqual(received["accept-encoding"], "identity")
+        self.assertNotIn("content-encoding", response.headers)
+        self.assertEqual(response.body, b"listing")
+        self.assertEqual(response.headers["content-length"], "7")
+
+
 if __name__ == "__main__":
     unittest.main()
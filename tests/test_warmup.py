@@ -0,0 +1,69 @@
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import httpx
+
+from app import warmup
+from app.main import app
+
+
+class TestWarmUp(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        warmup._state["ready"] = False
+        warmup._state["steps"].clear()
+
+    @patch("app.warmup.refresh_query_schema", new_callable=AsyncMock, return_value={"properties": {}})
+    @patch("app.warmup.get_http_transport")
+    @patch("app.warmup.UPSTREAM_SETTINGS", {
+        "inventory-service": dict(scheme="http", warmup_connections=3),
+        "geocoder": dict(scheme="https", warmup_connections=0),
+    })
+    async def test_connections_are_opened_per_upstream(self, mock_get_transport, mock_refresh):
+        requests = []
+
+        def handler(request):
+            requests.append(request)
+            return httpx.Response(404)
+
+        mock_get_transport.return_value = httpx.MockTransport(handler)
+
+        await warmup.warm_up()
+
+        self.assertTrue(warmup.is_ready())
+        self.assertEqual([str(request.url) for request in requests], ["http://inventory-service/"] * 3)
+        self.assertEqual(warmup.readiness()["steps"], {
+            "connections:inventory-service": "done",
+            "connections:geocoder": "done",
+            "query_schema": "done",
+        })
+
+    @patch("app.warmup.refresh_query_schema", new_callable=AsyncMock, return_value=None)
+    @patch("app.warmup.get_http_transport")
+    @patch("app.warmup.UPSTREAM_SETTINGS", {"inventory-service": dict(scheme="http", warmup_connections=1)})
+    async def test_failed_steps_do_not_block_readiness(self, mock_get_transport, mock_refresh):
+        # Mock the upstream being down
+        def handler(request):
+            raise httpx.ConnectError("refused")
+
+        mock_get_transport.return_value = httpx.MockTransport(handler)
+
+        await warmup.warm_up()
+
+        self.assertTrue(warmup.is_ready())
+        self.assertEqual(set(warmup.readiness()["steps"].values()), {"failed"})
+
+    async def test_ready_endpoint(self):
+        transport = httpx.ASGITransport(app=app)
+
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            warming = await client.get("/ready")
+            warmup._state["ready"] = True
+            ready = await client.get("/ready")
+
+        self.assertEqual(warming.status_code, 503)
+        self.assertEqual(ready.status_code, 200)
+        self.assertTrue(ready.json()["ready"])
+
+
+if __name__ == "__main__":
+    unittest.main()